@@ -10,6 +10,7 @@ from connection_pool import ConnectionPool
 
 from images import FindImageQueryGenerator
 from pdfs import FindPDFQueryGenerator
+from text_extraction.text_extractor import PDF_ENGINES
 from videos import FindVideoQueryGenerator
 
 IMAGE_DESCRIPTOR_SET = 'wf_embeddings_clip'
@@ -121,7 +122,8 @@ def main(params):
                 model_name=params.model_name,
                 properties={"type": "text", "source_type": "pdf"})
         generator = FindPDFQueryGenerator(
-            pool, embedder, done_property=DONE_PROPERTY)
+            pool, embedder, done_property=DONE_PROPERTY,
+            pdf_engine=params.pdf_engine, pdf_workers=params.pdf_workers)
         with pool.get_connection() as db:
             querier = ParallelQuery.ParallelQuery(db)
 
@@ -130,6 +132,7 @@ def main(params):
         querier.query(generator, batchsize=1,
                       numthreads=params.numthreads,
                       stats=True)
+        generator.extractor.close()
 
         print("Done with PDFs.")
 
@@ -186,6 +189,13 @@ def get_args():
     obj.add_argument('--extract-pdfs', type=str2bool,
                      default=os.environ.get('WF_EXTRACT_PDFS', False))
 
+    obj.add_argument('--pdf-engine', type=str,
+                     choices=PDF_ENGINES,
+                     default=os.environ.get('WF_PDF_ENGINE', 'pdfplumber'))
+
+    obj.add_argument('--pdf-workers', type=int,
+                     default=os.environ.get('WF_PDF_WORKERS', 0))
+
     obj.add_argument('--log-level', type=str,
                      default=os.environ.get('WF_LOG_LEVEL', 'WARNING'))
 
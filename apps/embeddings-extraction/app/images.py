@@ -7,6 +7,7 @@ from PIL import Image
 
 from aperturedb import QueryGenerator
 from connection_pool import ConnectionPool
+from bulk import BulkUpdate
 
 logger = logging.getLogger(__name__)
 
@@ -94,38 +95,18 @@ class FindImageQueryGenerator(QueryGenerator.QueryGenerator):
             logger.exception(f"error: {response}")
             return 0
 
-        desc_blobs = []
+        desc_blobs = [image_features.tobytes()
+                      for image_features in self.embedder.embed_images(r_blobs)]
 
-        for b in r_blobs:
-            image_features = self.embedder.embed_image(b)
-            desc_blobs.append(image_features.tobytes())
-
-        query = []
-        for uniqueid, i in zip(uniqueids, range(len(uniqueids))):
-
-            query.append({
-                "FindImage": {
-                    "_ref": i + 1,
-                    "constraints": {
-                        "_uniqueid": ["==", uniqueid]
-                    },
-                }
-            })
-
-            query.append({
-                "UpdateImage": {
-                    "ref": i + 1,
-                    "properties": {
-                        self.done_property: True
-                    },
-                }
-            })
-
-            query.append({
+        bulk = BulkUpdate("Image", uniqueids, properties={
+            self.done_property: True
+        })
+        for uniqueid in uniqueids:
+            bulk.add({
                 "AddDescriptor": {
                     "set": self.embedder.descriptor_set,
                     "connect": {
-                        "ref": i + 1
+                        "ref": bulk.ref(uniqueid)
                     },
                     "properties": {
                         "type": "image",
@@ -136,7 +117,7 @@ class FindImageQueryGenerator(QueryGenerator.QueryGenerator):
             })
 
         with self.pool.get_connection() as db:
-            r, _ = db.query(query, desc_blobs)
+            r, _ = db.query(bulk.query(), desc_blobs)
 
             if not db.last_query_ok():
                 db.print_last_response()
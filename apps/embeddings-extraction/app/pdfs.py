@@ -36,7 +36,8 @@ class FindPDFQueryGenerator(QueryGenerator.QueryGenerator):
         Generates n FindBlob Queries
     """
 
-    def __init__(self, pool, embedder, done_property: str):
+    def __init__(self, pool, embedder, done_property: str,
+                 pdf_engine: str = "pdfplumber", pdf_workers: int = 0):
 
         self.pool = pool
         self.embedder = embedder
@@ -74,7 +75,8 @@ class FindPDFQueryGenerator(QueryGenerator.QueryGenerator):
 
         self.len = self.total_batches
 
-        self.extractor = TextExtractor()
+        self.extractor = TextExtractor(pdf_engine=pdf_engine,
+                                       pdf_workers=pdf_workers)
         self.segmenter = TextSegmenter(max_tokens=MAX_TOKENS,
                                        overlap_tokens=OVERLAP_TOKENS)
 
@@ -8,6 +8,7 @@ from aperturedb.CommonLibrary import create_connector, execute_query
 from aperturedb import QueryGenerator
 from aperturedb import ParallelQuery
 from connection_pool import ConnectionPool
+from bulk import BulkUpdate
 from facenet_pytorch import MTCNN, InceptionResnetV1
 import torch
 
@@ -106,36 +107,17 @@ class FindImageQueryGenerator(QueryGenerator.QueryGenerator):
                 if self.generate_embeddings:
                     assert len(embeddings) == len(box)
 
-        query = []
-
-        ref_counter = 1
+        bulk = BulkUpdate("Image", uniqueids, properties={
+            PROCESSED_LABEL_IMAGES: True
+        })
         for uniqueid in uniqueids:
-            query.append({
-                "FindImage": {
-                    "_ref": ref_counter,
-                    "constraints": {
-                        "_uniqueid": ["==", uniqueid]
-                    },
-                }
-            })
-
-            query.append({
-                "UpdateImage": {
-                    "ref": ref_counter,
-                    "properties": {
-                        PROCESSED_LABEL_IMAGES: True
-                    },
-                }
-            })
-
-            bb_ref = 0
             if uniqueid in boxes:
-                bb_ref = 1
                 for box, prob in boxes[uniqueid]["boxes"]:
-                    query.append({
+                    bb_ref = bulk.new_ref()
+                    bulk.add({
                         "AddBoundingBox": {
-                            "image_ref": ref_counter,
-                            "_ref": ref_counter + bb_ref,
+                            "image_ref": bulk.ref(uniqueid),
+                            "_ref": bb_ref,
                             "label": "face",
                             "rectangle": {
                                 "x": max(int(box[0]), 0),
@@ -149,21 +131,19 @@ class FindImageQueryGenerator(QueryGenerator.QueryGenerator):
                         }
                     })
                     if self.generate_embeddings:
-                        query.append({
+                        bulk.add({
                             "AddDescriptor": {
                                 "set": PROCESSED_LABEL_IMAGES,
                                 "connect": {
-                                    "ref": ref_counter + bb_ref
+                                    "ref": bb_ref
                                 }
                             }
                         })
-                    bb_ref += 1
-            ref_counter += (bb_ref + 1)
 
         # This is not nice, but we need to create a new connection
         # and this happens in parallel with many threads.
 
-        result, response, _ = self.pool.execute_query(query, desc_blobs)
+        result, response, _ = self.pool.execute_query(bulk.query(), desc_blobs)
         if result != 0:
             print(f"Error: {response}")
             return 0
@@ -32,24 +32,7 @@ class Tool:
         return ""
 
     def get_function(self) -> Callable:
-        @functools.wraps(self.function)
-        def wrapper(*args, **kwargs):
-            """Wrapper to call the tool function."""
-            logger.info(
-                f"Calling tool: {self.name} with args: {args}, kwargs: {kwargs}")
-            check_auth()
-
-            # Ordinary exceptions may not be propagated to the client, so we catch them here and re-wrap them
-            # as ToolError with an informative message.
-            # Note that this potentially leaks sensitive information about the implementation.
-            try:
-                return self.function(*args, **kwargs)
-            except Exception as e:
-                logger.exception(f"Tool {self.name} crashed")
-                raise ToolError(
-                    f"Internal error in {self.name}: {type(e).__name__}: {str(e)} - {traceback.format_exc()}")
-
-        return wrapper
+        return wrap_function(self.function, "Tool", self.name, ToolError)
 
 
 @dataclass
@@ -79,24 +62,7 @@ class Resource():
         return ""
 
     def get_function(self) -> Callable:
-        @functools.wraps(self.function)
-        def wrapper(*args, **kwargs):
-            """Wrapper to call the resource function."""
-            logger.info(
-                f"Calling resource: {self.name} with args: {args}, kwargs: {kwargs}")
-            check_auth()
-
-            # Ordinary exceptions may not be propagated to the client, so we catch them here and re-wrap them
-            # as ToolError with an informative message.
-            # Note that this potentially leaks sensitive information about the implementation.
-            try:
-                return self.function(*args, **kwargs)
-            except Exception as e:
-                logger.exception(f"Resource {self.name} crashed")
-                raise ResourceError(
-                    f"Internal error in {self.name}: {type(e).__name__}: {str(e)} - {traceback.format_exc()}")
-
-        return wrapper
+        return wrap_function(self.function, "Resource", self.name, ResourceError)
 
 
 _registered_tools: List[Tool] = []
@@ -107,6 +73,49 @@ TOKEN = args.auth_token
 assert TOKEN, "You must provide a valid auth token in WF_AUTH_TOKEN"
 
 
+def wrap_function(function: Callable, kind: str, name: str, error_class: type) -> Callable:
+    """Wraps a tool or resource function to check authentication and report errors.
+
+    Coroutine functions get a coroutine wrapper, so that they run on the
+    event loop without blocking it.
+    """
+    def before_call(args, kwargs):
+        logger.info(
+            f"Calling {kind.lower()}: {name} with args: {args}, kwargs: {kwargs}")
+        check_auth()
+
+    # Ordinary exceptions may not be propagated to the client, so we catch them here and re-wrap them
+    # as ToolError or ResourceError with an informative message.
+    # Note that this potentially leaks sensitive information about the implementation.
+    def crashed(e: Exception):
+        logger.exception(f"{kind} {name} crashed")
+        return error_class(
+            f"Internal error in {name}: {type(e).__name__}: {str(e)} - {traceback.format_exc()}")
+
+    if inspect.iscoroutinefunction(function):
+        @functools.wraps(function)
+        async def async_wrapper(*args, **kwargs):
+            """Wrapper to call the coroutine function."""
+            before_call(args, kwargs)
+            try:
+                return await function(*args, **kwargs)
+            except Exception as e:
+                raise crashed(e)
+
+        return async_wrapper
+
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        """Wrapper to call the function."""
+        before_call(args, kwargs)
+        try:
+            return function(*args, **kwargs)
+        except Exception as e:
+            raise crashed(e)
+
+    return wrapper
+
+
 def check_auth():
     """Check if the request has a valid bearer token."""
     logger.debug("Checking authentication")
@@ -5,22 +5,22 @@ from pydantic import Field
 import base64
 
 @declare_mcp_resource(uri="/image/jpg/{image_id}", mime_type="image/jpeg")
-def image_jpg(
+async def image_jpg(
     image_id: Annotated[str, Field(description="The unique identifier for the image", min_length=1)],
 ) -> bytes:
     """Fetch an image by its ID in JPG format."""
-    return image(format="jpg", image_id=image_id)
+    return await image(format="jpg", image_id=image_id)
 
 
 @declare_mcp_resource(uri="/image/png/{image_id}", mime_type="image/png")
-def image_png(
+async def image_png(
     image_id: Annotated[str, Field(description="The unique identifier for the image", min_length=1)],
 ) -> bytes:
     """Fetch an image by its ID in PNG format."""
-    return image(format="png", image_id=image_id)
+    return await image(format="png", image_id=image_id)
 
 
-def image(
+async def image(
     format: Annotated[Literal["jpg", "png"], Field(description="The format of the image (e.g., 'jpg', 'png')")],
     image_id: Annotated[str, Field(description="The unique identifier for the image", min_length=1)],
 ) -> bytes:
@@ -44,7 +44,7 @@ def image(
     ]
 
     try:
-        response, blobs = connection_pool.query(query)
+        response, blobs = await connection_pool.query(query)
         if not response or not blobs:
             logger.error(f"Image with ID {image_id} not found.")
             raise ValueError(f"Image with ID {image_id} not found.")
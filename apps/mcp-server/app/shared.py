@@ -1,7 +1,7 @@
 import logging
 import os
 
-from connection_pool import ConnectionPool
+from connection_pool import AsyncConnectionPool
 
 
 def configure_logging(log_level):
@@ -36,4 +36,6 @@ def get_args():
 
 args = get_args()
 logger = configure_logging(args.log_level)
-connection_pool = ConnectionPool()
+# Queries run in the pool's threads, so concurrent tool calls overlap.
+# Fail requests rather than wait forever for a connection.
+connection_pool = AsyncConnectionPool(acquire_timeout=60)
@@ -1,3 +1,4 @@
+import asyncio
 import os
 from typing import List, Annotated
 
@@ -39,7 +40,7 @@ class FindSimilarImagesResponse(BaseModel):
 
 
 @declare_mcp_tool
-def find_similar_documents(query: Annotated[str, Field(description="The query text to find similar documents for")],
+async def find_similar_documents(query: Annotated[str, Field(description="The query text to find similar documents for")],
                            k: Annotated[int, Field(
                                description="The maximum number of documents to return")] = 5,
                            descriptor_set: Annotated[str, Field(
@@ -50,13 +51,12 @@ def find_similar_documents(query: Annotated[str, Field(description="The query te
         raise ValueError(
             "Descriptor set is required. Please provide a valid descriptor set name.")
 
-    with connection_pool.get_connection() as client:
-        embedder = Embedder.from_existing_descriptor_set(
-            client, descriptor_set)
+    embedder = await connection_pool.run(
+        Embedder.from_existing_descriptor_set, descriptor_set)
 
-    embedding = embedder.embed_text(query)
+    embedding = await asyncio.to_thread(embedder.embed_text, query)
 
-    with connection_pool.get_connection() as client:
+    def find_similar(client):
         entities = Descriptors(client)
         entities.find_similar(
             set=descriptor_set,
@@ -64,6 +64,9 @@ def find_similar_documents(query: Annotated[str, Field(description="The query te
             k_neighbors=k,
             results={"list": ["_uniqueid", "url", "text"]}
         )
+        return entities
+
+    entities = await connection_pool.run(find_similar)
     logger.info(
         f"Found {len(entities)} similar documents for query: {query} (k={k})")
     return FindSimilarDocumentsResponse(documents=[
@@ -73,7 +76,7 @@ def find_similar_documents(query: Annotated[str, Field(description="The query te
 
 
 @declare_mcp_tool
-def find_similar_images(query: Annotated[str, Field(description="The query text to find similar images for")],
+async def find_similar_images(query: Annotated[str, Field(description="The query text to find similar images for")],
                         k: Annotated[int, Field(
                             description="The maximum number of documents to return")] = 5,
                         descriptor_set: Annotated[str, Field(
@@ -84,11 +87,10 @@ def find_similar_images(query: Annotated[str, Field(description="The query text
         raise ValueError(
             "Descriptor set is required. Please provide a valid descriptor set name.")
 
-    with connection_pool.get_connection() as client:
-        embedder = Embedder.from_existing_descriptor_set(
-            client, descriptor_set)
+    embedder = await connection_pool.run(
+        Embedder.from_existing_descriptor_set, descriptor_set)
 
-    embedding = embedder.embed_text(query)
+    embedding = await asyncio.to_thread(embedder.embed_text, query)
 
     adb_query = [
         {
@@ -119,7 +121,7 @@ def find_similar_images(query: Annotated[str, Field(description="The query text
         },
     ]
 
-    _, response, blobs = connection_pool.execute_query(adb_query)
+    _, response, blobs = await connection_pool.execute_query(adb_query)
 
     def to_image_document(e, blob):
         return ImageDocument(
@@ -164,7 +166,7 @@ class DescriptorSetsResponse(BaseModel):
 
 
 @declare_mcp_tool
-def list_descriptor_sets() -> DescriptorSetsResponse:
+async def list_descriptor_sets() -> DescriptorSetsResponse:
     """List all available descriptor sets"""
     query = [
         {
@@ -177,7 +179,7 @@ def list_descriptor_sets() -> DescriptorSetsResponse:
             }
         }
     ]
-    _, response, _ = connection_pool.execute_query(query)
+    _, response, _ = await connection_pool.execute_query(query)
     if not response or not response[0].get("FindDescriptorSet"):
         logger.warning(
             "No descriptor sets found or unexpected response format.")
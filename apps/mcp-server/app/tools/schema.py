@@ -34,19 +34,16 @@ class ConnectionClassDescriptions(BaseModel):
     items: List[ConnectionClassDescription]
 
 
-def get_schema():
+async def get_schema():
     """Get the schema of the ApertureDB database."""
-    with connection_pool.get_connection() as client:
-        utils = Utils(client)
-        schema = utils.get_schema()
-    return schema
+    return await connection_pool.run(lambda client: Utils(client).get_schema())
 
 
 
 @declare_mcp_tool
-def list_entity_classes() -> ClassList:
+async def list_entity_classes() -> ClassList:
     """List all entity classes in the database."""
-    schema = get_schema()
+    schema = await get_schema()
     try:
         results = schema['entities']['classes'].keys()
     except KeyError:
@@ -56,7 +53,7 @@ def list_entity_classes() -> ClassList:
 
 
 @declare_mcp_tool
-def describe_entity_class(
+async def describe_entity_class(
     class_name: Annotated[str, Field(
         description="The name of the entity class to describe")]
 ) -> EntityClassDescription:
@@ -70,7 +67,7 @@ def describe_entity_class(
             matched=description['matched'], 
             properties=properties)
 
-    schema = get_schema()
+    schema = await get_schema()
     try:
         description = schema['entities']['classes'][class_name]
     except KeyError:
@@ -80,9 +77,9 @@ def describe_entity_class(
 
 
 @declare_mcp_tool
-def list_connection_classes() -> ClassList:
+async def list_connection_classes() -> ClassList:
     """List all connection classes in the database."""
-    schema = get_schema()
+    schema = await get_schema()
     try:
         results = schema['connections']['classes'].keys()
     except KeyError:
@@ -92,7 +89,7 @@ def list_connection_classes() -> ClassList:
 
 
 @declare_mcp_tool
-def describe_connection_class(
+async def describe_connection_class(
     class_name: Annotated[str, Field(
         description="The name of the connection class to describe")]
 ) -> ConnectionClassDescriptions:
@@ -108,7 +105,7 @@ def describe_connection_class(
             src=description['src'], 
             dst=description['dst'])
 
-    schema = get_schema()
+    schema = await get_schema()
     try:
         # From athena 0.18.15, connection class values are lists of dicts
         # so we standardize on that format
@@ -15,31 +15,30 @@ from aperturedb import PyTorchDataset
 from aperturedb import CommonLibrary
 
 from connection_pool import ConnectionPool
+from bulk import BulkUpdate
 
 from infer import BboxDetector as BboxDetector
 
 resize_scale = 0.5
 stop = False
+# Maximum number of images whose detections are pushed in one query
+push_batch_size = 32
 
 
-def push_to_aperturedb(pool, img_id, detections, classes, source, confidence_threshold):
+def push_to_aperturedb(pool, img_detections, classes, source, confidence_threshold):
+    """Push detections for a list of (img_id, detections)"""
 
-    q = [{
-        "FindImage": {
-            "_ref": 1,
-            "blobs": False,
-            "constraints": {
-                "_uniqueid": ["==", img_id]
-            },
-        }
-    }, {
-        "UpdateImage": {
-            "ref": 1,
-            "properties": {
-                "wf_od_model": source
-            }
-        }
-    }]
+    bulk = BulkUpdate("Image", [img_id for img_id, _ in img_detections],
+                      properties={"wf_od_model": source})
+
+    for img_id, detections in img_detections:
+        push_detections(bulk, img_id, detections, classes,
+                        source, confidence_threshold)
+
+    pool.execute_query(bulk.query())
+
+
+def push_detections(bulk, img_id, detections, classes, source, confidence_threshold):
 
     for box, score, label in zip(detections["boxes"], detections["scores"], detections["labels"]):
 
@@ -52,7 +51,7 @@ def push_to_aperturedb(pool, img_id, detections, classes, source, confidence_thr
 
         abb = {
             "AddBoundingBox": {
-                "image_ref": 1,
+                "image_ref": bulk.ref(img_id),
                 "label": label,
                 "rectangle": {
                     "x": int(box[0] / resize_scale),
@@ -67,9 +66,7 @@ def push_to_aperturedb(pool, img_id, detections, classes, source, confidence_thr
             }
         }
 
-        q.append(abb)
-
-    pool.execute_query(q)
+        bulk.add(abb)
 
 
 def cleanup_bboxes_from_aperturedb(pool, source):
@@ -111,9 +108,16 @@ def push_to_aperturedb_queue(pool, queue, classes, params):
             return
 
         if len(queue) > 0:
-            img_id, detections = queue.pop(0)
-            push_to_aperturedb(pool, img_id, detections, classes,
-                               model_name, params.confidence_threshold)
+            img_detections = []
+            while len(queue) > 0 and len(img_detections) < push_batch_size:
+                try:
+                    img_detections.append(queue.pop(0))
+                except IndexError:
+                    # Another thread took the last one
+                    break
+            if img_detections:
+                push_to_aperturedb(pool, img_detections, classes,
+                                   model_name, params.confidence_threshold)
         else:
             time.sleep(1)
             continue
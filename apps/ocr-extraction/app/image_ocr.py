@@ -4,6 +4,7 @@ from PIL import Image
 
 from aperturedb import QueryGenerator
 from connection_pool import ConnectionPool
+from bulk import BulkUpdate
 import pytesseract
 from io import BytesIO
 import logging
@@ -102,33 +103,17 @@ class FindImageOCRQueryGenerator(QueryGenerator.QueryGenerator):
             return 0
 
         desc_blobs = []
-        desc_query = []
+        bulk = BulkUpdate("Image", uniqueids, properties={
+            self.done_property: True
+        })
 
         for uid, b in zip(uniqueids, r_blobs):
-            image_ref = len(desc_query) + 1
-            desc_query.extend([
-                {
-                    "FindImage": {
-                        "_ref": image_ref,
-                        "constraints": {
-                            "_uniqueid": ["==", uid]
-                        },
-                    }
-                },
-                {
-                    "UpdateImage": {
-                        "ref": image_ref,
-                        "properties": {
-                            self.done_property: True
-                        },
-                    }
-                }])
-
             text = self.ocr.bytes_to_text(b)
             if text:
-                text_ref = image_ref + 1
+                image_ref = bulk.ref(uid)
+                text_ref = bulk.new_ref()
                 logger.debug(f"Text: {text}")
-                desc_query.extend([
+                bulk.add(
                     {
                         "AddEntity": {
                             "class": "ExtractedText",
@@ -144,7 +129,7 @@ class FindImageOCRQueryGenerator(QueryGenerator.QueryGenerator):
                             },
                             "_ref": text_ref,
                         }
-                    }])
+                    })
 
                 if self.generate_embeddings:
                     block = TextBlock(text=text)
@@ -160,8 +145,8 @@ class FindImageOCRQueryGenerator(QueryGenerator.QueryGenerator):
                         continue
 
                     for segment, embedding in zip(segments, embeddings):
-                        segment_ref = len(desc_query) + 1
-                        desc_query.extend([
+                        segment_ref = bulk.new_ref()
+                        bulk.add(
                             {
                                 "AddDescriptor": {
                                     "set": self.embedder.descriptor_set,
@@ -177,21 +162,21 @@ class FindImageOCRQueryGenerator(QueryGenerator.QueryGenerator):
                                     },
                                     "_ref": segment_ref,
                                 },
-                            },
+                            })
+                        bulk.add(
                             {
                                 "AddConnection": {
                                     "class": "imageHasDescriptor",
                                     "src": image_ref,
                                     "dst": segment_ref,
                                 },
-                            }
-                        ])
+                            })
                         desc_blobs.append(embedding)
                     logger.debug(f"Added {len(segments)} segments for {uid}")
             else:
                 logger.warning(f"No text found for image {uid}")
 
-        status, r, _ = self.pool.execute_query(desc_query, desc_blobs)
+        status, r, _ = self.pool.execute_query(bulk.query(), desc_blobs)
         assert status == 0, f"Query failed: {r}"
 
     def segments_to_embeddings(self, segments: Iterable[Segment]) -> List[bytes]:
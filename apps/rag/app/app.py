@@ -9,13 +9,13 @@ import logging
 import time
 import json
 import os
-from aperturedb.CommonLibrary import create_connector
 import asyncio
 
 from embeddings import Embedder
 from rag import QAChain
 from context_builder import ContextBuilder
 from retriever import Retriever
+from connection_pool import AsyncConnectionPool
 from contextlib import asynccontextmanager
 from fastapi.middleware.cors import CORSMiddleware
 from status_tools import StatusUpdater
@@ -308,7 +308,7 @@ async def config(request: Request):
         return JSONResponse(not_ready)
 
     # calculate number of descriptors in the descriptorset
-    count = retriever.count() if retriever else 0
+    count = await retriever.count() if retriever else 0
 
     db_host = validate("hostname", envar="DB_HOST", allow_unset=True)
 
@@ -357,16 +357,18 @@ def verify_token(auth_header: str = Header(None), token_cookie: str = Cookie(Non
 
 def get_retriever(descriptorset_name: str, k: int):
     """Build the retriever for the given descriptorset and model."""
-    client = create_connector()
-    embedder = Embedder.from_existing_descriptor_set(
-        client, descriptorset_name)
+    # Searches run in the pool's threads, so concurrent questions overlap
+    pool = AsyncConnectionPool(acquire_timeout=60)
+    with pool.pool.get_connection() as client:
+        embedder = Embedder.from_existing_descriptor_set(
+            client, descriptorset_name)
     retriever = Retriever(
         embeddings=embedder,
         descriptor_set=descriptorset_name,
         search_type="mmr",  # "similarity" or "mmr"
         k=k,
         fetch_k=k * 4,  # number of results fetched for MMR
-        client=create_connector(),
+        pool=pool,
     )
     return retriever
 
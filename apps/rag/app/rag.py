@@ -24,7 +24,7 @@ class QAChain:
         else:
             logger.debug("Not rewriting query")
             rewritten_query = query
-        docs = self.retriever.invoke(rewritten_query)
+        docs = await self.retriever.invoke(rewritten_query)
         logger.debug(f"Retrieved {len(docs)} documents")
         # Use original query and history for context
         prompt = self.context_builder.build(docs, query, history)
@@ -54,7 +54,7 @@ class QAChain:
         else:
             logger.debug("Not rewriting query")
             rewritten_query = query
-        docs = self.retriever.invoke(rewritten_query)
+        docs = await self.retriever.invoke(rewritten_query)
         # Use original query and history for context
         prompt = self.context_builder.build(docs, query, history)
 
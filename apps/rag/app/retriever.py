@@ -1,7 +1,7 @@
 from dataclasses import dataclass
 from typing import List, Dict, Optional
 from aperturedb.Descriptors import Descriptors
-from aperturedb.CommonLibrary import execute_query
+import asyncio
 import logging
 
 logger = logging.getLogger(__name__)
@@ -35,29 +35,33 @@ class Retriever:
     search_type: str  # "mmr" or "similarity"
     k: int
     fetch_k: int
-    client: "Connector"
+    pool: "AsyncConnectionPool"
 
-    def invoke(self, query: str) -> List[Document]:
-        descriptors = Descriptors(self.client)
-        embedding = self.embeddings.embed_text(query)
-        if self.search_type == "mmr":
-            descriptors.find_similar_mmr(
-                set=self.descriptor_set,
-                vector=embedding,
-                k_neighbors=self.k,
-                fetch_k=self.fetch_k,
-            )
-        elif self.search_type == "similarity":
-            descriptors.find_similar(
-                set=self.descriptor_set,
-                vector=embedding,
-                k_neighbors=self.k,
-            )
-        else:
+    async def invoke(self, query: str) -> List[Document]:
+        if self.search_type not in ("mmr", "similarity"):
             raise ValueError(
                 f"Invalid search type: {self.search_type}. Must be 'mmr' or 'similarity'.")
 
-        results = [Document(doc) for doc in descriptors.response]
+        embedding = await asyncio.to_thread(self.embeddings.embed_text, query)
+
+        def search(client):
+            descriptors = Descriptors(client)
+            if self.search_type == "mmr":
+                descriptors.find_similar_mmr(
+                    set=self.descriptor_set,
+                    vector=embedding,
+                    k_neighbors=self.k,
+                    fetch_k=self.fetch_k,
+                )
+            else:
+                descriptors.find_similar(
+                    set=self.descriptor_set,
+                    vector=embedding,
+                    k_neighbors=self.k,
+                )
+            return descriptors.response
+
+        results = [Document(doc) for doc in await self.pool.run(search)]
         logger.info(
             f"Retrieved {len(results)} documents for query: {query}")
         logger.debug(
@@ -65,14 +69,14 @@ class Retriever:
 
         return results
 
-    def count(self):
+    async def count(self):
         query = [
             {"FindDescriptorSet": {
                 "with_name": self.descriptor_set,
                 "counts": True
             }}
         ]
-        status, response, _ = execute_query(self.client, query)
+        status, response, _ = await self.pool.execute_query(query)
         if status != 0:
             logger.error(f"Error executing count query: {response}")
             return 0
@@ -6,9 +6,10 @@
 from fastapi import FastAPI, Form, File, UploadFile, HTTPException, Request
 from fastapi.responses import JSONResponse
 from fastapi.exceptions import RequestValidationError
+import asyncio
 import json
 import base64
-from connection_pool import ConnectionPool
+from connection_pool import AsyncConnectionPool
 from typing import List, Optional
 from embeddings import Embedder
 from pydantic import BaseModel, Field, model_validator, ValidationError
@@ -24,7 +25,9 @@ logger = logging.getLogger(__name__)
 
 app = FastAPI()
 
-pool = ConnectionPool()
+# Queries run in the pool's threads, so concurrent requests overlap.
+# Fail requests rather than wait forever for a connection.
+pool = AsyncConnectionPool(acquire_timeout=60)
 
 
 # Custom exception handler for Pydantic validation errors
@@ -118,7 +121,7 @@ async def query_multipart(
         raise HTTPException(status_code=400, detail=error_msg)
     
     try:
-        status, out_json, out_blobs = pool.execute_query(in_json, in_blobs)
+        status, out_json, out_blobs = await pool.execute_query(in_json, in_blobs)
     except Exception as e:
         error_msg = f"Error executing query: {str(e)}\nQuery: {json.dumps(in_json, indent=2)[:500]}...\nTraceback:\n{traceback.format_exc()}"
         logger.error(error_msg)
@@ -179,18 +182,27 @@ class EmbedTextOutput(BaseModel):
         return cls(embeddings=[base64.b64encode(e).decode('utf-8') for e in embeddings])
 
 
+def _load_embedder(provider: str, model: str, corpus: str) -> Embedder:
+    return Embedder.from_properties(
+        {
+            "embeddings_provider": provider,
+            "embeddings_model": model,
+            "embeddings_pretrained": corpus,
+        },
+        descriptor_set=None
+    )
+
+
+def _embed_texts(input: "EmbedTextInput") -> List[bytes]:
+    embedder = _load_embedder(input.provider, input.model, input.corpus)
+    return embedder.embed_texts(input.texts)
+
+
 @app.post("/v2/embed/texts")
 async def forward_embed_texts(input: EmbedTextInput) -> EmbedTextOutput:
     try:
-        embedder = Embedder.from_properties(
-            {
-                "embeddings_provider": input.provider,
-                "embeddings_model": input.model,
-                "embeddings_pretrained": input.corpus,
-            },
-            descriptor_set=None
-        )
-        embeddings = embedder.embed_texts(input.texts)
+        # Loading the model and inference block, so keep them off the event loop
+        embeddings = await asyncio.to_thread(_embed_texts, input)
         return EmbedTextOutput.from_embeddings(embeddings)
     except Exception as e:
         error_msg = f"Error in text embedding request: {str(e)}\nProvider: {input.provider}, Model: {input.model}, Corpus: {input.corpus}\nNumber of texts: {len(input.texts)}\nTraceback:\n{traceback.format_exc()}"
@@ -264,21 +276,19 @@ class EmbedImageOutput(BaseModel):
         return cls(embeddings=[base64.b64encode(e).decode('utf-8') for e in embeddings])
 
 
+def _embed_images(input: "EmbedImageInput", images: List[bytes]) -> List[bytes]:
+    embedder = _load_embedder(input.provider, input.model, input.corpus)
+    return embedder.embed_images(images)
+
+
 @app.post("/v2/embed/images")
 async def forward_embed_images(input: EmbedImageInput) -> EmbedImageOutput:
     try:
-        embedder = Embedder.from_properties(
-            {
-                "embeddings_provider": input.provider,
-                "embeddings_model": input.model,
-                "embeddings_pretrained": input.corpus,
-            },
-            descriptor_set=None
-        )
         images = input.get_images()
         assert all(isinstance(i, bytes)
                    for i in images), "All images must be bytes"
-        embeddings = embedder.embed_images(images)
+        # Loading the model and inference block, so keep them off the event loop
+        embeddings = await asyncio.to_thread(_embed_images, input, images)
         return EmbedImageOutput.from_embeddings(embeddings)
     except Exception as e:
         error_msg = f"Error in image embedding request: {str(e)}\nProvider: {input.provider}, Model: {input.model}, Corpus: {input.corpus}\nNumber of images: {len(input.images)}\nTraceback:\n{traceback.format_exc()}"
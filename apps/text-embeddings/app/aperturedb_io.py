@@ -1,18 +1,23 @@
 from schema import Segment, Embedding
-from typing import Iterator, Optional, Tuple
+from typing import Iterator, List, Optional, Tuple
 from uuid import uuid4
-import math
 import json
 from datetime import datetime, timezone
 from aperturedb.CommonLibrary import create_connector, execute_query
 import logging
-from batcher import SymbolicBatcher
+from batcher import SymbolicBatcher, CommandTemplate
+from prefetch import prefetch
+from incremental import DescriptorVersion, text_hash
+from chunked_delete import ChunkedDeleter
+from status_tools import StatusUpdater
 
 logger = logging.getLogger(__name__)
 
 INPUT_SPEC_CLASS = "SegmentationSpec"
 SPEC_CLASS = "EmbeddingsSpec"
 RUN_CLASS = "EmbeddingsRun"
+# Most segments to read in one page, however small they are
+MAX_PAGE_SEGMENTS = 10000
 
 
 class AperturedbIO:
@@ -27,7 +32,12 @@ class AperturedbIO:
                  descriptorset_name: str,
                  engine: str,
                  embedder: "BatchEmbedder",
-                 batch_size: int = 100):
+                 batch_size: int = 100,
+                 pipeline_depth: int = 0,
+                 max_blob_bytes: int = 0,
+                 max_json_bytes: int = 0,
+                 read_ahead_pages: int = 0,
+                 page_max_bytes: int = 0):
         self.input_spec_id = input_spec_id
         self.spec_id = spec_id
         self.run_id = run_id
@@ -36,11 +46,20 @@ class AperturedbIO:
         self.embedder = embedder
         self.batch_size = batch_size
         self.db = create_connector()
+        self.batcher_db = create_connector() if pipeline_depth > 0 else self.db
+        self.read_ahead_pages = read_ahead_pages
+        self.reader_db = create_connector() if read_ahead_pages > 0 else self.db
+        self.page_max_bytes = page_max_bytes
         self.start_time = datetime.now(timezone.utc)
+        # The epilog is the same for every batch, so it is compiled once
+        self._epilog = [CommandTemplate(c) for c in self._batcher_epilog()]
         self.batcher = SymbolicBatcher(
-            execute_query=self.execute_query,
+            execute_query=self._execute_batch,
             batch_size=batch_size,
-            prolog=self._batcher_prolog)
+            epilog=lambda: self._epilog,
+            pipeline_depth=pipeline_depth,
+            max_blob_bytes=max_blob_bytes,
+            max_json_bytes=max_json_bytes)
         self.n_embeddings = 0
 
     def execute_query(self,
@@ -64,6 +83,43 @@ class AperturedbIO:
 
         return results, result_blobs
 
+    def _execute_batch(self,
+                       query: Iterator[dict],
+                       blobs: Optional[Iterator[bytes]] = [],
+                       ) -> Tuple[list[dict], list[bytes]]:
+        """Execute a query for the batcher.
+
+        This uses its own connection, because a pipelined batcher runs queries in a background thread.
+        """
+        status, results, result_blobs = execute_query(
+            client=self.batcher_db,
+            query=query,
+            blobs=blobs, strict_response_validation=True, success_statuses=[0]
+        )
+        if not self.batcher_db.last_query_ok():
+            raise ValueError(
+                f"Query failed with status {status}: {json.dumps(results, indent=2)}")
+
+        return results, result_blobs
+
+    def _execute_read(self,
+                      query: Iterator[dict],
+                      ) -> Tuple[list[dict], list[bytes]]:
+        """Execute a query for the segment reader.
+
+        This uses its own connection, because the reader runs queries in a background thread.
+        """
+        status, results, result_blobs = execute_query(
+            client=self.reader_db,
+            query=query,
+            strict_response_validation=True, success_statuses=[0]
+        )
+        if not self.reader_db.last_query_ok():
+            raise ValueError(
+                f"Query failed with status {status}: {json.dumps(results, indent=2)}")
+
+        return results, result_blobs
+
     def __enter__(self):
         return self
 
@@ -71,11 +127,43 @@ class AperturedbIO:
         """Flush any remaining descriptors and update job document"""
         if exc_type is not None:
             logger.error(f"Error during processing: {exc_value}")
-        self.batcher.flush()
+        self.batcher.close()
         self.create_run()
 
-    def _batcher_prolog(self) -> list[dict]:
-        """Prolog function to create a new batch"""
+    def _connect_to_spec(self, spec, pending, limit: int) -> List[dict]:
+        """Commands that connect up to `limit` of this run's descriptors,
+        that are not yet connected, to the spec in `spec`"""
+        return [
+            {
+                "FindDescriptor": {
+                    "set": self.descriptorset_name,
+                    "constraints": {
+                        "run_id": ["==", self.run_id],
+                        "spec_pending": ["==", True],
+                    },
+                    "results": {"limit": limit},
+                    "_ref": pending,
+                }
+            },
+            {
+                "AddConnection": {
+                    "src": spec,
+                    "dst": pending,
+                    "class": "embeddingsSpecHasDescriptor",
+                }
+            },
+            {
+                "UpdateDescriptor": {
+                    "ref": pending,
+                    "remove_props": ["spec_pending"],
+                }
+            },
+        ]
+
+    def _batcher_epilog(self) -> List[dict]:
+        """Connect the descriptors of each batch to the spec in the same
+        transaction, a bounded number at a time, rather than one
+        command per descriptor"""
         return [
             {
                 "FindEntity": {
@@ -86,6 +174,7 @@ class AperturedbIO:
                     "_ref": "SPEC",
                 }
             },
+            *self._connect_to_spec("SPEC", "PENDING", self.batch_size),
         ]
 
     def _filter_null_properties(self, obj: dict) -> dict:
@@ -195,6 +284,13 @@ class AperturedbIO:
                         "property_key": "run_id",
                     }
                 },
+                {
+                    "CreateIndex": {
+                        "index_type": "entity",
+                        "class": "_Descriptor",
+                        "property_key": "uniqueid",
+                    }
+                },
             ],
             success_statuses=[0, 2],  # 0 = success, 2 = already exists
         )
@@ -251,63 +347,125 @@ class AperturedbIO:
             },
         ])
 
-    def get_segments(self) -> Iterator[Segment]:
-        """Retrieve text segments from ApertureDB"""
-        query = [
-            {
-                "FindEntity": {
-                    "with_class": INPUT_SPEC_CLASS,
-                    "constraints": {
-                        "id": ["==", self.input_spec_id],
+        # Descriptors that a batch's epilog did not get to, if any
+        while True:
+            results, _ = self.execute_query([
+                {
+                    "FindEntity": {
+                        "with_class": SPEC_CLASS,
+                        "constraints": {
+                            "id": ["==", self.spec_id],
+                        },
+                        "_ref": 1,
                     },
-                    "_ref": 1,
-                }
-            },
+                },
+                *self._connect_to_spec(1, 2, MAX_PAGE_SEGMENTS),
+            ])
+            if results[-1]["UpdateDescriptor"].get("count", 0) < MAX_PAGE_SEGMENTS:
+                break
+
+    def get_segments(self) -> Iterator[Segment]:
+        """Retrieve text segments from ApertureDB.
+
+        Pages are read on a background thread, up to `read_ahead_pages`
+        ahead, so that the database and the embedder work at once.
+        """
+        for page in prefetch(self._get_segment_pages(), self.read_ahead_pages):
+            yield from page
+
+    def _get_segment_pages(self) -> Iterator[List[Segment]]:
+        """Retrieve pages of text segments, in order of id.
+
+        Each page carries on from the id at the end of the last page,
+        rather than counting from the start. The size of a page is set
+        from the size of the last one, to be about `page_max_bytes`.
+        """
+        find_spec = {
+            "FindEntity": {
+                "with_class": INPUT_SPEC_CLASS,
+                "constraints": {
+                    "id": ["==", self.input_spec_id],
+                },
+                "_ref": 1,
+            }
+        }
+        is_in_spec = {
+            "ref": 1,
+            "connection_class": "segmentationSpecHasSegment",
+            "direction": "out",
+        }
+
+        results, _ = self._execute_read([
+            find_spec,
             {
                 "FindEntity": {
                     "with_class": "Segment",
-                    "is_connected_to": {
-                        "ref": 1,
-                        "connection_class": "segmentationSpecHasSegment",
-                        "direction": "out",
-                    },
-                    "results": {
-                        "list": ["id", "url", "text", "title"],
-                    },
-                    "batch": {},
+                    "is_connected_to": is_in_spec,
+                    "results": {"count": True},
                 }
             },
-        ]
-
-        results, _ = self.execute_query(query)
-        n_results = results[1]["FindEntity"]["batch"]["total_elements"]
+        ])
+        n_results = results[1]["FindEntity"]["count"]
         assert n_results > 0, f"No text segments found for input {self.input_spec_id}"
-        query[1]["FindEntity"]["batch"]["batch_size"] = self.batch_size
-        n_batches = int(math.ceil(n_results / self.batch_size))
+        logger.info(f"Found {n_results} segments in {INPUT_SPEC_CLASS} {self.input_spec_id}")
 
-        for batch_id in range(n_batches):
-            query[1]["FindEntity"]["batch"]["batch_id"] = batch_id
-            results, _ = self.execute_query(query)
-            entities = results[1]["FindEntity"]["entities"]
+        page_size = self.batch_size
+        last_id = None
+        while True:
+            find_segments = {
+                "with_class": "Segment",
+                "is_connected_to": is_in_spec,
+                "results": {
+                    "list": ["_uniqueid", "id", "url", "text", "title", "text_sha256"],
+                    "sort": {"key": "id", "order": "ascending"},
+                    "limit": page_size,
+                },
+            }
+            if last_id is not None:
+                find_segments["constraints"] = {"id": [">", last_id]}
+            results, _ = self._execute_read([find_spec, {"FindEntity": find_segments}])
+            entities = results[1]["FindEntity"].get("entities", [])
+            if not entities:
+                return
+            last_id = entities[-1]["id"]
 
-            for result in entities:
-                yield Segment(
+            yield [
+                Segment(
                     id=result["id"],
                     url=result["url"],
                     text=result["text"],
                     title=result.get("title", None),
+                    uniqueid=result["_uniqueid"],
+                    text_sha256=result.get("text_sha256"),
                 )
+                for result in entities
+            ]
+
+            if len(entities) < page_size:
+                return
+            page_bytes = sum(len(e["text"]) + len(e["url"]) + len(e.get("title") or "")
+                             for e in entities)
+            if self.page_max_bytes and page_bytes:
+                page_size = int(self.page_max_bytes * len(entities) / page_bytes)
+                page_size = max(1, min(MAX_PAGE_SEGMENTS, page_size))
 
     def create_embedding(self, embedding: Embedding) -> None:
-        """Create a Descriptor in ApertureDB, linked to the EmbeddingsSpec and Segment"""
+        """Create a Descriptor in ApertureDB, linked to the Segment.
+
+        The Descriptor is linked to the EmbeddingsSpec by the epilog of
+        its batch, with the others in the batch.
+        """
         self.n_embeddings += 1
+        if embedding.segment_uniqueid:
+            # Much cheaper than a search on id
+            segment = {"_uniqueid": ["==", embedding.segment_uniqueid]}
+        else:
+            segment = {"id": ["==", embedding.segment_id]}
         self.batcher.add([
             {
                 "FindEntity": {
                     "with_class": "Segment",
-                    "constraints": {
-                        "id": ["==", embedding.segment_id],
-                    },
+                    "constraints": segment,
                     "_ref": "SEGMENT",
                 }
             },
@@ -323,107 +481,125 @@ class AperturedbIO:
                         "url": embedding.url,
                         "lc_url": embedding.url,  # LangChain supported field
                         "title": embedding.title,
+                        "text_sha256": embedding.text_sha256 or text_hash(embedding.text),
+                        "model_fingerprint": self.embedder.fingerprint_hash(),
+                        # Until the batch's epilog connects it to the spec
+                        "spec_pending": True,
                     }),
                     "connect": {
                         "ref": "SEGMENT",
                         "class": "segmentHasDescriptor",
                         "direction": "in",
                     },
-                    "_ref": "TEMP",
                 }
             },
-            {
-                "AddConnection": {
-                    "src": "SPEC",
-                    "dst": "TEMP",
-                    "class": "embeddingsSpecHasDescriptor",
-                }
-            }
         ], [embedding.vector.tobytes()])
 
-    def delete_spec(self, spec_id) -> None:
-        """Delete an EmbeddingsSpec document and all its dependent artefacts"""
-        logger.info(f"Deleting {SPEC_CLASS} {spec_id}")
-        response, _ = self.execute_query([
+    def get_descriptor_versions(self) -> List[DescriptorVersion]:
+        """What each of this spec's descriptors was embedded from.
+
+        Pages are read in order of uniqueid, each carrying on from the
+        uniqueid at the end of the last page, rather than counting from
+        the start.
+        """
+        versions = []
+        last_uniqueid = None
+        while True:
+            constraints = {"spec_id": ["==", self.spec_id]}
+            if last_uniqueid is not None:
+                constraints["uniqueid"] = [">", last_uniqueid]
+            results, _ = self.execute_query([
+                {
+                    "FindDescriptor": {
+                        "set": self.descriptorset_name,
+                        "constraints": constraints,
+                        "results": {
+                            "list": ["uniqueid", "segment_id", "text_sha256", "model_fingerprint"],
+                            "sort": {"key": "uniqueid", "order": "ascending"},
+                            "limit": MAX_PAGE_SEGMENTS,
+                        },
+                    }
+                },
+            ])
+            entities = results[0]["FindDescriptor"].get("entities") or []
+            for e in entities:
+                versions.append(DescriptorVersion(
+                    uniqueid=e["uniqueid"],
+                    segment_id=e["segment_id"],
+                    text_sha256=e.get("text_sha256"),
+                    model_fingerprint=e.get("model_fingerprint")))
+            if len(entities) < MAX_PAGE_SEGMENTS:
+                break
+            last_uniqueid = entities[-1]["uniqueid"]
+        logger.info(f"Found {len(versions)} descriptors embedded for {self.spec_id}")
+        return versions
+
+    def move_descriptor(self, descriptor: DescriptorVersion, segment: Segment) -> None:
+        """Connect an existing Descriptor to a new Segment with the same text,
+        in place of its own, which has gone"""
+        self.batcher.add([
             {
-                "FindEntity": {
-                    "with_class": SPEC_CLASS,
+                "UpdateDescriptor": {
+                    "set": self.descriptorset_name,
                     "constraints": {
-                        "id": ["==", spec_id],
-                    },
-                    "_ref": 1,
-                }
-            },
-            {
-                "FindDescriptorSet": {
-                    "is_connected_to": {
-                        "ref": 1,
-                        "connection_class": "embeddingsSpecHasDescriptorSet",
+                        "uniqueid": ["==", descriptor.uniqueid],
                     },
-                    "counts": True,
-                    "uniqueids": True,
-                    "_ref": 2,
-                },
-            },
-            {
-                "DeleteEntity": {
-                    "ref": 1,
+                    "properties": self._filter_null_properties({
+                        "segment_id": segment.id,
+                        "url": segment.url,
+                        "lc_url": segment.url,
+                        "title": segment.title,
+                    }),
                 }
             },
             {
                 "FindEntity": {
-                    "with_class": RUN_CLASS,
+                    "with_class": "Segment",
                     "constraints": {
-                        "spec_id": ["==", spec_id],
+                        "_uniqueid": ["==", segment.uniqueid],
+                    } if segment.uniqueid else {
+                        "id": ["==", segment.id],
                     },
-                    "_ref": 3,
-                }
-            },
-            {
-                "DeleteEntity": {
-                    "ref": 3,
+                    "_ref": "SEGMENT",
                 }
             },
             {
                 "FindDescriptor": {
+                    "set": self.descriptorset_name,
                     "constraints": {
-                        "spec_id": ["==", spec_id],
+                        "uniqueid": ["==", descriptor.uniqueid],
                     },
-                    "_ref": 4,
+                    "_ref": "DESCRIPTOR",
                 }
             },
             {
-                "DeleteDescriptor": {
-                    "ref": 4,
+                "AddConnection": {
+                    "src": "SEGMENT",
+                    "dst": "DESCRIPTOR",
+                    "class": "segmentHasDescriptor",
                 }
             },
         ])
 
-        # It is possible for multiple EmbeddingsSpec documents to share the same DesceriptorSet
-        # If the descriptor set is empty, delete it
-        descriptorset_count = response[1]["FindDescriptorSet"].get("count", 0)
-        deleted_count = response[6]["DeleteDescriptor"]["count"]
-        if descriptorset_count > 0 and descriptorset_count == deleted_count:
-            descriptorset_id = response[1]["FindDescriptorSet"]["entities"][0]["id"]
-            logger.info("Deleting empty descriptor set")
-            self.execute_query([
-                {
-                    "FindDescriptorSet": {
-                        "constraints": {
-                            "_uniqueid": ["==", descriptorset_id],
-                        },
-                        "_ref": 1,
-                    }
-                },
-                {
-                    "DeleteEntity": {
-                        "ref": 1,
-                    }
-                }
-            ])
+    def delete_descriptors(self, uniqueids: List[str]) -> None:
+        """Delete this spec's descriptors with these uniqueids, in batches"""
+        logger.info(f"Deleting {len(uniqueids)} descriptors")
+        deleter = ChunkedDeleter(self.execute_query, batch_size=MAX_PAGE_SEGMENTS)
+        # Each step names no more descriptors than one batch deletes
+        for start in range(0, len(uniqueids), MAX_PAGE_SEGMENTS):
+            deleter.add("Descriptor", {
+                "spec_id": ["==", self.spec_id],
+                "uniqueid": ["in", uniqueids[start:start + MAX_PAGE_SEGMENTS]],
+            }, set=self.descriptorset_name)
+        deleter.run()
+
+    def delete_spec(self, spec_id) -> None:
+        """Delete an EmbeddingsSpec document and all its dependent artefacts"""
+        logger.info(f"Deleting {SPEC_CLASS} {spec_id}")
+        self._delete_specs([spec_id])
 
     def delete_all(self) -> None:
-        """Delete all SegmentationSpec documents and all their dependent artefacts
+        """Delete all EmbeddingsSpec documents and all their dependent artefacts
         """
         logger.info(f"Deleting all {SPEC_CLASS} documents")
         response, _ = self.execute_query([
@@ -441,10 +617,82 @@ class AperturedbIO:
             logger.info(f"No {SPEC_CLASS} documents found")
             return
 
-        for entity in response[0]["FindEntity"]["entities"]:
-            spec_id = entity["id"]
-            logger.info(f"Deleting {SPEC_CLASS} {spec_id}")
-            self.delete_spec(spec_id)
+        spec_ids = [entity["id"] for entity in response[0]["FindEntity"]["entities"]]
+        logger.info(f"Deleting {SPEC_CLASS} {', '.join(spec_ids)}")
+        self._delete_specs(spec_ids)
+
+    def _descriptorset_names(self, spec_ids: List[str]) -> List[str]:
+        """The names of the descriptor sets that the specs write to"""
+        response, _ = self.execute_query([
+            {
+                "FindEntity": {
+                    "with_class": SPEC_CLASS,
+                    "constraints": {
+                        "id": ["in", spec_ids],
+                    },
+                    "_ref": 1,
+                }
+            },
+            {
+                "FindDescriptorSet": {
+                    "is_connected_to": {
+                        "ref": 1,
+                        "connection_class": "embeddingsSpecHasDescriptorSet",
+                    },
+                    "results": {
+                        "list": ["_name"],
+                    },
+                }
+            },
+        ])
+        return [e["_name"] for e in response[1]["FindDescriptorSet"].get("entities") or []]
+
+    def _descriptorset_spec_ids(self, name: str) -> List[str]:
+        """The ids of all the specs that write to a descriptor set"""
+        response, _ = self.execute_query([
+            {
+                "FindDescriptorSet": {
+                    "with_name": name,
+                    "_ref": 1,
+                }
+            },
+            {
+                "FindEntity": {
+                    "with_class": SPEC_CLASS,
+                    "is_connected_to": {
+                        "ref": 1,
+                        "connection_class": "embeddingsSpecHasDescriptorSet",
+                    },
+                    "results": {
+                        "list": ["id"],
+                    },
+                }
+            },
+        ])
+        return [e["id"] for e in response[1]["FindEntity"].get("entities") or []]
+
+    def _delete_specs(self, spec_ids: List[str]) -> None:
+        """Delete the specs in batches, children first, so that a deletion
+        that is interrupted can be finished by running it again"""
+        in_specs = {"spec_id": ["in", spec_ids]}
+        deleter = ChunkedDeleter(self.execute_query, updater=StatusUpdater())
+        for name in self._descriptorset_names(spec_ids):
+            # Several EmbeddingsSpec documents can share a descriptor set.
+            # If no other spec writes to it, even one that has no
+            # descriptors yet, and it holds nothing else, delete it whole,
+            # which is much faster than deleting its descriptors.
+            if set(self._descriptorset_spec_ids(name)) <= set(spec_ids) and \
+                    deleter.count("Descriptor", in_specs, set=name) == \
+                    deleter.count("Descriptor", {}, set=name):
+                deleter.add_descriptor_set(name)
+            else:
+                deleter.add("Descriptor", in_specs, set=name)
+        # Any descriptors left outside the sets, e.g. if a set was renamed.
+        # This also finds those in the sets, so it is left out of progress.
+        deleter.add("Descriptor", in_specs, in_total=False)
+        deleter.add("Entity", in_specs, with_class=RUN_CLASS)
+        deleter.add("Entity", {"id": ["in", spec_ids]}, with_class=SPEC_CLASS)
+        deleter.run()
 
     def does_entity_exist(self, class_, id_) -> bool:
         """Check if an entity exists in ApertureDB"""
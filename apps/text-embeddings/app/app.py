@@ -1,15 +1,65 @@
-from aperturedb_io import AperturedbIO
+from aperturedb_io import AperturedbIO, SPEC_CLASS
+from incremental import ChangeDetector
 from wf_argparse import ArgumentParser
 import logging
 from aperturedb.CommonLibrary import create_connector
 
 from embeddings import Embedder, DEFAULT_MODEL
-from schema import Embedding
+from schema import Embedding, Segment
+from typing import Iterable, Iterator, List
 from uuid import uuid4
 
 logger = logging.getLogger(__name__)
 
 
+def batch_segments(segments: Iterable[Segment],
+                   embedder: Embedder,
+                   max_tokens: int) -> Iterator[List[Segment]]:
+    """Gather segments into batches of about max_tokens tokens, so that
+    there are many short segments to a batch, but few long ones.
+
+    Each batch is embedded with one call to the embedder, which splits it
+    into batches for the model.
+    """
+    batch = []
+    tokens = 0
+    for segment in segments:
+        batch.append(segment)
+        tokens += embedder.estimate_tokens(segment.text)
+        if tokens >= max_tokens:
+            yield batch
+            batch = []
+            tokens = 0
+    if batch:
+        yield batch
+
+
+def embed_segments(io: AperturedbIO,
+                   embedder: Embedder,
+                   segments: Iterable[Segment],
+                   max_tokens: int) -> None:
+    """Embed the segments and write their descriptors"""
+    for batch in batch_segments(segments, embedder, max_tokens):
+        try:
+            logger.debug(f"Embedding {len(batch)} segments")
+            vectors = embedder.embed_texts([segment.text for segment in batch])
+        except Exception as e:
+            logger.exception(
+                f"Error embedding segments {batch[0].id} to {batch[-1].id}")
+            raise
+        for segment, v in zip(batch, vectors):
+            embedding = Embedding(
+                segment_id=segment.id,
+                url=segment.url,
+                text=segment.text,
+                title=segment.title,
+                vector=v,
+                segment_uniqueid=segment.uniqueid,
+                text_sha256=segment.text_sha256,
+            )
+            io.create_embedding(embedding)
+
+
 def run_text_embeddings(args):
     logger.info(f"Starting text embeddings")
     segmentation_spec_id = args.input
@@ -35,6 +85,11 @@ def run_text_embeddings(args):
         descriptorset_name=descriptorset_name,
         engine=engine,
         embedder=embedder,
+        pipeline_depth=args.pipeline_depth,
+        max_blob_bytes=args.batch_max_blob_bytes,
+        max_json_bytes=args.batch_max_json_bytes,
+        read_ahead_pages=args.read_ahead_pages,
+        page_max_bytes=args.page_max_bytes,
     ) as io:
         if args.delete_all:
             io.delete_all()
@@ -47,26 +102,47 @@ def run_text_embeddings(args):
         if args.clean:
             io.delete_spec(spec_id)
             # continue
-        io.ensure_output_does_not_exist()
-        io.create_spec()
-        io.connect_descriptor_set()
-
-        for segment in io.get_segments():
-            try:
-                logger.debug(f"Processing segment {segment.id}")
-                # Embed the segment text
-                v = embedder.embed_text(segment.text)
-                embedding = Embedding(
-                    segment_id=segment.id,
-                    url=segment.url,
-                    text=segment.text,
-                    title=segment.title,
-                    vector=v,
-                )
-                io.create_embedding(embedding)
-            except Exception as e:
-                logger.exception(f"Error processing segment {segment.id}")
-                raise
+        detector = None
+        if args.incremental and io.does_entity_exist(SPEC_CLASS, spec_id):
+            # Only new and changed segments are embedded again
+            detector = ChangeDetector(io.get_descriptor_versions(),
+                                      embedder.fingerprint_hash())
+        else:
+            io.ensure_output_does_not_exist()
+            io.create_spec()
+            io.connect_descriptor_set()
+        io.create_indexes()
+
+        if detector is None:
+            embed_segments(io, embedder, io.get_segments(), args.embed_batch_tokens)
+            return
+
+        # Segments with the same text as a descriptor whose segment may
+        # have gone, to be looked at once all the segments are seen
+        deferred = []
+
+        def changed_segments():
+            n_unchanged = 0
+            for segment in io.get_segments():
+                if detector.unchanged(segment):
+                    n_unchanged += 1
+                elif detector.may_move(segment):
+                    deferred.append(segment)
+                else:
+                    yield segment
+            logger.info(f"{n_unchanged} segments unchanged")
+
+        embed_segments(io, embedder, changed_segments(), args.embed_batch_tokens)
+        unmoved = []
+        for segment in deferred:
+            descriptor = detector.move(segment)
+            if descriptor is None:
+                unmoved.append(segment)
+            else:
+                io.move_descriptor(descriptor, segment)
+        logger.info(f"{len(deferred) - len(unmoved)} descriptors moved to new segments with the same text")
+        embed_segments(io, embedder, unmoved, args.embed_batch_tokens)
+        io.delete_descriptors(detector.stale())
 
     logger.info("Done.")
 
@@ -98,11 +174,46 @@ def get_args():
                      help='The embedding engine to use',
                      default="HNSW")
 
+    obj.add_argument('--pipeline-depth',
+                     type=int,
+                     help='Number of batches written to the database in the background while the next batch is prepared; 0 to write synchronously',
+                     default=1)
+
+    obj.add_argument('--batch-max-blob-bytes',
+                     type=int,
+                     help='Flush a batch when its blobs reach this size; 0 for no limit',
+                     default=64 * 1024 * 1024)
+
+    obj.add_argument('--batch-max-json-bytes',
+                     type=int,
+                     help='Flush a batch when its commands reach this size as JSON; 0 for no limit',
+                     default=16 * 1024 * 1024)
+
+    obj.add_argument('--read-ahead-pages',
+                     type=int,
+                     help='Number of pages of segments read in the background while the last page is embedded; 0 to read synchronously',
+                     default=2)
+
+    obj.add_argument('--page-max-bytes',
+                     type=int,
+                     help='Size of text to read in a page of segments; 0 for pages of 100 segments',
+                     default=4 * 1024 * 1024)
+
+    obj.add_argument('--embed-batch-tokens',
+                     type=int,
+                     help='Number of tokens of segment text to embed at once',
+                     default=32768)
+
     obj.add_argument('--clean',
                      type=bool,
                      help='Delete existing spec before creating a new one',
                      default=False)
 
+    obj.add_argument('--incremental',
+                     type=bool,
+                     help='If the spec exists, only embed segments that are new or have changed since it was last run',
+                     default=False)
+
     obj.add_argument('--delete',
                      type=bool,
                      help='Delete the spec and all its embeddings; don\'t run embedding job',
@@ -0,0 +1,87 @@
+from collections import defaultdict
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Tuple
+import hashlib
+import logging
+
+from schema import Segment
+
+
+logger = logging.getLogger(__name__)
+
+
+def text_hash(text: str) -> str:
+    """The hash of a segment's text, as text-extraction records it"""
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+@dataclass
+class DescriptorVersion:
+    """What was embedded for a segment when the spec was last run"""
+    uniqueid: str
+    segment_id: str
+    text_sha256: Optional[str] = None
+    model_fingerprint: Optional[str] = None
+
+
+class ChangeDetector:
+    """Decides which segments need to be embedded again, and which of the
+    spec's descriptors are no longer wanted.
+
+    A descriptor is kept if its segment still exists, with the same text,
+    and was embedded with the same model. Text-extraction gives new ids
+    to the segments of a document that has changed, so a descriptor
+    whose segment has gone can also be moved to a new segment with the
+    same text, rather than embedding that text again.
+
+    Moves can only be decided once every segment has been seen, as a
+    descriptor's own segment may still turn up.
+    """
+
+    def __init__(self, previous: List[DescriptorVersion], model_fingerprint: str):
+        """
+        Args:
+            previous: The spec's descriptors.
+            model_fingerprint: The fingerprint of the model used for this run.
+        """
+        self.previous = previous
+        self.model_fingerprint = model_fingerprint
+        self.by_segment: Dict[str, List[DescriptorVersion]] = defaultdict(list)
+        self.by_text: Dict[Tuple[str, str], List[DescriptorVersion]] = defaultdict(list)
+        for descriptor in previous:
+            self.by_segment[descriptor.segment_id].append(descriptor)
+            if descriptor.text_sha256 and descriptor.model_fingerprint:
+                self.by_text[(descriptor.text_sha256, descriptor.model_fingerprint)].append(descriptor)
+        self.seen = set()  # segment ids
+        self.kept = set()  # descriptor uniqueids
+
+    def _key(self, segment: Segment) -> Tuple[str, str]:
+        return (segment.text_sha256 or text_hash(segment.text), self.model_fingerprint)
+
+    def unchanged(self, segment: Segment) -> bool:
+        """True if the segment already has a descriptor for its text from this model"""
+        self.seen.add(segment.id)
+        key = self._key(segment)
+        for descriptor in self.by_segment.get(segment.id, []):
+            if (descriptor.text_sha256, descriptor.model_fingerprint) == key:
+                self.kept.add(descriptor.uniqueid)
+                return True
+        return False
+
+    def may_move(self, segment: Segment) -> bool:
+        """True if there is a descriptor for the same text from this model,
+        which may be moved to the segment if its own has gone"""
+        return self._key(segment) in self.by_text
+
+    def move(self, segment: Segment) -> Optional[DescriptorVersion]:
+        """A descriptor for the same text, whose segment has gone, to move
+        to this segment, if there is one. Call once all segments are seen."""
+        for descriptor in self.by_text.get(self._key(segment), []):
+            if descriptor.uniqueid not in self.kept and descriptor.segment_id not in self.seen:
+                self.kept.add(descriptor.uniqueid)
+                return descriptor
+        return None
+
+    def stale(self) -> List[str]:
+        """The uniqueids of the descriptors that are neither kept nor moved"""
+        return [d.uniqueid for d in self.previous if d.uniqueid not in self.kept]
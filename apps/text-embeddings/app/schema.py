@@ -9,6 +9,8 @@ class Segment:
     url: str
     text: str
     title: Optional[str] = None
+    uniqueid: Optional[str] = None  # ApertureDB _uniqueid, for lookups
+    text_sha256: Optional[str] = None
 
 
 @dataclass
@@ -18,3 +20,5 @@ class Embedding:
     text: str
     vector: np.ndarray
     title: Optional[str] = None
+    segment_uniqueid: Optional[str] = None
+    text_sha256: Optional[str] = None
@@ -1,18 +1,26 @@
 from text_extraction.schema import CrawlDocument, Segment, ImageBlock, FullTextBlock
-from typing import Iterator, Optional, Tuple
+from collections import OrderedDict
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Tuple
 from uuid import uuid4
-import math
+import queue
 import json
 from datetime import datetime, timezone
 from aperturedb.CommonLibrary import create_connector, execute_query
 import logging
-from batcher import SymbolicBatcher
+from batcher import SymbolicBatcher, CommandTemplate
+from chunked_delete import ChunkedDeleter
+from status_tools import StatusUpdater
+from incremental import DocumentVersion, content_hash
 
 logger = logging.getLogger(__name__)
 
 INPUT_SPEC_CLASS = "CrawlSpec"
 SPEC_CLASS = "SegmentationSpec"
 RUN_CLASS = "SegmentationRun"
+# Most document versions to read in one page
+MAX_PAGE_VERSIONS = 10000
+# Most image URLs whose Images are remembered, least recently used first out
+MAX_CACHED_IMAGE_URLS = 100000
 
 
 class AperturedbIO:
@@ -20,21 +28,47 @@ class AperturedbIO:
     This class is specific to the task and insulates other components from
     the details of the database."""
 
-    def __init__(self, crawl_spec_id: str, spec_id: str, run_id: str, batch_size: int = 100):
+    def __init__(self, crawl_spec_id: str, spec_id: str, run_id: str, batch_size: int = 100,
+                 pipeline_depth: int = 0,
+                 max_blob_bytes: int = 0,
+                 max_json_bytes: int = 0,
+                 page_max_blob_bytes: int = 0):
         self.crawl_spec_id = crawl_spec_id
         self.spec_id = spec_id
         self.run_id = run_id
         self.batch_size = batch_size
+        self.page_max_blob_bytes = page_max_blob_bytes
+        # The uniqueids of the Images with each URL, as they are looked up
+        self.image_ids: "OrderedDict[str, List[str]]" = OrderedDict()
         self.db = create_connector()
+        self.batcher_db = create_connector() if pipeline_depth > 0 else self.db
         self.start_time = datetime.now(timezone.utc)
         self.n_segments = 0
         self.n_images = 0
         self.n_full_texts = 0
         self.batcher = SymbolicBatcher(
-            execute_query=self.execute_query,
+            execute_query=self._execute_batch,
             batch_size=batch_size,
-            prolog=self._batcher_prolog)
+            prolog=self._batcher_prolog,
+            pipeline_depth=pipeline_depth,
+            max_blob_bytes=max_blob_bytes,
+            max_json_bytes=max_json_bytes)
         self.current_document = None
+        # The prolog's commands, compiled once per run and once per document
+        self._find_spec = CommandTemplate({
+            "FindEntity": {
+                "with_class": SPEC_CLASS,
+                "constraints": {
+                    "id": ["==", self.spec_id],
+                },
+                "_ref": "SPEC",
+            }
+        })
+        self._find_document = None
+        # URLs of documents whose new results have been written, so that
+        # what earlier runs made from them can be deleted. These are put
+        # by the batcher, which may be on its own thread.
+        self.replaced: queue.SimpleQueue = queue.SimpleQueue()
 
     def execute_query(self,
                       query: Iterator[dict],
@@ -53,6 +87,21 @@ class AperturedbIO:
         )
         return results, result_blobs
 
+    def _execute_batch(self,
+                       query: Iterator[dict],
+                       blobs: Optional[Iterator[bytes]] = [],
+                       ) -> Tuple[list[dict], list[bytes]]:
+        """Execute a query for the batcher.
+
+        This uses its own connection, because a pipelined batcher runs queries in a background thread.
+        """
+        status, results, result_blobs = execute_query(
+            client=self.batcher_db,
+            query=query,
+            blobs=blobs, strict_response_validation=True, success_statuses=[0]
+        )
+        return results, result_blobs
+
     def __enter__(self):
         return self
 
@@ -60,31 +109,14 @@ class AperturedbIO:
         """Flush any remaining segments and update job document"""
         if exc_type is not None:
             logger.error(f"Error during processing: {exc_value}")
-        self.batcher.flush()
+        self.batcher.close()
+        self._delete_replaced()
         self.create_run()
 
     def _batcher_prolog(self) -> list[dict]:
         """Prolog function to create a new batch"""
         assert self.current_document is not None, "No current document set"
-        return [
-            {
-                "FindEntity": {
-                    "with_class": SPEC_CLASS,
-                    "constraints": {
-                        "id": ["==", self.spec_id],
-                    },
-                    "_ref": "SPEC",
-                }
-            },
-            {
-                "FindBlob": {
-                    "constraints": {
-                        "_uniqueid": ["==", self.current_document.document_id],
-                    },
-                    "_ref": "DOC",
-                }
-            },
-        ]
+        return [self._find_spec, self._find_document]
 
     def _filter_null_properties(self, obj: dict) -> dict:
         """Filter out null properties from a dictionary"""
@@ -166,6 +198,28 @@ class AperturedbIO:
                         "property_key": "run_id",
                     }
                 },
+                # For replacing what was made from a document in incremental mode
+                {
+                    "CreateIndex": {
+                        "index_type": "entity",
+                        "class": "Segment",
+                        "property_key": "document_url",
+                    }
+                },
+                {
+                    "CreateIndex": {
+                        "index_type": "entity",
+                        "class": "ImageText",
+                        "property_key": "document_url",
+                    }
+                },
+                {
+                    "CreateIndex": {
+                        "index_type": "entity",
+                        "class": "FullText",
+                        "property_key": "url",
+                    }
+                },
             ],
             success_statuses=[0, 2],  # 0 = success, 2 = already exists
         )
@@ -258,78 +312,106 @@ class AperturedbIO:
             },
         ])
 
-    def get_crawl_documents(self) -> Iterator[CrawlDocument]:
-        """Retrieve crawled documents from ApertureDB that have not been segmented"""
-        query = [
-            {
-                "FindEntity": {
-                    "with_class": INPUT_SPEC_CLASS,
-                    "constraints": {
-                        "id": ["==", self.crawl_spec_id],
-                    },
-                    "_ref": 1,
-                }
-            },
+    def get_crawl_documents(self,
+                            skip: Optional[Callable[[str, Optional[str], Optional[dict]], bool]] = None
+                            ) -> Iterator[CrawlDocument]:
+        """Retrieve crawled documents from ApertureDB that have not been segmented
+
+        Documents are read a page at a time in order of id, each page
+        with its blobs in a single query. The number of documents in a
+        page is adjusted so that their blobs come to about
+        page_max_blob_bytes, up to batch_size documents.
+
+        Documents for which skip(url, etag, last_modified) is true are
+        passed over without fetching their blobs; the blobs of the rest
+        are then fetched with a second query per page.
+        """
+        find_spec = {
+            "FindEntity": {
+                "with_class": INPUT_SPEC_CLASS,
+                "constraints": {
+                    "id": ["==", self.crawl_spec_id],
+                },
+                "_ref": 1,
+            }
+        }
+        is_in_spec = {
+            "ref": 1,
+            "connection_class": "crawlSpecHasDocument",
+            "direction": "out",
+        }
+
+        results, _ = self.execute_query([
+            find_spec,
             {
                 "FindEntity": {
                     "with_class": "CrawlDocument",
-                    "is_connected_to": {
-                        "ref": 1,
-                        "connection_class": "crawlSpecHasDocument",
-                        "direction": "out",
-                    },
-                    "uniqueids": True,
-                    "results": {
-                        "list": ["url", "content_type"],
-                    },
-                    "batch": {},
+                    "is_connected_to": is_in_spec,
+                    "results": {"count": True},
                 }
             },
-        ]
-
-        results, _ = self.execute_query(query)
-        n_results = results[1]["FindEntity"]["batch"]["total_elements"]
-        assert n_results > 0, f"No documents found for crawl {self.crawl_id}"
-        query[1]["FindEntity"]["batch"]["batch_size"] = self.batch_size
-        n_batches = int(math.ceil(n_results / self.batch_size))
-
-        for batch_id in range(n_batches):
-            query[1]["FindEntity"]["batch"]["batch_id"] = batch_id
-            results, _ = self.execute_query(query)
-            entities = results[1]["FindEntity"]["entities"]
-            entity_ids = [e["_uniqueid"] for e in entities]
-
-            # Now fetch blobs (can't do this in the batch query)
-            blob_results, blobs = self.execute_query([
-                {
-                    "FindEntity": {
-                        "with_class": "CrawlDocument",
-                        "constraints": {
-                            "_uniqueid": ["in", entity_ids],
-                        },
-                        "_ref": 1,
-                    }
-                },
-                {
-                    "FindBlob": {
-                        "is_connected_to": {
-                            "ref": 1,
-                            "connection_class": "crawlDocumentHasBlob",
-                            "direction": "out",
-                        },
-                        "uniqueids": True,  # required to make group_by_source work
-                        "blobs": True,
-                        "group_by_source": True,
-                    }
+        ])
+        n_results = results[1]["FindEntity"]["count"]
+        assert n_results > 0, f"No documents found for crawl {self.crawl_spec_id}"
+        logger.info(f"Found {n_results} documents in crawl {self.crawl_spec_id}")
+
+        page_size = self.batch_size
+        last_id = None
+        while True:
+            find_documents = {
+                "with_class": "CrawlDocument",
+                "is_connected_to": is_in_spec,
+                "uniqueids": True,
+                "results": {
+                    "list": ["id", "url", "content_type", "etag", "last_modified"],
+                    "sort": {"key": "id", "order": "ascending"},
+                    "limit": page_size,
                 },
-            ])
+                "_ref": 2,
+            }
+            # Carry on from the last page, rather than counting from the
+            # start, which also lets the blobs be found in the same query
+            if last_id is not None:
+                find_documents["constraints"] = {"id": [">", last_id]}
+            query = [find_spec, {"FindEntity": find_documents}]
+            if skip is None:
+                query.append(self._find_blobs(2))
+            results, blobs = self.execute_query(query)
+            entities = results[1]["FindEntity"].get("entities", [])
+            if not entities:
+                return
+            last_page = len(entities) < page_size
+            last_id = entities[-1]["id"]
+
+            if skip is None:
+                blob_groups = results[2]["FindBlob"]["entities"]
+            else:
+                entities = [e for e in entities
+                            if not skip(e["url"], e.get("etag"), e.get("last_modified"))]
+                if not entities:
+                    if last_page:
+                        return
+                    continue
+                blob_results, blobs = self.execute_query([
+                    {
+                        "FindEntity": {
+                            "with_class": "CrawlDocument",
+                            "constraints": {
+                                "_uniqueid": ["in", [e["_uniqueid"] for e in entities]],
+                            },
+                            "_ref": 1,
+                        }
+                    },
+                    self._find_blobs(1),
+                ])
+                blob_groups = blob_results[1]["FindBlob"]["entities"]
 
             for result in entities:
                 document_id = result["_uniqueid"]
                 url = result["url"]
                 content_type = result["content_type"]
 
-                blob_entities = blob_results[1]["FindBlob"]["entities"][document_id]
+                blob_entities = blob_groups[document_id]
                 assert len(
                     blob_entities) == 1, f"Expected 1 blob for document {document_id}, found {len(blob_entities)}"
                 blob = blobs[blob_entities[0]["_blob_index"]]
@@ -337,23 +419,190 @@ class AperturedbIO:
                     document_id=document_id,
                     url=url,
                     content_type=content_type,
-                    blob=blob
+                    blob=blob,
+                    etag=result.get("etag"),
+                    last_modified=result.get("last_modified"),
                 )
 
-    def set_document(self, crawl_document: CrawlDocument) -> None:
-        """Set the current document for batch processing"""
-        self.current_document = crawl_document
-        if not self.batcher.empty():
-            self.batcher.add([
+            if last_page:
+                return
+            blob_bytes = sum(len(blob) for blob in blobs)
+            if self.page_max_blob_bytes and blob_bytes:
+                page_size = int(self.page_max_blob_bytes * len(entities) / blob_bytes)
+                page_size = max(1, min(self.batch_size, page_size))
+
+    @staticmethod
+    def _find_blobs(ref: int) -> dict:
+        """A command to find the blobs of the crawl documents in ref"""
+        return {
+            "FindBlob": {
+                "is_connected_to": {
+                    "ref": ref,
+                    "connection_class": "crawlDocumentHasBlob",
+                    "direction": "out",
+                },
+                "uniqueids": True,  # required to make group_by_source work
+                "blobs": True,
+                "group_by_source": True,
+            }
+        }
+
+    def get_document_versions(self) -> Dict[str, DocumentVersion]:
+        """The version of each document that this spec was segmented from, by URL,
+        as recorded on its FullText.
+
+        Pages are read in order of the indexed url, each carrying on from
+        the url at the end of the last page, rather than counting from
+        the start.
+        """
+        versions = {}
+        last_url = None
+        while True:
+            constraints = {"spec_id": ["==", self.spec_id]}
+            if last_url is not None:
+                constraints["url"] = [">", last_url]
+            results, _ = self.execute_query([
                 {
-                    "FindBlob": {
-                        "constraints": {
-                            "_uniqueid": ["==", self.current_document.document_id],
+                    "FindEntity": {
+                        "with_class": "FullText",
+                        "constraints": constraints,
+                        "results": {
+                            "list": ["url", "doc_etag", "doc_last_modified", "doc_sha256"],
+                            "sort": {"key": "url", "order": "ascending"},
+                            "limit": MAX_PAGE_VERSIONS,
                         },
-                        "_ref": "DOC",
                     }
                 },
             ])
+            entities = results[0]["FindEntity"].get("entities") or []
+            for e in entities:
+                versions[e["url"]] = DocumentVersion(
+                    etag=e.get("doc_etag"),
+                    last_modified=e.get("doc_last_modified"),
+                    sha256=e.get("doc_sha256"))
+            if len(entities) < MAX_PAGE_VERSIONS:
+                break
+            last_url = entities[-1]["url"]
+        logger.info(f"Found {len(versions)} documents segmented for {self.spec_id}")
+        return versions
+
+    def update_document_version(self, crawl_document: CrawlDocument) -> None:
+        """Record the headers of a document whose content has not changed,
+        so that the next incremental run can tell from them alone"""
+        properties = self._filter_null_properties({
+            "doc_etag": crawl_document.etag,
+            "doc_last_modified": crawl_document.last_modified,
+        })
+        if not properties:
+            return
+        self.execute_query([
+            {
+                "UpdateEntity": {
+                    "with_class": "FullText",
+                    "constraints": {
+                        "spec_id": ["==", self.spec_id],
+                        "url": ["==", crawl_document.url],
+                    },
+                    "properties": properties,
+                }
+            },
+        ])
+
+    def delete_document(self, url: str) -> None:
+        """Delete what earlier runs of this spec made from a document"""
+        logger.info(f"Deleting segments of {url}")
+        earlier = {
+            "spec_id": ["==", self.spec_id],
+            "run_id": ["!=", self.run_id],
+        }
+        self.execute_query([
+            {
+                "DeleteEntity": {
+                    "with_class": "Segment",
+                    "constraints": {
+                        **earlier,
+                        "document_url": ["==", url],
+                    },
+                }
+            },
+            {
+                "DeleteEntity": {
+                    "with_class": "ImageText",
+                    "constraints": {
+                        **earlier,
+                        "document_url": ["==", url],
+                    },
+                }
+            },
+            {
+                "FindEntity": {
+                    "with_class": "FullText",
+                    "constraints": {
+                        **earlier,
+                        "url": ["==", url],
+                    },
+                    "_ref": 1,
+                }
+            },
+            {
+                "FindBlob": {
+                    "is_connected_to": {
+                        "ref": 1,
+                        "connection_class": "fullTextHasBlob",
+                    },
+                    "_ref": 2,
+                }
+            },
+            {
+                "DeleteEntity": {
+                    "ref": 1,
+                }
+            },
+            {
+                "DeleteBlob": {
+                    "ref": 2,
+                }
+            },
+        ])
+
+    def replace_document(self, url: str) -> None:
+        """Delete what earlier runs made from the current document, once
+        what this run made from it has been written.
+
+        Call this after the document's results have been added, so that
+        searches never find the document missing, and a batch that fails
+        leaves the earlier results in place.
+        """
+        if self.batcher.empty():
+            # Its results may be in a batch that is still being written
+            self.batcher.join()
+            self.delete_document(url)
+            return
+        self.batcher.add([], response_handler=lambda results, blobs: self.replaced.put(url))
+
+    def _delete_replaced(self) -> None:
+        """Delete what earlier runs made from the documents that have been replaced"""
+        while True:
+            try:
+                url = self.replaced.get_nowait()
+            except queue.Empty:
+                return
+            self.delete_document(url)
+
+    def set_document(self, crawl_document: CrawlDocument) -> None:
+        """Set the current document for batch processing"""
+        self._delete_replaced()
+        self.current_document = crawl_document
+        self._find_document = CommandTemplate({
+            "FindBlob": {
+                "constraints": {
+                    "_uniqueid": ["==", crawl_document.document_id],
+                },
+                "_ref": "DOC",
+            }
+        })
+        if not self.batcher.empty():
+            self.batcher.add([self._find_document])
 
     def create_segment(self, segment: Segment) -> None:
         """Create a Segment document in ApertureDB, linked to the CrawlDocument and SegmentationSpec"""
@@ -368,10 +617,12 @@ class AperturedbIO:
                         "text": segment.text,
                         "kind": segment.kinds,
                         "url": segment.url(self.current_document.url),
+                        "document_url": self.current_document.url,
                         "spec_id": self.spec_id,
                         "run_id": self.run_id,
                         "n_tokens": segment.total_tokens,
                         "n_characters": len(segment.text),
+                        "text_sha256": content_hash(segment.text.encode("utf-8")),
                         **({"title": segment.title} if segment.title else {}),
                     },
                     "connect": {
@@ -391,10 +642,48 @@ class AperturedbIO:
             }
         ])
 
+    def find_images(self, image_urls: Iterable[str]) -> None:
+        """Look up the Images with any of these URLs that have not been
+        looked up before, with one query. Pages of a site tend to share
+        images, so most are only looked up once in a run."""
+        urls = set(image_urls)
+        new_urls = []
+        for url in urls:
+            if url in self.image_ids:
+                self.image_ids.move_to_end(url)
+            else:
+                new_urls.append(url)
+        if not new_urls:
+            return
+        results, _ = self.execute_query([
+            {
+                "FindImage": {
+                    "constraints": {
+                        "url": ["in", new_urls],
+                    },
+                    "uniqueids": True,
+                    "results": {
+                        "list": ["url"],
+                    },
+                }
+            },
+        ])
+        for url in new_urls:
+            self.image_ids[url] = []
+        for entity in results[0]["FindImage"].get("entities", []):
+            self.image_ids[entity["url"]].append(entity["_uniqueid"])
+        # Forget the least recently used, but not those just asked for
+        while len(self.image_ids) > MAX_CACHED_IMAGE_URLS:
+            if next(iter(self.image_ids)) in urls:
+                break
+            self.image_ids.popitem(last=False)
+
     def create_image_block(self, block: ImageBlock) -> None:
         """Create a ImageBlock document in ApertureDB, linked to the CrawlDocument, SegmentationSpec, and possibly Image"""
         assert self.current_document is not None, "No current document set"
         self.n_images += 1
+        self.find_images([block.image_url])
+        image_ids = self.image_ids[block.image_url]
         self.batcher.add([
             {
                 "AddEntity": {
@@ -406,6 +695,7 @@ class AperturedbIO:
                         "text": block.best_text,
                         "anchor": block.anchor,
                         "text_url": block.url(self.current_document.url),
+                        "document_url": self.current_document.url,
                         "spec_id": self.spec_id,
                         "run_id": self.run_id,
                         **({"title": block.title} if block.title else {}),
@@ -425,10 +715,11 @@ class AperturedbIO:
                     "class": "segmentationSpecHasImageText",
                 }
             },
+        ] + ([
             {
                 "FindImage": {
                     "constraints": {
-                        "url": ["==", block.image_url],
+                        "_uniqueid": ["in", image_ids],
                     },
                     "_ref": "IMAGE",
                 }
@@ -440,7 +731,7 @@ class AperturedbIO:
                     "class": "imageHasImageText",
                 }
             }
-        ])
+        ] if image_ids else []))
 
     def create_full_text_block(self, block: FullTextBlock) -> None:
         """Create a FullTextBlock document in ApertureDB, linked to the CrawlDocument and SegmentationSpec"""
@@ -450,12 +741,16 @@ class AperturedbIO:
             {
                 "AddEntity": {
                     "class": "FullText",
-                    "properties": {
+                    "properties": self._filter_null_properties({
                         "url": self.current_document.url,
                         "spec_id": self.spec_id,
                         "run_id": self.run_id,
-                        **({"title": block.title} if block.title else {}),
-                    },
+                        "title": block.title or None,
+                        # The version of the document, for incremental runs
+                        "doc_etag": self.current_document.etag,
+                        "doc_last_modified": self.current_document.last_modified,
+                        "doc_sha256": content_hash(self.current_document.blob),
+                    }),
                     "connect": {
                         "ref": "DOC",
                         "class": "documentHasFullText",
@@ -488,93 +783,7 @@ class AperturedbIO:
     def delete_spec(self, spec_id) -> None:
         """Delete a SegmentationSpec document and all its dependent artefacts"""
         logger.info(f"Deleting {SPEC_CLASS} {spec_id}")
-        self.execute_query([
-            {
-                "FindEntity": {
-                    "with_class": SPEC_CLASS,
-                    "constraints": {
-                        "id": ["==", spec_id],
-                    },
-                    "_ref": 1,
-                }
-            },
-            {
-                "DeleteEntity": {
-                    "ref": 1,
-                }
-            },
-            {
-                "FindEntity": {
-                    "with_class": RUN_CLASS,
-                    "constraints": {
-                        "spec_id": ["==", spec_id],
-                    },
-                    "_ref": 2,
-                }
-            },
-            {
-                "DeleteEntity": {
-                    "ref": 2,
-                }
-            },
-            {
-                "FindEntity": {
-                    "with_class": "Segment",
-                    "constraints": {
-                        "spec_id": ["==", spec_id],
-                    },
-                    "_ref": 3,
-                }
-            },
-            {
-                "DeleteEntity": {
-                    "ref": 3,
-                }
-            },
-            {
-                "FindEntity": {
-                    "with_class": "ImageText",
-                    "constraints": {
-                        "spec_id": ["==", spec_id],
-                    },
-                    "_ref": 4,
-                }
-            },
-            {
-                "DeleteEntity": {
-                    "ref": 4,
-                }
-            },
-            {
-                "FindEntity": {
-                    "with_class": "FullText",
-                    "constraints": {
-                        "spec_id": ["==", spec_id],
-                    },
-                    "_ref": 5,
-                }
-            },
-            {
-                "FindBlob": {
-                    "is_connected_to": {
-                        "ref": 5,
-                        "connection_class": "fullTextHasBlob",
-                    },
-                    "_ref": 6,
-                }
-            },
-            {
-                "DeleteEntity": {
-                    "ref": 5,
-                }
-            },
-            {
-                "DeleteBlob": {
-                    "ref": 6,
-                }
-            }
-
-        ])
+        self._delete_specs([spec_id])
 
     def delete_all(self) -> None:
         """Delete all SegmentationSpec documents and all their dependent artefacts
@@ -595,10 +804,22 @@ class AperturedbIO:
             logger.info(f"No {SPEC_CLASS} documents found")
             return
 
-        for entity in response[0]["FindEntity"]["entities"]:
-            spec_id = entity["id"]
-            logger.info(f"Deleting {SPEC_CLASS} {spec_id}")
-            self.delete_spec(spec_id)
+        spec_ids = [entity["id"] for entity in response[0]["FindEntity"]["entities"]]
+        logger.info(f"Deleting {SPEC_CLASS} {', '.join(spec_ids)}")
+        self._delete_specs(spec_ids)
+
+    def _delete_specs(self, spec_ids: List[str]) -> None:
+        """Delete the specs in batches, children first, so that a deletion
+        that is interrupted can be finished by running it again"""
+        in_specs = {"spec_id": ["in", spec_ids]}
+        deleter = ChunkedDeleter(self.execute_query, updater=StatusUpdater())
+        deleter.add("Entity", in_specs, with_class="Segment")
+        deleter.add("Entity", in_specs, with_class="ImageText")
+        deleter.add("Entity", in_specs, with_class="FullText",
+                    blob_connection="fullTextHasBlob")
+        deleter.add("Entity", in_specs, with_class=RUN_CLASS)
+        deleter.add("Entity", {"id": ["in", spec_ids]}, with_class=SPEC_CLASS)
+        deleter.run()
 
     def does_entity_exist(self, class_, id_) -> bool:
         """Check if an entity exists in ApertureDB"""
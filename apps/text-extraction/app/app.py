@@ -1,27 +1,47 @@
-from aperturedb_io import AperturedbIO
+from aperturedb_io import AperturedbIO, SPEC_CLASS
 from wf_argparse import ArgumentParser
 import logging
 from uuid import uuid4
 
-from text_extraction.text_extractor import TextExtractor
-from text_extraction.segmentation import TextSegmenter
-from text_extraction.schema import TextBlock, ImageBlock, FullTextBlock
+from extraction import DocumentProcessor
+from incremental import ChangeDetector
+from text_extraction.text_extractor import HTML_BACKENDS, PDF_ENGINES
+from text_extraction.schema import ImageBlock, FullTextBlock, Segment
 
 
 logger = logging.getLogger(__name__)
 
 
+def changed_documents(io: AperturedbIO, detector: ChangeDetector, documents):
+    """Pass over the documents whose content is unchanged, recording their
+    new headers"""
+    n_unchanged = 0
+    for doc in documents:
+        if detector.unchanged_by_content(doc):
+            n_unchanged += 1
+            io.update_document_version(doc)
+            continue
+        yield doc
+    logger.info(f"{n_unchanged} fetched documents were unchanged")
+
+
 def run_extraction_and_segmentation(args):
     crawl_spec_id = args.input
     logger.info(f"Starting text extraction for crawl: {crawl_spec_id}")
 
-    css_selector = args.css_selector
-    extractor = TextExtractor(css_selector=css_selector, emit_full_text=True)
-    segmenter = TextSegmenter()
+    extractor_options = dict(css_selector=args.css_selector, emit_full_text=True,
+                             html_backend=args.html_backend,
+                             pdf_engine=args.pdf_engine,
+                             pdf_workers=args.pdf_workers,
+                             pdf_parallel_min_pages=args.pdf_parallel_min_pages)
 
     spec_id = args.output
     run_id = str(uuid4())
-    with AperturedbIO(crawl_spec_id, spec_id, run_id) as io:
+    with AperturedbIO(crawl_spec_id, spec_id, run_id,
+                      pipeline_depth=args.pipeline_depth,
+                      max_blob_bytes=args.batch_max_blob_bytes,
+                      max_json_bytes=args.batch_max_json_bytes,
+                      page_max_blob_bytes=args.page_max_blob_bytes) as io:
         if args.delete_all:
             io.delete_all()
             return
@@ -36,30 +56,48 @@ def run_extraction_and_segmentation(args):
             io.delete_spec(spec_id)
             # continue
 
-        # TODO: Support incremental mode
-        io.ensure_output_does_not_exist()
-
-        io.create_spec()
-
-        for doc in io.get_crawl_documents():
-            logger.info(f"Processing {doc.url}")
-            io.set_document(doc)
-            try:
-                text_blocks = []
-                for block in extractor.extract_blocks(doc.blob, doc.content_type):
-                    if isinstance(block, TextBlock):
-                        text_blocks.append(block)  # defer for segmentation
-                    elif isinstance(block, ImageBlock):
-                        io.create_image_block(block)
-                    elif isinstance(block, FullTextBlock):
-                        io.create_full_text_block(block)
-
-                # Segment text blocks
-                for segment in segmenter.segment(text_blocks):
-                    io.create_segment(segment)
-
-            except Exception as e:
-                logger.exception(f"Failed to process document {doc.url}: {e}")
+        detector = None
+        if args.incremental and io.does_entity_exist(SPEC_CLASS, spec_id):
+            # Only new and changed documents are segmented again
+            detector = ChangeDetector(io.get_document_versions())
+        else:
+            io.ensure_output_does_not_exist()
+            io.create_spec()
+        io.create_indexes()
+
+        if detector is not None:
+            documents = changed_documents(
+                io, detector, io.get_crawl_documents(skip=detector.unchanged_by_headers))
+        else:
+            documents = io.get_crawl_documents()
+
+        # Documents are extracted and segmented in worker processes, if
+        # any, and written from this process in the order they were found
+        with DocumentProcessor(extractor_options,
+                               workers=args.workers,
+                               log_level=args.log_level) as processor:
+            for doc, results in processor.process(documents):
+                if isinstance(results, Exception):
+                    logger.error(f"Failed to process document {doc.url}: {results}",
+                                 exc_info=results)
+                    continue
+                logger.info(f"Processed {doc.url}")
+                io.set_document(doc)
+                io.find_images(r.image_url for r in results if isinstance(r, ImageBlock))
+                for result in results:
+                    if isinstance(result, ImageBlock):
+                        io.create_image_block(result)
+                    elif isinstance(result, FullTextBlock):
+                        io.create_full_text_block(result)
+                    elif isinstance(result, Segment):
+                        io.create_segment(result)
+                if detector is not None and detector.is_known(doc.url):
+                    # Replace what an earlier run made from this document
+                    io.replace_document(doc.url)
+
+        if detector is not None:
+            for url in detector.removed():
+                io.delete_document(url)
     logger.info("Done.")
 
 
@@ -96,9 +134,59 @@ def get_args():
                      help='Delete all specs; don\'t run segmentation',
                      default=False)
 
+    obj.add_argument('--incremental',
+                     type=bool,
+                     help='If the spec exists, only segment documents that are new or have changed since it was last run',
+                     default=False)
+
     obj.add_argument('--css-selector',
                      help='CSS selector to use for text extraction, e.g. DIV#main-content')
 
+    obj.add_argument('--html-backend',
+                     help='Parser for HTML documents: bs4 (BeautifulSoup) or lxml, which is faster on large pages',
+                     choices=HTML_BACKENDS,
+                     default='bs4')
+
+    obj.add_argument('--pdf-engine',
+                     help='Text extraction for PDF documents: pdfplumber, or pdfium, which is much faster',
+                     choices=PDF_ENGINES,
+                     default='pdfplumber')
+
+    obj.add_argument('--pdf-workers',
+                     type=int,
+                     help='Number of processes extracting the pages of a PDF in parallel; 0 to extract in the main process. Ignored with --workers',
+                     default=0)
+
+    obj.add_argument('--pdf-parallel-min-pages',
+                     type=int,
+                     help='Extract PDFs with fewer pages than this in the main process',
+                     default=16)
+
+    obj.add_argument('--workers',
+                     type=int,
+                     help='Number of processes extracting and segmenting documents in parallel; 0 to process them in the main process',
+                     default=0)
+
+    obj.add_argument('--pipeline-depth',
+                     type=int,
+                     help='Number of batches written to the database in the background while the next batch is prepared; 0 to write synchronously',
+                     default=1)
+
+    obj.add_argument('--batch-max-blob-bytes',
+                     type=int,
+                     help='Flush a batch when its blobs reach this size; 0 for no limit',
+                     default=64 * 1024 * 1024)
+
+    obj.add_argument('--batch-max-json-bytes',
+                     type=int,
+                     help='Flush a batch when its commands reach this size as JSON; 0 for no limit',
+                     default=16 * 1024 * 1024)
+
+    obj.add_argument('--page-max-blob-bytes',
+                     type=int,
+                     help='Read crawled documents in pages of about this many bytes of blobs; 0 for pages of 100 documents',
+                     default=32 * 1024 * 1024)
+
     obj.add_argument('--log-level',
                      help='Logging level, e.g. INFO, DEBUG',
                      choices=list(logging._nameToLevel.keys()),
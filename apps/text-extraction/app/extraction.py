@@ -0,0 +1,171 @@
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Iterable, Iterator, List, Tuple, Union
+import logging
+import multiprocessing
+
+from text_extraction.text_extractor import TextExtractor
+from text_extraction.segmentation import TextSegmenter
+from text_extraction.schema import CrawlDocument, TextBlock, ImageBlock, FullTextBlock, Segment
+
+
+logger = logging.getLogger(__name__)
+
+Result = Union[ImageBlock, FullTextBlock, Segment]
+
+
+def extract_document(extractor: TextExtractor,
+                     segmenter: TextSegmenter,
+                     blob: bytes,
+                     content_type: str) -> List[Result]:
+    """Extract and segment one document.
+
+    The results are only written once the whole document has been
+    processed, so a document that fails leaves nothing behind.
+    """
+    results = []
+    text_blocks = []
+    for block in extractor.extract_blocks(blob, content_type):
+        if isinstance(block, TextBlock):
+            text_blocks.append(block)  # defer for segmentation
+        else:
+            results.append(block)
+    results.extend(segmenter.segment(text_blocks))
+    return results
+
+
+# The extractor and segmenter of a worker process
+_worker = None
+
+
+def _init_worker(extractor_options: dict, log_level: str) -> None:
+    global _worker
+    logging.basicConfig(level=log_level, force=True)
+    # The documents are already processed in parallel, so each worker
+    # extracts its PDFs itself rather than starting a pool of its own
+    _worker = (TextExtractor(**{**extractor_options, "pdf_workers": 0}),
+               TextSegmenter())
+
+
+def _extract_in_worker(blob: bytes, content_type: str) -> List[Result]:
+    return extract_document(*_worker, blob, content_type)
+
+
+class DocumentProcessor:
+    """Extracts and segments documents, in this process or in a pool of
+    worker processes, and hands back the results in document order.
+
+    With workers, up to `depth` documents are in flight at once, so that
+    the workers are kept busy while the caller writes the results of
+    the oldest one.
+
+    Example:
+        with DocumentProcessor(options, workers=4) as processor:
+            for doc, results in processor.process(documents):
+                if isinstance(results, Exception):
+                    ...
+    """
+
+    def __init__(self,
+                 extractor_options: dict,
+                 workers: int = 0,
+                 depth: int = 0,
+                 log_level: str = "INFO"):
+        """
+        Args:
+            extractor_options: Keyword arguments for TextExtractor.
+            workers: Number of worker processes. 0 or 1 processes the
+                documents in this process. With workers, the
+                `pdf_workers` extractor option is ignored.
+            depth: Number of documents in flight. Defaults to twice the
+                number of workers.
+            log_level: Logging level for the workers.
+        """
+        self.extractor_options = extractor_options
+        self.workers = workers
+        self.depth = depth or 2 * workers
+        self.log_level = log_level
+        self._executor = None
+        self._extractor = None
+        self._segmenter = None
+        if workers > 1:
+            if extractor_options.get("pdf_workers"):
+                logger.warning(f"Ignoring pdf_workers={extractor_options['pdf_workers']} "
+                               f"with {workers} document workers")
+            self._start_workers()
+        else:
+            self._extractor = TextExtractor(**extractor_options)
+            self._segmenter = TextSegmenter()
+
+    def _start_workers(self) -> None:
+        # Spawn rather than fork, as the batcher runs a thread
+        self._executor = ProcessPoolExecutor(
+            max_workers=self.workers,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=_init_worker,
+            initargs=(self.extractor_options, self.log_level))
+
+    def close(self) -> None:
+        if self._executor is not None:
+            self._executor.shutdown(cancel_futures=True)
+            self._executor = None
+        if self._extractor is not None:
+            self._extractor.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def process(self, documents: Iterable[CrawlDocument]
+                ) -> Iterator[Tuple[CrawlDocument, Union[List[Result], Exception]]]:
+        """Yields each document with its results, or the exception raised
+        while processing it"""
+        if self._executor is None:
+            for doc in documents:
+                try:
+                    yield doc, extract_document(
+                        self._extractor, self._segmenter, doc.blob, doc.content_type)
+                except Exception as e:
+                    yield doc, e
+            return
+
+        documents = iter(documents)
+        pending = deque()  # (document, future, submitted by itself)
+        # Documents to run one at a time, after a worker died
+        isolate = deque()
+        while True:
+            while len(pending) < (1 if isolate else self.depth):
+                alone = bool(isolate)
+                doc = isolate.popleft() if isolate else next(documents, None)
+                if doc is None:
+                    break
+                future = self._executor.submit(
+                    _extract_in_worker, doc.blob, doc.content_type)
+                pending.append((doc, future, alone))
+            if not pending:
+                return
+
+            doc, future, alone = pending.popleft()
+            try:
+                yield doc, future.result()
+            except BrokenProcessPool as e:
+                # A worker died, perhaps killed for running out of memory,
+                # and took the documents in flight with it. Start new
+                # workers and run those documents again one at a time,
+                # so that only the one that kills a worker fails.
+                logger.warning(f"A worker died while {doc.url} was in flight")
+                self._executor.shutdown(wait=False, cancel_futures=True)
+                self._start_workers()
+                retry = [d for d, _, _ in pending]
+                pending.clear()
+                if not alone:
+                    retry.insert(0, doc)
+                # These come before any documents still waiting to run alone
+                isolate.extendleft(reversed(retry))
+                if alone:
+                    yield doc, e
+            except Exception as e:
+                yield doc, e
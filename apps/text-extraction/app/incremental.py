@@ -0,0 +1,69 @@
+from dataclasses import dataclass
+from typing import Dict, List, Optional
+import hashlib
+import logging
+
+from text_extraction.schema import CrawlDocument
+
+
+logger = logging.getLogger(__name__)
+
+
+def content_hash(blob: bytes) -> str:
+    return hashlib.sha256(blob).hexdigest()
+
+
+@dataclass
+class DocumentVersion:
+    """What was known of a document when it was last segmented"""
+    etag: Optional[str] = None
+    last_modified: Optional[dict] = None  # {"_date": ...}, as ApertureDB returns dates
+    sha256: Optional[str] = None
+
+
+class ChangeDetector:
+    """Decides which crawled documents are new or have changed since they
+    were last segmented for a spec, and which have gone from the crawl.
+
+    The response headers are checked first, so that a document the server
+    says is unchanged need not even be fetched from the database. Failing
+    that, the content is hashed, as many servers send a new ETag or
+    Last-Modified for the same page.
+    """
+
+    def __init__(self, previous: Dict[str, DocumentVersion]):
+        """
+        Args:
+            previous: The version of each document, by URL, that the
+                spec was last segmented from.
+        """
+        self.previous = previous
+        self.seen = set()
+
+    def is_known(self, url: str) -> bool:
+        return url in self.previous
+
+    def unchanged_by_headers(self, url: str,
+                             etag: Optional[str],
+                             last_modified: Optional[dict]) -> bool:
+        """True if the ETag, or failing that Last-Modified, is the same as
+        when the document was last segmented"""
+        self.seen.add(url)
+        old = self.previous.get(url)
+        if old is None:
+            return False
+        if etag and old.etag:
+            return etag == old.etag
+        if last_modified and old.last_modified:
+            return last_modified == old.last_modified
+        return False
+
+    def unchanged_by_content(self, doc: CrawlDocument) -> bool:
+        """True if the content is the same as when the document was last
+        segmented, though the headers may not be"""
+        old = self.previous.get(doc.url)
+        return old is not None and old.sha256 == content_hash(doc.blob)
+
+    def removed(self) -> List[str]:
+        """The URLs that were segmented before but are no longer in the crawl"""
+        return [url for url in self.previous if url not in self.seen]
@@ -0,0 +1,174 @@
+#!/usr/bin/env python3
+"""
+Microbenchmark for symbolic reference resolution in batcher.py
+
+Compares SymbolicBatcher with the previous implementation, which resolved
+references by modifying the commands in place, for AddDescriptor commands
+as emitted by the text embeddings workflow. SymbolicBatcher is run with
+plain commands, which are copied as they are resolved, and with compiled
+CommandTemplates.
+
+It also times the commands that are resolved for every flush, such as
+the epilog of the text embeddings workflow, built as dicts for each
+flush or compiled once into CommandTemplates, as the workflows do.
+
+Run from this directory:
+    PYTHONPATH=../scripts python bench_batcher.py [--n 100000]
+"""
+
+import argparse
+import gc
+import logging
+import time
+import uuid
+
+import numpy as np
+
+from batcher import SymbolicBatcher, CommandTemplate
+
+logger = logging.getLogger(__name__)
+
+
+class LegacyBatcher(SymbolicBatcher):
+    """The previous resolution path, which modified commands in place"""
+
+    def _resolve(self, command):
+        logger.debug("Resolving refs in command: %s", command)
+        command_name = next(iter(command))
+        command_body = command[command_name]
+        self._assign_ref(command_body, "_ref")
+        for x in ["is_connected_to", "connect"]:
+            if x in command_body:
+                self._lookup_ref(command_body[x], "ref")
+        if command_name == "AddConnection":
+            for x in ["src", "dst"]:
+                self._lookup_ref(command_body, x)
+        return command
+
+    def _assign_ref(self, obj, field):
+        if field not in obj:
+            return
+        if not isinstance(obj[field], str):
+            raise ValueError(f"Numeric ref ({obj}, {field}) not allowed")
+        self._ref_map[obj[field]] = self._ref_counter
+        obj[field] = self._ref_counter
+        self._ref_counter += 1
+
+    def _lookup_ref(self, obj, field):
+        if field not in obj:
+            return
+        if not isinstance(obj[field], str):
+            raise ValueError(f"Numeric ref ({obj}, {field}) not allowed")
+        if obj[field] not in self._ref_map:
+            raise ValueError(
+                f"Symbolic reference '{obj[field]}' not assigned yet")
+        obj[field] = self._ref_map[obj[field]]
+
+
+def prolog():
+    return [{"FindEntity": {"with_class": "EmbeddingsSpec",
+                            "constraints": {"id": ["==", "spec"]}, "_ref": "SPEC"}}]
+
+
+def epilog():
+    """As built by text embeddings for each flush"""
+    return [
+        {"FindEntity": {"with_class": "EmbeddingsSpec",
+                        "constraints": {"id": ["==", "spec"]}, "_ref": "SPEC"}},
+        {"FindDescriptor": {"set": "bench",
+                            "constraints": {"run_id": ["==", "run"], "spec_pending": ["==", True]},
+                            "results": {"limit": 100}, "_ref": "PENDING"}},
+        {"AddConnection": {"src": "SPEC", "dst": "PENDING",
+                           "class": "embeddingsSpecHasDescriptor"}},
+        {"UpdateDescriptor": {"ref": "PENDING", "remove_props": ["spec_pending"]}},
+    ]
+
+
+def time_per_flush(epilog_fn, n: int) -> float:
+    """Seconds to build and resolve the epilog of one flush"""
+    batcher = SymbolicBatcher(lambda commands, blobs: ([], []))
+    start = time.perf_counter()
+    for _ in range(n):
+        batcher._ref_map = {}
+        batcher._ref_counter = 1
+        for command in epilog_fn():
+            batcher._resolve(command)
+    return (time.perf_counter() - start) / n
+
+
+def make_commands(n: int) -> list:
+    """n sets of commands and blobs, as emitted by text embeddings"""
+    vector = np.zeros(384, dtype=np.float32).tobytes()
+    items = []
+    for i in range(n):
+        segment_id = str(uuid.uuid4())
+        items.append(([
+            {"FindEntity": {"with_class": "Segment",
+                            "constraints": {"id": ["==", segment_id]}, "_ref": "SEGMENT"}},
+            {"AddDescriptor": {"set": "bench",
+                               "properties": {"segment_id": segment_id, "uniqueid": str(uuid.uuid4()),
+                                              "spec_id": "spec", "run_id": "run", "text": "text " * 50},
+                               "connect": {"ref": "SEGMENT", "class": "segmentHasDescriptor",
+                                           "direction": "in"},
+                               "_ref": "TEMP"}},
+            {"AddConnection": {"src": "SPEC", "dst": "TEMP",
+                               "class": "embeddingsSpecHasDescriptor"}},
+        ], [vector]))
+    return items
+
+
+def run(batcher_class, items) -> float:
+    sent = []
+    batcher = batcher_class(lambda commands, blobs: sent.append(len(commands)) or ([], []),
+                            batch_size=300, prolog=prolog)
+    gc.collect()
+    start = time.perf_counter()
+    for commands, blobs in items:
+        batcher.add(commands, blobs)
+    batcher.flush()
+    elapsed = time.perf_counter() - start
+    assert sum(sent) == len(items) * 3 + len(sent)
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--n", type=int, default=100000,
+                        help="Number of AddDescriptor commands")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--flushes", type=int, default=100000,
+                        help="Number of flushes to time the epilog over")
+    args = parser.parse_args()
+
+    def best(batcher_class, make_items):
+        return min(run(batcher_class, make_items()) for _ in range(args.repeat))
+
+    def report(name, seconds):
+        print(f"{name:10s} {seconds:.3f}s ({args.n / seconds:,.0f} descriptors/s)")
+
+    # The legacy path modifies the commands, so they cannot be reused
+    report("legacy", best(LegacyBatcher, lambda: make_commands(args.n)))
+
+    items = make_commands(args.n)
+    report("dicts", best(SymbolicBatcher, lambda: items))
+
+    start = time.perf_counter()
+    templates = [([CommandTemplate(c) for c in commands], blobs)
+                 for commands, blobs in items]
+    print(f"{'compile':10s} {time.perf_counter() - start:.3f}s (once)")
+    report("templates", best(SymbolicBatcher, lambda: templates))
+
+    print("Per flush, for the text embeddings epilog:")
+    dicts = min(time_per_flush(epilog, args.flushes) for _ in range(args.repeat))
+    start = time.perf_counter()
+    compiled = [CommandTemplate(c) for c in epilog()]
+    compile_seconds = time.perf_counter() - start
+    templates = min(time_per_flush(lambda: compiled, args.flushes) for _ in range(args.repeat))
+    print(f"{'dicts':10s} {dicts * 1e6:.2f}us")
+    print(f"{'templates':10s} {templates * 1e6:.2f}us, "
+          f"saving {(dicts - templates) * 1e6:.2f}us per flush "
+          f"for {compile_seconds * 1e6:.0f}us compiled once")
+
+
+if __name__ == "__main__":
+    main()
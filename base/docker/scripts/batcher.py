@@ -1,11 +1,115 @@
-from typing import Callable, List, Optional, Dict, Tuple, Iterator
+from typing import Callable, List, Optional, Dict, Tuple, Iterator, Union
+from dataclasses import dataclass
+import json
 import logging
+import queue
+import threading
+import time
 
 logger = logging.getLogger(__name__)
 
 # TODO: Elevate this to a shared library
 
 
+# Keys that hold references to other commands
+_CONNECTION_KEYS = ("is_connected_to", "connect")
+_ADD_CONNECTION_KEYS = ("src", "dst")
+
+
+def _symbol(obj: dict, field: str) -> Optional[str]:
+    """Returns the symbolic reference in obj[field], if any."""
+    if field not in obj:
+        return None
+    if not isinstance(obj[field], str):
+        logger.error(
+            f"Numeric ref ({obj}, {field}) not allowed")
+        raise ValueError(
+            f"Numeric ref ({obj}, {field}) not allowed")
+    return obj[field]
+
+
+def _lookup(ref_map: Dict[str, int], symbol: str) -> int:
+    if symbol not in ref_map:
+        logger.error(
+            f"Symbolic reference '{symbol}' not assigned yet")
+        raise ValueError(f"Symbolic reference '{symbol}' not assigned yet")
+    return ref_map[symbol]
+
+
+def _lookup_field(ref_map: Dict[str, int], obj: dict, field: str) -> int:
+    """Returns the numeric reference for the symbol in obj[field]"""
+    try:
+        return ref_map[obj[field]]
+    except (KeyError, TypeError):
+        # Raise the same errors as the slow path
+        return _lookup(ref_map, _symbol(obj, field))
+
+
+class CommandTemplate:
+    """A command with symbolic references, compiled so that it can be
+    resolved for any number of batches without inspecting it again.
+
+    A symbol is assigned by `_ref` in the command body, and looked up by
+    `ref` in the body (as in Update and Delete commands), by `ref` in
+    `connect` or `is_connected_to`, or by `src` and `dst` in
+    `AddConnection`. Resolving copies only the dictionaries that hold
+    references; everything else, such as properties, is shared.
+    """
+    __slots__ = ("command", "name", "body", "assigns", "lookups")
+
+    def __init__(self, command: dict):
+        assert isinstance(command, dict)
+        self.command = command
+        self.name = next(iter(command))
+        self.body = command[self.name]
+        # The symbol assigned by this command, if any
+        self.assigns = _symbol(self.body, "_ref")
+        # (key of nested dictionary or None for the body, field, symbol)
+        self.lookups: List[Tuple[Optional[str], str, str]] = []
+        symbol = _symbol(self.body, "ref")
+        if symbol is not None:
+            self.lookups.append((None, "ref", symbol))
+        for x in _CONNECTION_KEYS:
+            if x in self.body:
+                symbol = _symbol(self.body[x], "ref")
+                if symbol is not None:
+                    self.lookups.append((x, "ref", symbol))
+        if self.name == "AddConnection":
+            for x in _ADD_CONNECTION_KEYS:
+                symbol = _symbol(self.body, x)
+                if symbol is not None:
+                    self.lookups.append((None, x, symbol))
+
+    def resolve(self, ref_map: Dict[str, int], ref: int) -> dict:
+        """Returns a new command with symbols replaced by numeric references.
+
+        If this command assigns a symbol, it is given `ref`, and `ref_map` is updated.
+        """
+        body = dict(self.body)
+        if self.assigns is not None:
+            ref_map[self.assigns] = ref
+            body["_ref"] = ref
+        for key, field, symbol in self.lookups:
+            if key is None:
+                body[field] = _lookup(ref_map, symbol)
+            else:
+                nested = dict(body[key])
+                nested[field] = _lookup(ref_map, symbol)
+                body[key] = nested
+        return {self.name: body}
+
+
+@dataclass
+class _Batch:
+    """A batch of resolved commands, ready to be executed"""
+    commands: List[dict]
+    blobs: List[bytes]
+    # (start, length, response_handler)
+    response_handlers: List[Tuple[int, int, Callable]]
+    # Offset of the first added command, after the prolog
+    commands_start: int
+
+
 class SymbolicBatcher:
     """This class is a lightweight way to run batches of commands
     to ApertureDB. It handles symbolic references and
@@ -15,6 +119,27 @@ class SymbolicBatcher:
     that return an additional list of commands to be run at the start
     and end of the batch. The prolog and epilog are run in the
     context of the batch, so they can use the same symbolic references.
+
+    If `pipeline_depth` is greater than zero, flushed batches are executed
+    by a background thread, while the caller fills the next batch.
+    Up to `pipeline_depth` batches may be waiting or in flight; after that,
+    `flush` blocks. Batches are executed and response handlers are called
+    in order, on the background thread. An error in a background batch
+    is raised by the next call to `add`, `flush`, `join`, or `close`.
+    `execute_query` must be safe to call from the background thread,
+    e.g. by using its own connection.
+
+    A batch is flushed when it has `batch_size` commands. It is also flushed
+    when its blobs reach `max_blob_bytes`, when its commands reach
+    `max_json_bytes` (estimated as JSON), or when `max_latency` seconds have
+    passed since the first command was added; these limits are off when 0.
+    Commands that would take a batch over a byte limit start a new batch.
+    Latency is only checked when commands are added.
+
+    Commands are not modified, so the same command may be added many times;
+    each batch gets shallow copies with numeric references. Commands that are
+    used in many batches, say in a prolog, may be given as `CommandTemplate`s,
+    so that they are only inspected once.
     """
 
     def __init__(
@@ -23,130 +148,290 @@ class SymbolicBatcher:
         batch_size: int = 100,
         prolog: Optional[Callable[[], List[dict]]] = None,
         epilog: Optional[Callable[[], List[dict]]] = None,
+        pipeline_depth: int = 0,
+        max_blob_bytes: int = 0,
+        max_json_bytes: int = 0,
+        max_latency: float = 0,
     ):
         self.execute_query = execute_query
         self.batch_size = batch_size
         self.prolog_fn = prolog or (lambda: [])
         self.epilog_fn = epilog or (lambda: [])
+        self.pipeline_depth = pipeline_depth
+        self.max_blob_bytes = max_blob_bytes
+        self.max_json_bytes = max_json_bytes
+        self.max_latency = max_latency
 
-        self._commands: List[dict] = []
+        self._commands: List[Union[dict, CommandTemplate]] = []
         self._response_handlers: List[Tuple[int, int, Callable]] = []
         self._blobs: List[bytes] = []
         self._ref_map: dict[str, int] = {}
         self._ref_counter = 1
         self._batch_started = False
+        self._blob_bytes = 0
+        self._json_bytes = 0
+        self._start_time = None
+
+        # Background execution, only used if pipeline_depth > 0
+        self._queue: Optional[queue.Queue] = None
+        self._worker: Optional[threading.Thread] = None
+        self._errors: List[Exception] = []
+        self._errors_lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            # Don't send a half-built batch, or hide the error with another
+            self.abort()
 
     def empty(self) -> bool:
         """Returns True if the batch is empty."""
         return not self._commands
 
     def add(self,
-            items: Iterator[dict],
+            items: Iterator[Union[dict, CommandTemplate]],
             blobs: Optional[Iterator[bytes]] = [],
             response_handler=None):
+        """Add commands (and their blobs) to the batch.
+
+        If given, `response_handler(results, blobs)` is called with the
+        results of these commands and their blobs after the batch is executed.
+        """
+        self._raise_pending_error()
+
+        items = list(items)
+        blobs = list(blobs) if blobs else []
+        # Sizes are only needed if there is a limit
+        blob_bytes = sum(map(len, blobs)) if self.max_blob_bytes else 0
+        json_bytes = self._estimate_json_bytes(items)
+        if (blob_bytes or json_bytes) and not self.empty() and \
+                self._would_exceed(blob_bytes, json_bytes):
+            self.flush()
 
+        if not self._batch_started:
+            self._start_time = time.monotonic()
         self._batch_started = True
+        self._blob_bytes += blob_bytes
+        self._json_bytes += json_bytes
 
         if response_handler is not None:
             # (start, length, response_handler)
-            self._response_handlers.append((len(self._commands), len(resolved),
+            self._response_handlers.append((len(self._commands), len(items),
                                             response_handler))
         self._commands.extend(items)
+        self._blobs.extend(blobs)
 
-        if blobs is not None:
-            self._blobs.extend(blobs)
-
-        if self._count_commands() >= self.batch_size:
+        if self._should_flush():
             self.flush()
 
     def flush(self):
+        """Send the current batch.
+
+        In pipelined mode, this returns once the batch is queued; use `join` to wait for it.
+        """
+        self._raise_pending_error()
+
         if self.empty():
             return
 
         logger.info("Flushing %d commands", len(self._commands))
 
-        commands = []
-        for proto in self.prolog_fn():
-            commands.append(self._resolve_refs_in_command(proto))
+        batch = self._resolve_batch()
+
+        if self.pipeline_depth > 0:
+            self._start_worker()
+            self._queue.put(batch)
+        else:
+            self._execute_batch(batch)
+
+    def join(self):
+        """Wait until all flushed batches have been executed."""
+        if self._queue is not None:
+            self._queue.join()
+        self._raise_pending_error()
+
+    def close(self):
+        """Flush the current batch, wait for all batches, and stop the background thread."""
+        try:
+            self.flush()
+            self.join()
+        finally:
+            self._stop_worker()
+
+    def abort(self):
+        """Discard the current batch and stop the background thread, without raising.
+
+        Batches that were already flushed are still executed; their errors are logged.
+        """
+        if not self.empty():
+            logger.warning("Discarding %d commands that were not flushed",
+                           len(self._commands))
+        self._new_batch()
+        self._stop_worker()
+        with self._errors_lock:
+            errors, self._errors = self._errors, []
+        if errors:
+            logger.error("%d batches failed", len(errors))
+
+    def _stop_worker(self):
+        if self._worker is not None:
+            self._queue.put(None)
+            self._worker.join()
+            self._worker = None
+            self._queue = None
+
+    def _resolve_batch(self) -> _Batch:
+        """Resolve the symbolic references in the current batch and start a new batch.
+
+        This runs on the calling thread, so that the prolog and epilog see the caller's state.
+        """
+        resolve = self._resolve
+        commands = [resolve(proto) for proto in self.prolog_fn()]
         commands_start = len(commands)
+        commands.extend(map(resolve, self._commands))
+        commands.extend(map(resolve, self.epilog_fn()))
 
-        for proto in self._commands:
-            commands.append(self._resolve_refs_in_command(proto))
+        batch = _Batch(commands=commands,
+                       blobs=self._blobs,
+                       response_handlers=self._response_handlers,
+                       commands_start=commands_start)
+        self._new_batch()
+        return batch
 
-        for proto in self.epilog_fn():
-            commands.append(self._resolve_refs_in_command(proto))
+    def _new_batch(self):
+        """Start a new, empty batch"""
+        # New lists, because the background thread may still be using the old ones
+        self._commands = []
+        self._blobs = []
+        self._response_handlers = []
+        self._ref_map = {}
+        self._ref_counter = 1
+        self._batch_started = False
+        self._blob_bytes = 0
+        self._json_bytes = 0
+        self._start_time = None
 
-        results, blobs = self.execute_query(commands, self._blobs)
+    def _execute_batch(self, batch: _Batch):
+        results, blobs = self.execute_query(batch.commands, batch.blobs)
 
-        for start, length, response_handler in self._response_handlers:
-            sub_results = results[commands_start +
-                                  start:commands_start+start + length]
+        for start, length, response_handler in batch.response_handlers:
+            sub_results = results[batch.commands_start +
+                                  start:batch.commands_start + start + length]
             assert len(sub_results) == length
-            result_blobs = None
+            result_blobs = []
             for result in sub_results:
+                body = next(iter(result.values()), None)
+                if not isinstance(body, dict):
+                    continue
                 new_start = len(result_blobs)
-                if "blobs_start" in result:
+                if "blobs_start" in body:
                     result_blobs.extend(
-                        blobs[result["blobs_start"]: result["blobs_start"] + result["returned"]])
-                    result["blobs_start"] = new_start
-                elif "blob_index" in result:
-                    result_blobs.append([blobs[result["blob_index"]]])
-                    result["blob_index"] = new_start
-            response_handler(result, result_blobs)
-
-        self._commands.clear()
-        self._blobs.clear()
-        self._response_handlers.clear()
-        self._ref_map.clear()
-        self._ref_counter = 1
-        self._batch_started = False
+                        blobs[body["blobs_start"]: body["blobs_start"] + body["returned"]])
+                    body["blobs_start"] = new_start
+                elif "blob_index" in body:
+                    result_blobs.append(blobs[body["blob_index"]])
+                    body["blob_index"] = new_start
+            response_handler(sub_results, result_blobs)
 
-        logger.info("Flushed %d commands", len(commands))
+        logger.info("Flushed %d commands", len(batch.commands))
 
-    def _assign_ref(self, obj: dict, field: str) -> None:
-        if field not in obj:
+    def _start_worker(self):
+        if self._worker is not None:
             return
-        if not isinstance(obj[field], str):
-            logger.error(
-                f"Numeric ref ({obj}, {field}) not allowed")
-            raise ValueError(
-                f"Numeric ref ({obj}, {field}) not allowed")
-        symbol = obj[field]
-        ref = self._ref_counter
-        self._ref_counter += 1
-        self._ref_map[symbol] = ref
-        obj[field] = ref
-
-    def _lookup_ref(self, obj: dict, field: str) -> None:
-        if field not in obj:
+        self._queue = queue.Queue(maxsize=self.pipeline_depth)
+        self._worker = threading.Thread(
+            target=self._run_worker, name="batcher", daemon=True)
+        self._worker.start()
+
+    def _run_worker(self):
+        while True:
+            batch = self._queue.get()
+            try:
+                if batch is None:
+                    return
+                self._execute_batch(batch)
+            except Exception as e:
+                logger.exception("Failed to execute batch of %d commands",
+                                 len(batch.commands))
+                with self._errors_lock:
+                    self._errors.append(e)
+            finally:
+                self._queue.task_done()
+
+    def _raise_pending_error(self):
+        """Raise the first error from the background thread, if any."""
+        if not self._errors:
             return
-        if not isinstance(obj[field], str):
-            logger.error(
-                f"Numeric ref ({obj}, {field}) not allowed")
-            raise ValueError(
-                f"Numeric ref ({obj}, {field}) not allowed")
-        symbol = obj[field]
-        if symbol not in self._ref_map:
-            logger.error(
-                f"Symbolic reference '{symbol}' not assigned yet")
-            raise ValueError(f"Symbolic reference '{symbol}' not assigned yet")
-        obj[field] = self._ref_map[symbol]
-
-    def _resolve_refs_in_command(self, command):
-        # TODO: Deep copy?
-        logger.debug("Resolving refs in command: %s", command)
-        assert isinstance(command, dict)
-        command_name = next(iter(command))
-        command_body = command[command_name]
+        with self._errors_lock:
+            errors, self._errors = self._errors, []
+        if errors:
+            if len(errors) > 1:
+                logger.error("%d further batches failed", len(errors) - 1)
+            raise errors[0]
+
+    def _resolve(self, command: Union[dict, CommandTemplate]) -> dict:
+        """Returns a copy of the command with numeric references."""
+        if type(command) is not dict:
+            assert isinstance(command, CommandTemplate)
+            resolved = command.resolve(self._ref_map, self._ref_counter)
+            if command.assigns is not None:
+                self._ref_counter += 1
+            return resolved
 
-        self._assign_ref(command_body, "_ref")
-        for x in ["is_connected_to", "connect"]:
-            if x in command_body:
-                self._lookup_ref(command_body[x], "ref")
+        # Resolving a command once is cheaper than compiling it, so this
+        # path is kept lean: the common case is a dictionary lookup per ref
+        (command_name, command_body), = command.items()
+        body = command_body.copy()
+        ref_map = self._ref_map
+
+        if "_ref" in body:
+            symbol = body["_ref"]
+            if type(symbol) is not str:
+                _symbol(body, "_ref")  # raises
+            ref_map[symbol] = body["_ref"] = self._ref_counter
+            self._ref_counter += 1
+        if "ref" in body:
+            body["ref"] = _lookup_field(ref_map, body, "ref")
+        for x in _CONNECTION_KEYS:
+            if x in body and "ref" in body[x]:
+                nested = body[x].copy()
+                nested["ref"] = _lookup_field(ref_map, nested, "ref")
+                body[x] = nested
         if command_name == "AddConnection":
-            for x in ["src", "dst"]:
-                self._lookup_ref(command_body, x)
-        return command
+            for x in _ADD_CONNECTION_KEYS:
+                if x in body:
+                    body[x] = _lookup_field(ref_map, body, x)
+        return {command_name: body}
+
+    def _estimate_json_bytes(self, items: List[dict]) -> int:
+        """Estimate the size of commands in the JSON query; only needed if there is a limit."""
+        if not self.max_json_bytes:
+            return 0
+        return len(json.dumps(
+            [item.command if isinstance(item, CommandTemplate) else item for item in items],
+            default=str))
+
+    def _would_exceed(self, blob_bytes: int, json_bytes: int) -> bool:
+        """Would adding this many bytes take the batch over a byte limit?"""
+        return bool(
+            (self.max_blob_bytes and self._blob_bytes + blob_bytes > self.max_blob_bytes) or
+            (self.max_json_bytes and self._json_bytes + json_bytes > self.max_json_bytes))
+
+    def _should_flush(self) -> bool:
+        """Returns True if the batch should be flushed now."""
+        if self._count_commands() >= self.batch_size:
+            return True
+        if self.max_blob_bytes and self._blob_bytes >= self.max_blob_bytes:
+            return True
+        if self.max_json_bytes and self._json_bytes >= self.max_json_bytes:
+            return True
+        if self.max_latency and time.monotonic() - self._start_time >= self.max_latency:
+            return True
+        return False
 
     def _count_commands(self):
         """Returns the number of commands in the batch.
@@ -0,0 +1,114 @@
+from typing import Dict, Iterable, List, Optional
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Object types whose Find commands return their blobs unless told not to
+_BLOB_TYPES = ("Image", "Video", "Blob")
+
+
+class BulkUpdate:
+    """This class builds a single query that updates a set of objects
+    of one type, say marking images as processed, and adds new objects
+    connected to some of them.
+
+    Instead of a Find and an Update for each object, all the objects
+    are found by `_uniqueid` with one `Find<Type>` using `["in", ids]`,
+    and updated with one `Update<Type>`.
+
+    A reference from a Find that matches many objects would connect an
+    Add command to all of them, so an object that needs Add commands of
+    its own is found again by itself. These per-object Finds are only
+    added for objects that ask for a reference with `ref`.
+
+    The Find commands do not return blobs, and `find_options` are added
+    to each of them.
+
+    Example:
+        bulk = BulkUpdate("Image", uniqueids, properties={"done": True})
+        for uniqueid, box in boxes:
+            bulk.add({"AddBoundingBox": {"image_ref": bulk.ref(uniqueid), ...}})
+        execute_query(bulk.query(), blobs)
+    """
+
+    def __init__(self,
+                 object_type: str,
+                 uniqueids: Iterable[str],
+                 properties: Optional[dict] = None,
+                 remove_props: Optional[List[str]] = None,
+                 find_options: Optional[dict] = None):
+        self.object_type = object_type
+        self.find_options = {
+            **({"blobs": False} if object_type in _BLOB_TYPES else {}),
+            **(find_options or {}),
+        }
+        self.uniqueids = list(uniqueids)
+        self._refs: Dict[str, int] = {}
+        self._ref_counter = 1
+        self._commands: List[dict] = []
+
+        if not self.uniqueids:
+            return
+
+        self._all_ref = self.new_ref()
+        self._commands.append({
+            f"Find{object_type}": {
+                "_ref": self._all_ref,
+                "constraints": {
+                    "_uniqueid": ["in", self.uniqueids]
+                },
+                **self.find_options,
+            }
+        })
+        update = {}
+        if properties:
+            update["properties"] = properties
+        if remove_props:
+            update["remove_props"] = remove_props
+        if update:
+            self._commands.append({
+                f"Update{object_type}": {
+                    "ref": self._all_ref,
+                    **update,
+                }
+            })
+
+    def new_ref(self) -> int:
+        """Returns a new reference, for use by an added command"""
+        ref = self._ref_counter
+        self._ref_counter += 1
+        return ref
+
+    def ref(self, uniqueid: str) -> int:
+        """Returns a reference to a single object, finding it if necessary"""
+        if uniqueid in self._refs:
+            return self._refs[uniqueid]
+        assert uniqueid in self.uniqueids, \
+            f"{self.object_type} {uniqueid} is not in this update"
+        if len(self.uniqueids) == 1:
+            # The bulk Find already matches only this object
+            ref = self._all_ref
+        else:
+            ref = self.new_ref()
+            self._commands.append({
+                f"Find{self.object_type}": {
+                    "_ref": ref,
+                    "constraints": {
+                        "_uniqueid": ["==", uniqueid]
+                    },
+                    **self.find_options,
+                }
+            })
+        self._refs[uniqueid] = ref
+        return ref
+
+    def add(self, command: dict) -> None:
+        """Add a command, which may use references from `ref` and `new_ref`"""
+        self._commands.append(command)
+
+    def query(self) -> List[dict]:
+        """Returns the commands for the query"""
+        logger.debug(
+            f"Bulk update of {len(self.uniqueids)} {self.object_type}s, "
+            f"{len(self._refs)} found individually, {len(self._commands)} commands")
+        return self._commands
@@ -0,0 +1,182 @@
+from dataclasses import dataclass, field
+from typing import Callable, Dict, List, Optional, Tuple
+import logging
+
+from status_tools import StatusUpdater
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class DeleteStep:
+    """Objects of one type to delete, found by constraints"""
+    object_type: str  # e.g. "Entity", "Descriptor"
+    constraints: dict
+    # Other parameters of the Find command, e.g. with_class or set
+    find_options: dict = field(default_factory=dict)
+    # Also delete the blobs connected to each object with this class
+    blob_connection: Optional[str] = None
+    # Delete this descriptor set, with its descriptors, in one command
+    descriptor_set: Optional[str] = None
+    # Counted in the total for progress; False if earlier steps may
+    # delete some of the same objects
+    in_total: bool = True
+
+    def __str__(self):
+        if self.descriptor_set:
+            return f"descriptor set {self.descriptor_set}"
+        return f"{self.find_options.get('with_class', self.object_type)} {self.constraints}"
+
+
+class ChunkedDeleter:
+    """This class deletes large numbers of objects in batches of bounded
+    size, rather than in one query that could time out or hold a huge
+    transaction on the server.
+
+    Each batch finds up to `batch_size` of the objects that are left and
+    deletes them, so a deletion that is interrupted can be resumed by
+    running it again. Add the steps children first, so that the parent
+    that they are found from is deleted last.
+
+    Progress is reported through StatusUpdater after each batch.
+
+    Example:
+        deleter = ChunkedDeleter(io.execute_query, updater=StatusUpdater())
+        deleter.add("Entity", {"spec_id": ["==", spec_id]}, with_class="Segment")
+        deleter.add("Entity", {"id": ["==", spec_id]}, with_class="SegmentationSpec")
+        deleter.run()
+    """
+
+    def __init__(self,
+                 execute_query: Callable[[List[dict]], Tuple[List[dict], list]],
+                 batch_size: int = 10000,
+                 updater: Optional[StatusUpdater] = None,
+                 phase: str = "deleting"):
+        self.execute_query = execute_query
+        self.batch_size = batch_size
+        self.updater = updater
+        self.phase = phase
+        self.steps: List[DeleteStep] = []
+
+    def add(self,
+            object_type: str,
+            constraints: dict,
+            blob_connection: Optional[str] = None,
+            in_total: bool = True,
+            **find_options) -> "ChunkedDeleter":
+        """Add a step that deletes the objects matching the constraints.
+
+        A step that may find objects deleted by earlier steps, e.g. one
+        that catches whatever they missed, should have `in_total=False`.
+        It is then counted only when it is reached, and left out of the
+        progress, so that nothing is counted twice.
+        """
+        self.steps.append(DeleteStep(object_type, constraints,
+                                     find_options=find_options,
+                                     blob_connection=blob_connection,
+                                     in_total=in_total))
+        return self
+
+    def add_descriptor_set(self, name: str) -> "ChunkedDeleter":
+        """Add a step that deletes a descriptor set and all its descriptors
+        with one command, which is much faster than deleting the
+        descriptors in batches"""
+        # Counted as its descriptors, for progress
+        self.steps.append(DeleteStep("Descriptor", {},
+                                     find_options={"set": name},
+                                     descriptor_set=name))
+        return self
+
+    def count(self, object_type: str, constraints: dict, **find_options) -> int:
+        """Returns the number of objects matching the constraints"""
+        results, _ = self.execute_query([{
+            f"Find{object_type}": {
+                **find_options,
+                **({"constraints": constraints} if constraints else {}),
+                "results": {"count": True},
+            }
+        }])
+        return results[0][f"Find{object_type}"].get("count", 0)
+
+    def _delete_descriptor_set(self, step: DeleteStep) -> None:
+        self.execute_query([{
+            "DeleteDescriptorSet": {
+                "with_name": step.descriptor_set,
+            }
+        }])
+
+    def _delete_batch(self, step: DeleteStep) -> int:
+        """Delete up to batch_size objects, returning how many were deleted"""
+        query = [{
+            f"Find{step.object_type}": {
+                **step.find_options,
+                **({"constraints": step.constraints} if step.constraints else {}),
+                "uniqueids": True,
+                "results": {"limit": self.batch_size},
+                "_ref": 1,
+            }
+        }]
+        if step.blob_connection:
+            query.extend([
+                {
+                    "FindBlob": {
+                        "is_connected_to": {
+                            "ref": 1,
+                            "connection_class": step.blob_connection,
+                        },
+                        "_ref": 2,
+                    }
+                },
+                {
+                    "DeleteBlob": {
+                        "ref": 2,
+                    }
+                },
+            ])
+        query.append({
+            f"Delete{step.object_type}": {
+                "ref": 1,
+            }
+        })
+        results, _ = self.execute_query(query)
+        return results[-1][f"Delete{step.object_type}"].get("count", 0)
+
+    def run(self) -> Dict[str, int]:
+        """Run the steps in order, returning the number of objects deleted by each"""
+        totals = [self.count(step.object_type, step.constraints, **step.find_options)
+                  if step.in_total else 0
+                  for step in self.steps]
+        total = sum(totals)
+        logger.info(f"Deleting {total} objects in {len(self.steps)} steps")
+        deleted = {}
+        done = 0
+        for step, expected in zip(self.steps, totals):
+            if not step.in_total:
+                expected = self.count(step.object_type, step.constraints, **step.find_options)
+            n = 0
+            if step.descriptor_set:
+                self._delete_descriptor_set(step)
+                n = expected
+                done += n
+                logger.info(f"Deleted {step} with {n} descriptors")
+                self._post_progress(done, total)
+            else:
+                while expected:
+                    count = self._delete_batch(step)
+                    if count == 0:
+                        break
+                    n += count
+                    if step.in_total:
+                        done += count
+                    logger.info(f"Deleted {n} of {expected} {step}")
+                    self._post_progress(done, total)
+                    if count < self.batch_size:  # That was the last of them
+                        break
+            deleted[str(step)] = n
+        self._post_progress(total, total)
+        return deleted
+
+    def _post_progress(self, done: int, total: int) -> None:
+        if self.updater is not None and total:
+            self.updater.post_update(
+                completed=100.0 * min(done, total) / total, phase=self.phase)
@@ -1,82 +1,282 @@
-import queue
-from contextlib import contextmanager
-from typing import ContextManager, Optional
+import asyncio
+import functools
+import logging
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager, contextmanager
+from typing import AsyncContextManager, Callable, ContextManager, List, Optional, Tuple
 
 from aperturedb.CommonLibrary import create_connector, execute_query
 from aperturedb.Connector import Connector
 from aperturedb.Utils import Utils
+from prometheus_client import Counter, Gauge, Histogram
+
+from metrics import start_metrics_server
+
+logger = logging.getLogger(__name__)
+
+# Metrics are shared by all pools in a process
+CHECKOUT_WAIT = Histogram(
+    "aperturedb_pool_checkout_wait_seconds",
+    "Time spent waiting for a connection from the pool")
+CONNECTIONS_IN_USE = Gauge(
+    "aperturedb_pool_connections_in_use",
+    "Number of connections checked out of the pool")
+CONNECTIONS_OPEN = Gauge(
+    "aperturedb_pool_connections_open",
+    "Number of open connections, idle or in use")
+QUERY_LATENCY = Histogram(
+    "aperturedb_query_duration_seconds",
+    "Duration of queries run through the pool, by first command",
+    ["command"])
+# JSON is only counted if it is already a string, as serializing it
+# again to count it would cost as much as the query itself
+BYTES_SENT = Counter(
+    "aperturedb_query_sent_bytes",
+    "Bytes of blobs, and of JSON given as a string, sent in queries run through the pool")
+BYTES_RECEIVED = Counter(
+    "aperturedb_query_received_bytes",
+    "Bytes of blobs received from queries run through the pool")
+COMMANDS_SENT = Counter(
+    "aperturedb_query_sent_commands",
+    "Commands sent in queries run through the pool")
+ENTITIES_RECEIVED = Counter(
+    "aperturedb_query_received_entities",
+    "Entities listed in the responses to queries run through the pool")
+QUERY_ERRORS = Counter(
+    "aperturedb_query_errors",
+    "Queries run through the pool that raised an exception or returned an error status, by first command",
+    ["command"])
+CONNECTION_ERRORS = Counter(
+    "aperturedb_pool_connection_errors",
+    "Connections that could not be created or failed a liveness check")
 
 
 class ConnectionPool:
     """
     A thread-safe connection pool for aperturedb.Connector.
 
-    This pool manages a fixed number of Connector instances, allowing multiple
+    This pool manages up to `pool_size` Connector instances, allowing multiple
     threads to safely execute queries by borrowing and returning connections.
+
+    Connections are created when they are needed, and connections beyond
+    `min_size` are closed after they have been idle for `max_idle_time` seconds.
+    A connection that has been idle for `validate_after` seconds, or whose last
+    use raised an exception, is checked with GetStatus before it is handed out,
+    and replaced if it is broken.
     """
 
-    def __init__(self, pool_size: int = 10, connection_factory=create_connector):
+    def __init__(self,
+                 pool_size: int = 10,
+                 connection_factory=create_connector,
+                 min_size: int = 1,
+                 acquire_timeout: Optional[float] = None,
+                 max_idle_time: float = 300,
+                 validate_after: float = 30):
         """
         Initializes the connection pool.
 
         Args:
-            pool_size (int): The number of connections to keep in the pool.
+            pool_size (int): The maximum number of connections in the pool.
             connection_factory (callable): A factory function to create new connections.
+            min_size (int): The number of connections to create up front and keep open.
+            acquire_timeout (float): Seconds to wait for a connection before raising TimeoutError; None to wait forever.
+            max_idle_time (float): Seconds after which an idle connection beyond `min_size` is closed.
+            validate_after (float): Seconds of idleness after which a connection is checked before use.
         """
         if pool_size <= 0:
             raise ValueError("Pool size must be greater than 0.")
+        if not 0 <= min_size <= pool_size:
+            raise ValueError(
+                "Minimum size must be between 0 and the pool size.")
 
         self._pool_size = pool_size
+        self._min_size = min_size
         self._connection_factory = connection_factory
-        # A thread-safe queue to hold the available connections
-        self._pool = queue.LifoQueue(maxsize=pool_size)
+        self._acquire_timeout = acquire_timeout
+        self._max_idle_time = max_idle_time
+        self._validate_after = validate_after
+
+        self._condition = threading.Condition()
+        # Idle connections, most recently used last: (connection, last used, suspect)
+        self._idle: List[Tuple[Connector, float, bool]] = []
+        # Open connections, including those in use and being created
+        self._size = 0
+        self._closed = False
 
-        # Pre-populate the pool with connections
-        for _ in range(pool_size):
+        for _ in range(min_size):
             try:
-                connection = self._connection_factory()
-                if not connection:
-                    raise ConnectionError("Failed to create a connection.")
-                self._pool.put(connection)
+                self._idle.append((self._create(), time.monotonic(), False))
+                self._size += 1
+                CONNECTIONS_OPEN.inc()
             except Exception as e:
-                print(f"Failed to create a connection for the pool: {e}")
-                # Depending on requirements, you might want to raise an error
-                # if the pool cannot be fully populated.
+                CONNECTION_ERRORS.inc()
+                logger.warning(
+                    f"Failed to create a connection for the pool: {e}")
 
-        if self.available() == 0:
+        if min_size > 0 and not self._idle:
             raise ConnectionError(
                 "Failed to initialize any connections for the pool. "
                 "Please check connection parameters and network."
             )
 
+        start_metrics_server()
+
     def available(self) -> int:
-        """Returns the number of available connections in the pool."""
-        return self._pool.qsize()
+        """Returns the number of connections that can be had without waiting."""
+        with self._condition:
+            return len(self._idle) + self._pool_size - self._size
 
     def total(self) -> int:
-        """Returns the total number of connections in the pool."""
+        """Returns the maximum number of connections in the pool."""
         return self._pool_size
 
+    def size(self) -> int:
+        """Returns the number of open connections, idle or in use."""
+        return self._size
+
+    def close(self):
+        """Closes the idle connections. Connections in use are closed when they are returned."""
+        with self._condition:
+            idle, self._idle = self._idle, []
+            self._size -= len(idle)
+            self._closed = True
+        for connection, _, _ in idle:
+            self._close(connection)
+            CONNECTIONS_OPEN.dec()
+
     @contextmanager
-    def get_connection(self) -> ContextManager[Connector]:
+    def get_connection(self, timeout: Optional[float] = None) -> ContextManager[Connector]:
         """
         A context manager to get a connection from the pool.
         This is the recommended way to use a connection.
         It automatically gets a connection and releases it back to the pool.
 
+        Args:
+            timeout (float): Seconds to wait for a connection; defaults to `acquire_timeout`.
+
+        Raises:
+            TimeoutError: If no connection became available in time.
+
         Usage:
             with pool.get_connection() as conn:
                 conn.query(...)
         """
-        # The get() call will block until a connection is available.
-        connection = self._pool.get()
+        connection = self._checkout(timeout)
+        suspect = False
         try:
             # Yield the connection for the user to use
             yield connection
+        except BaseException:
+            # The connection may be broken; check it before it is used again
+            suspect = True
+            raise
         finally:
             # This block is guaranteed to execute, ensuring the connection
             # is always returned to the pool.
-            self._pool.put(connection)
+            self._checkin(connection, suspect)
+
+    def _checkout(self, timeout: Optional[float]) -> Connector:
+        start = time.monotonic()
+        connection = self._acquire(
+            timeout if timeout is not None else self._acquire_timeout)
+        CHECKOUT_WAIT.observe(time.monotonic() - start)
+        CONNECTIONS_IN_USE.inc()
+        return connection
+
+    def _checkin(self, connection: Connector, suspect: bool):
+        CONNECTIONS_IN_USE.dec()
+        self._release(connection, suspect)
+
+    def _acquire(self, timeout: Optional[float]) -> Connector:
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            with self._condition:
+                while True:
+                    self._reap_idle()
+                    if self._idle:
+                        connection, last_used, suspect = self._idle.pop()
+                        break
+                    if self._size < self._pool_size:
+                        # Reserve a place for a new connection
+                        self._size += 1
+                        connection = None
+                        break
+                    remaining = None if deadline is None else deadline - time.monotonic()
+                    if remaining is not None and remaining <= 0:
+                        raise TimeoutError(
+                            f"Timed out after {timeout} seconds waiting for a connection")
+                    self._condition.wait(remaining)
+
+            if connection is None:
+                try:
+                    connection = self._create()
+                    CONNECTIONS_OPEN.inc()
+                    return connection
+                except BaseException:
+                    CONNECTION_ERRORS.inc()
+                    self._discard(None)
+                    raise
+
+            if not suspect and time.monotonic() - last_used < self._validate_after:
+                return connection
+            if self._is_alive(connection):
+                return connection
+            logger.warning("Discarding broken connection")
+            CONNECTION_ERRORS.inc()
+            self._discard(connection)
+
+    def _release(self, connection: Connector, suspect: bool):
+        if self._closed:
+            self._discard(connection)
+            return
+        with self._condition:
+            self._idle.append((connection, time.monotonic(), suspect))
+            self._reap_idle()
+            self._condition.notify()
+
+    def _discard(self, connection: Optional[Connector]):
+        """Gives up a connection, or a place reserved for one."""
+        if connection is not None:
+            self._close(connection)
+            CONNECTIONS_OPEN.dec()
+        with self._condition:
+            self._size -= 1
+            self._condition.notify()
+
+    def _reap_idle(self):
+        """Closes connections that have been idle for too long. Must hold the lock."""
+        now = time.monotonic()
+        while self._idle and self._size > self._min_size and \
+                now - self._idle[0][1] >= self._max_idle_time:
+            connection, _, _ = self._idle.pop(0)
+            self._size -= 1
+            self._close(connection)
+            CONNECTIONS_OPEN.dec()
+
+    def _create(self) -> Connector:
+        connection = self._connection_factory()
+        if not connection:
+            raise ConnectionError("Failed to create a connection.")
+        return connection
+
+    @staticmethod
+    def _is_alive(connection: Connector) -> bool:
+        try:
+            connection.query([{"GetStatus": {}}])
+            return connection.last_query_ok()
+        except Exception as e:
+            logger.warning(f"Connection check failed: {e}")
+            return False
+
+    @staticmethod
+    def _close(connection: Connector):
+        try:
+            connection.close()
+        except Exception as e:
+            logger.debug(f"Failed to close connection: {e}")
 
     @contextmanager
     def get_utils(self) -> ContextManager[Utils]:
@@ -110,8 +310,13 @@ class ConnectionPool:
             Blobs
         """
         blobs = blobs if blobs is not None else []
-        with self.get_connection() as connection:
-            return connection.query(query, blobs, **kwargs)
+        with self.get_connection() as connection, \
+                _QueryMetrics(query, blobs) as query_metrics:
+            response, response_blobs = connection.query(
+                query, blobs, **kwargs)
+            query_metrics.done(response, response_blobs,
+                               ok=connection.last_query_ok())
+            return response, response_blobs
 
     def execute_query(self, query: str, blobs: Optional[list] = None, **kwargs):
         """
@@ -134,5 +339,192 @@ class ConnectionPool:
         See CommonLibrary.execute_query for details.
         """
         blobs = blobs if blobs is not None else []
-        with self.get_connection() as connection:
-            return execute_query(connection, query, blobs, **kwargs)
+        with self.get_connection() as connection, \
+                _QueryMetrics(query, blobs) as query_metrics:
+            status, response, response_blobs = execute_query(
+                connection, query, blobs, **kwargs)
+            query_metrics.done(response, response_blobs, ok=status == 0)
+            return status, response, response_blobs
+
+
+class AsyncConnectionPool:
+    """
+    An asyncio interface to a ConnectionPool, for use in async servers.
+
+    Blocking calls run in a thread pool with one thread per connection,
+    so they do not stall the event loop and concurrent requests overlap.
+    Requests beyond the size of the pool wait on the event loop, not in
+    a thread.
+    """
+
+    def __init__(self, pool: Optional[ConnectionPool] = None, **kwargs):
+        """
+        Initializes the async pool.
+
+        Args:
+            pool (ConnectionPool): The pool to use. If not given, one is created.
+            **kwargs: Arguments for the ConnectionPool, if one is created.
+        """
+        self._pool = pool if pool is not None else ConnectionPool(**kwargs)
+        self._executor = ThreadPoolExecutor(
+            max_workers=self._pool.total(),
+            thread_name_prefix="aperturedb-pool")
+        # Places in the pool; held while a connection is wanted or in use
+        self._places = asyncio.Semaphore(self._pool.total())
+
+    @property
+    def pool(self) -> ConnectionPool:
+        """The underlying ConnectionPool, for use from other threads."""
+        return self._pool
+
+    def close(self):
+        """Stops the threads and closes the idle connections."""
+        self._executor.shutdown(wait=False)
+        self._pool.close()
+
+    async def run_in_executor(self, fn: Callable, *args, **kwargs):
+        """Calls a blocking function in one of the pool's threads."""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            self._executor, functools.partial(fn, *args, **kwargs))
+
+    @asynccontextmanager
+    async def get_connection(self, timeout: Optional[float] = None) -> AsyncContextManager[Connector]:
+        """
+        An async context manager to get a connection from the pool.
+
+        The connection's methods block, so call them with `run_in_executor`,
+        or use `run` instead.
+
+        Args:
+            timeout (float): Seconds to wait for a connection; defaults to `acquire_timeout`.
+
+        Raises:
+            TimeoutError: If no connection became available in time.
+
+        Usage:
+            async with pool.get_connection() as conn:
+                response, blobs = await pool.run_in_executor(conn.query, query)
+        """
+        async with self._place(timeout) as remaining:
+            future = asyncio.get_running_loop().run_in_executor(
+                self._executor, self._pool._checkout, remaining)
+            try:
+                connection = await asyncio.shield(future)
+            except asyncio.CancelledError:
+                # Return the connection once the thread has it
+                future.add_done_callback(self._checkin_later)
+                raise
+            suspect = False
+            try:
+                yield connection
+            except BaseException:
+                suspect = True
+                raise
+            finally:
+                self._pool._checkin(connection, suspect)
+
+    async def run(self, fn: Callable, *args, timeout: Optional[float] = None, **kwargs):
+        """
+        Calls `fn(connection, *args, **kwargs)` in one of the pool's threads,
+        with a connection from the pool.
+
+        Usage:
+            schema = await pool.run(lambda conn: Utils(conn).get_schema())
+        """
+        def call(remaining):
+            with self._pool.get_connection(remaining) as connection:
+                return fn(connection, *args, **kwargs)
+
+        async with self._place(timeout) as remaining:
+            return await self.run_in_executor(call, remaining)
+
+    async def query(self, query: str, blobs: Optional[list] = None, **kwargs):
+        """
+        Execute a query without blocking the event loop.
+        See ConnectionPool.query for details.
+        """
+        async with self._place(None):
+            return await self.run_in_executor(self._pool.query, query, blobs, **kwargs)
+
+    async def execute_query(self, query: str, blobs: Optional[list] = None, **kwargs):
+        """
+        Execute a query without blocking the event loop.
+        See ConnectionPool.execute_query for details.
+        """
+        async with self._place(None):
+            return await self.run_in_executor(self._pool.execute_query, query, blobs, **kwargs)
+
+    @asynccontextmanager
+    async def _place(self, timeout: Optional[float]):
+        """Waits for a place in the pool, and yields the time left to get a connection."""
+        if timeout is None:
+            timeout = self._pool._acquire_timeout
+        start = time.monotonic()
+        try:
+            await asyncio.wait_for(self._places.acquire(), timeout)
+        except asyncio.TimeoutError:
+            raise TimeoutError(
+                f"Timed out after {timeout} seconds waiting for a connection")
+        try:
+            yield None if timeout is None else max(0, timeout - (time.monotonic() - start))
+        finally:
+            self._places.release()
+
+    def _checkin_later(self, future):
+        if not future.cancelled() and future.exception() is None:
+            self._pool._checkin(future.result(), False)
+
+
+class _QueryMetrics:
+    """Records metrics for a query. Exceptions count as errors."""
+
+    def __init__(self, query, blobs: list):
+        self.command = _first_command(query)
+        BYTES_SENT.inc((len(query) if isinstance(query, str) else 0) +
+                       sum(map(len, blobs)))
+        if isinstance(query, list):
+            COMMANDS_SENT.inc(len(query))
+
+    def __enter__(self):
+        self.start = time.monotonic()
+        return self
+
+    def done(self, response, blobs: list, ok: bool):
+        BYTES_RECEIVED.inc(sum(map(len, blobs or [])))
+        ENTITIES_RECEIVED.inc(_count_entities(response))
+        if not ok:
+            QUERY_ERRORS.labels(self.command).inc()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        QUERY_LATENCY.labels(self.command).observe(
+            time.monotonic() - self.start)
+        if exc_type is not None:
+            QUERY_ERRORS.labels(self.command).inc()
+
+
+_FIRST_COMMAND = re.compile(r'\s*\[\s*\{\s*"([^"]+)"')
+
+
+def _first_command(query) -> str:
+    """The name of the first command in a query, to label metrics"""
+    if isinstance(query, str):
+        # Rather than parse the whole query
+        match = _FIRST_COMMAND.match(query)
+        return match.group(1) if match else "unknown"
+    if isinstance(query, list) and query and isinstance(query[0], dict) and query[0]:
+        return next(iter(query[0]))
+    return "unknown"
+
+
+def _count_entities(response) -> int:
+    """The number of entities in a response, without walking them"""
+    if not isinstance(response, list):
+        return 0
+    n = 0
+    for result in response:
+        if isinstance(result, dict):
+            for body in result.values():
+                if isinstance(body, dict):
+                    n += len(body.get("entities") or ())
+    return n
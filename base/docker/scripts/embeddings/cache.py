@@ -0,0 +1,160 @@
+import hashlib
+import logging
+import os
+import sqlite3
+import threading
+import time
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# Most variables in one SQLite statement, for older versions of SQLite
+_MAX_VARIABLES = 500
+# Evict down to this fraction of the size limit, so as not to evict on every write
+_EVICT_TO = 0.9
+
+
+def input_key(kind: str, data: bytes) -> str:
+    """The cache key of an input, e.g. the UTF-8 of a text or the bytes of an image"""
+    h = hashlib.sha256(kind.encode("utf-8"))
+    h.update(b"\0")
+    h.update(data)
+    return h.hexdigest()
+
+
+class EmbeddingCache:
+    """Embeddings kept in an SQLite file on local disk, so that an input that
+    has been embedded before, in this process or another, is not embedded again.
+
+    Embeddings are keyed by the fingerprint of the model and a hash of the
+    input. When the vectors in the cache reach `max_bytes`, the least
+    recently used are evicted.
+
+    The cache can be shared by threads and by processes. It is only a
+    cache: if the file cannot be read or written, a warning is logged and
+    every input is treated as a miss.
+    """
+
+    def __init__(self, path: str, max_bytes: int = 0):
+        """
+        Args:
+            path: The SQLite file, which is created if it does not exist.
+            max_bytes: Size limit of the vectors in the cache; 0 for no limit.
+        """
+        self.path = path
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._db: Optional[sqlite3.Connection] = None
+        self._pid = None
+        self._bytes = None  # Estimated size of the vectors, if known
+
+    def _connect(self) -> sqlite3.Connection:
+        # A connection must not be used across a fork
+        if self._db is None or self._pid != os.getpid():
+            directory = os.path.dirname(os.path.abspath(self.path))
+            os.makedirs(directory, exist_ok=True)
+            db = sqlite3.connect(self.path, timeout=30,
+                                 check_same_thread=False, isolation_level=None)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+            db.execute("""
+                CREATE TABLE IF NOT EXISTS embeddings (
+                    fingerprint TEXT NOT NULL,
+                    key TEXT NOT NULL,
+                    dtype TEXT NOT NULL,
+                    vector BLOB NOT NULL,
+                    used REAL NOT NULL,
+                    PRIMARY KEY (fingerprint, key)
+                ) WITHOUT ROWID""")
+            db.execute(
+                "CREATE INDEX IF NOT EXISTS embeddings_used ON embeddings (used)")
+            self._db = db
+            self._pid = os.getpid()
+            self._bytes = None
+        return self._db
+
+    def get_many(self, fingerprint: str, keys: Sequence[str]) -> List[Optional[np.ndarray]]:
+        """Returns the cached vector for each key, or None if it is not cached"""
+        found: Dict[str, np.ndarray] = {}
+        unique_keys = list(dict.fromkeys(keys))
+        with self._lock:
+            try:
+                db = self._connect()
+                now = time.time()
+                for start in range(0, len(unique_keys), _MAX_VARIABLES):
+                    chunk = unique_keys[start:start + _MAX_VARIABLES]
+                    marks = ",".join("?" * len(chunk))
+                    rows = db.execute(
+                        f"SELECT key, dtype, vector FROM embeddings WHERE fingerprint = ? AND key IN ({marks})",
+                        [fingerprint, *chunk]).fetchall()
+                    for key, dtype, vector in rows:
+                        found[key] = np.frombuffer(vector, dtype=np.dtype(dtype)).copy()
+                    if rows:
+                        hits = [key for key, _, _ in rows]
+                        marks = ",".join("?" * len(hits))
+                        db.execute(
+                            f"UPDATE embeddings SET used = ? WHERE fingerprint = ? AND key IN ({marks})",
+                            [now, fingerprint, *hits])
+            except (sqlite3.Error, OSError) as e:
+                logger.warning(f"Failed to read embedding cache {self.path}: {e}")
+                return [None] * len(keys)
+        logger.debug(f"Embedding cache: {len(found)} of {len(unique_keys)} inputs found")
+        return [found.get(key) for key in keys]
+
+    def put_many(self, fingerprint: str, items: Sequence[Tuple[str, np.ndarray]]) -> None:
+        """Adds (key, vector) pairs to the cache, evicting others if it is full"""
+        if not items:
+            return
+        rows = [(fingerprint, key, vector.dtype.str, vector.tobytes(), time.time())
+                for key, vector in items]
+        with self._lock:
+            try:
+                db = self._connect()
+                with db:
+                    db.execute("BEGIN")
+                    db.executemany(
+                        "INSERT OR REPLACE INTO embeddings (fingerprint, key, dtype, vector, used) VALUES (?, ?, ?, ?, ?)",
+                        rows)
+                if self._bytes is not None:
+                    self._bytes += sum(len(row[3]) for row in rows)
+                self._evict()
+            except (sqlite3.Error, OSError) as e:
+                logger.warning(f"Failed to write embedding cache {self.path}: {e}")
+
+    def _evict(self) -> None:
+        """Evict the least recently used vectors if the cache is over its limit"""
+        if not self.max_bytes:
+            return
+        if self._bytes is not None and self._bytes <= self.max_bytes:
+            return
+        # Other processes may have added to the cache, so count again
+        db = self._db
+        self._bytes = db.execute(
+            "SELECT COALESCE(SUM(LENGTH(vector)), 0) FROM embeddings").fetchone()[0]
+        if self._bytes <= self.max_bytes:
+            return
+        target = int(self.max_bytes * _EVICT_TO)
+        evicted = 0
+        with db:
+            db.execute("BEGIN")
+            rows = db.execute(
+                "SELECT fingerprint, key, LENGTH(vector) FROM embeddings ORDER BY used")
+            victims = []
+            for fingerprint, key, size in rows:
+                if self._bytes - evicted <= target:
+                    break
+                victims.append((fingerprint, key))
+                evicted += size
+            db.executemany(
+                "DELETE FROM embeddings WHERE fingerprint = ? AND key = ?", victims)
+        self._bytes -= evicted
+        logger.info(
+            f"Evicted {len(victims)} embeddings ({evicted} bytes) from cache {self.path}")
+
+    def close(self) -> None:
+        with self._lock:
+            if self._db is not None and self._pid == os.getpid():
+                self._db.close()
+            self._db = None
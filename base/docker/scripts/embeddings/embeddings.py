@@ -1,11 +1,20 @@
 import torch
 import numpy as np
 import hashlib
-from typing import List, Union, Literal, Optional
+from typing import Any, Callable, Dict, List, Union, Literal, Optional, Tuple
+from collections import OrderedDict
+from dataclasses import dataclass, field
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import json
+import os
+import tempfile
 import cv2
 from PIL import Image
 import logging
 from aperturedb.Connector import Connector
+from wf_argparse import validate
+from .cache import EmbeddingCache, input_key
 import inspect
 
 # Set up logging
@@ -29,6 +38,267 @@ DEFAULT_MODEL = SUPPORTED_MODELS[0]
 FINGERPRINT_TEXT = "ApertureDB unifies multimodal data, knowledge graphs, and vector search into a single database solution for rapid AI deployments at enterprise scale."
 
 
+@dataclass
+class LoadedModel:
+    """The weights and helpers for one loaded model, shared between Embedder instances."""
+    model: Any
+    preprocess: Optional[Callable] = None
+    tokenizer: Optional[Callable] = None
+    context_length: Optional[int] = None
+    n_bytes: int = 0  # Estimated memory footprint, used for eviction
+    # Memoized results of inference that depend only on the model
+    dimensions: Optional[int] = None
+    fingerprints: Dict[str, np.ndarray] = field(default_factory=dict)
+    fingerprint_hashes: Dict[str, str] = field(default_factory=dict)
+    lock: threading.RLock = field(default_factory=threading.RLock)
+
+
+def _estimate_model_bytes(model) -> int:
+    """Estimate the memory used by a model's parameters and buffers.
+
+    Models that are not torch modules (e.g. gpt4all) are reported as 0 bytes,
+    so they only count towards the model limit.
+    """
+    if not isinstance(model, torch.nn.Module):
+        return 0
+    tensors = list(model.parameters()) + list(model.buffers())
+    return sum(t.numel() * t.element_size() for t in tensors)
+
+
+class ModelRegistry:
+    """A process-wide, thread-safe cache of loaded models.
+
+    Models are keyed by (provider, model name, pretrained corpus, device),
+    so Embedder instances with the same specification share the same weights.
+    When there are more than `max_models` models, or their estimated size exceeds
+    `max_bytes` (0 means no limit), the least recently used models are evicted.
+    An evicted model stays alive for as long as an Embedder still refers to it.
+    """
+
+    def __init__(self, max_models: int = 4, max_bytes: int = 0):
+        if max_models <= 0:
+            raise ValueError("max_models must be greater than 0.")
+        self.max_models = max_models
+        self.max_bytes = max_bytes
+        self._models: "OrderedDict[Tuple, LoadedModel]" = OrderedDict()
+        self._lock = threading.Lock()
+        # One lock per model being loaded, so that concurrent requests for the
+        # same model load it once, without blocking requests for other models.
+        self._loading_locks: Dict[Tuple, threading.Lock] = {}
+
+    def __len__(self) -> int:
+        return len(self._models)
+
+    def __contains__(self, key: Tuple) -> bool:
+        return key in self._models
+
+    def total_bytes(self) -> int:
+        """Returns the estimated memory used by all cached models."""
+        with self._lock:
+            return sum(m.n_bytes for m in self._models.values())
+
+    def get(self, key: Tuple, loader: Callable[[], LoadedModel]) -> LoadedModel:
+        """Return the cached model for `key`, calling `loader` to load it if necessary."""
+        with self._lock:
+            if key in self._models:
+                self._models.move_to_end(key)
+                return self._models[key]
+            key_lock = self._loading_locks.setdefault(key, threading.Lock())
+
+        with key_lock:
+            with self._lock:
+                # Another thread may have loaded it while we were waiting
+                if key in self._models:
+                    self._models.move_to_end(key)
+                    return self._models[key]
+
+            try:
+                logger.info(f"Loading model {key}")
+                loaded = loader()
+                if not loaded.n_bytes:
+                    loaded.n_bytes = _estimate_model_bytes(loaded.model)
+                logger.info(
+                    f"Loaded model {key}: {loaded.n_bytes / 2**20:.1f} MiB")
+
+                with self._lock:
+                    self._models[key] = loaded
+                    self._evict(keep=key)
+                return loaded
+            finally:
+                # Also if the load failed, so that the lock is not kept forever
+                with self._lock:
+                    self._loading_locks.pop(key, None)
+
+    def clear(self) -> None:
+        """Drop all cached models."""
+        with self._lock:
+            self._models.clear()
+        self._release_memory()
+
+    def _evict(self, keep: Tuple) -> None:
+        """Evict least recently used models until within limits. Call with the lock held."""
+        evicted = False
+        while len(self._models) > 1:
+            total = sum(m.n_bytes for m in self._models.values())
+            if len(self._models) <= self.max_models and \
+                    (not self.max_bytes or total <= self.max_bytes):
+                break
+            key = next(iter(self._models))
+            if key == keep:
+                break
+            del self._models[key]
+            evicted = True
+            logger.info(f"Evicted model {key} from registry")
+        if evicted:
+            self._release_memory()
+
+    @staticmethod
+    def _release_memory() -> None:
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+
+
+MODEL_REGISTRY = ModelRegistry(
+    max_models=validate("positive_int", envar="EMBEDDINGS_MAX_MODELS",
+                        default="4"),
+    max_bytes=validate("non_negative_int", envar="EMBEDDINGS_MAX_MODEL_BYTES",
+                       default="0"))
+
+
+class ModelMetadataCache:
+    """A small JSON file that remembers model metadata between processes.
+
+    Dimensions and fingerprint hashes are keyed by model specification and device,
+    so that starting a workflow does not need to run inference just to learn them.
+    If no path is configured, nothing is persisted.
+    """
+
+    def __init__(self, path: Optional[str] = None):
+        self.path = path
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> dict:
+        """Returns the cached metadata for a model, or an empty dict."""
+        if not self.path:
+            return {}
+        with self._lock:
+            return self._read().get(key, {})
+
+    def update(self, key: str, **values) -> None:
+        """Merges values into the cached metadata for a model."""
+        if not self.path:
+            return
+        with self._lock:
+            data = self._read()
+            data.setdefault(key, {}).update(values)
+            try:
+                directory = os.path.dirname(os.path.abspath(self.path))
+                os.makedirs(directory, exist_ok=True)
+                # Write atomically, in case another process is reading
+                fd, temp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+                with os.fdopen(fd, "w") as f:
+                    json.dump(data, f, indent=2, sort_keys=True)
+                os.replace(temp_path, self.path)
+            except OSError as e:
+                logger.warning(
+                    f"Failed to write model metadata cache {self.path}: {e}")
+
+    def _read(self) -> dict:
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+        except (OSError, ValueError) as e:
+            logger.warning(
+                f"Ignoring unreadable model metadata cache {self.path}: {e}")
+            return {}
+
+
+MODEL_METADATA_CACHE = ModelMetadataCache(
+    validate("file_path", envar="EMBEDDINGS_METADATA_CACHE", allow_unset=True))
+
+
+# Defaults for splitting large inputs into batches for the model.
+# A budget of 0 means that only the batch size applies.
+DEFAULT_BATCH_SIZE = validate(
+    "positive_int", envar="EMBEDDINGS_BATCH_SIZE", default="64")
+DEFAULT_MAX_BATCH_PIXELS = validate(
+    "non_negative_int", envar="EMBEDDINGS_MAX_BATCH_PIXELS", default="0")
+DEFAULT_MAX_BATCH_TOKENS = validate(
+    "non_negative_int", envar="EMBEDDINGS_MAX_BATCH_TOKENS", default="0")
+
+# Optional cache of embeddings on local disk, shared by all models
+_EMBEDDING_CACHE_PATH = validate(
+    "file_path", envar="EMBEDDINGS_CACHE", allow_unset=True)
+EMBEDDING_CACHE = EmbeddingCache(
+    _EMBEDDING_CACHE_PATH,
+    max_bytes=validate("non_negative_int", envar="EMBEDDINGS_CACHE_MAX_BYTES",
+                       default=str(1024 * 1024 * 1024))) if _EMBEDDING_CACHE_PATH else None
+
+# Number of threads used to decode and preprocess images; 0 to do it in the calling thread.
+# OpenCV and PyTorch release the GIL, so threads run in parallel.
+DEFAULT_PREPROCESS_WORKERS = validate(
+    "non_negative_int", envar="EMBEDDINGS_PREPROCESS_WORKERS", default="0")
+
+# Preprocessing threads, shared by all Embedders with the same number of workers,
+# as services create an Embedder for each request
+_preprocess_pools: Dict[int, ThreadPoolExecutor] = {}
+_preprocess_pools_lock = threading.Lock()
+
+
+def _preprocess_pool(workers: int) -> ThreadPoolExecutor:
+    """Returns the process-wide pool of preprocessing threads of this size."""
+    with _preprocess_pools_lock:
+        pool = _preprocess_pools.get(workers)
+        if pool is None:
+            pool = _preprocess_pools[workers] = ThreadPoolExecutor(
+                max_workers=workers, thread_name_prefix="preprocess")
+        return pool
+
+# Transforms that do nothing to an RGB image that is already at the model's resolution,
+# apart from conversion to a tensor
+_NATIVE_RESOLUTION_NO_OPS = {
+    "Resize", "CenterCrop", "ToTensor", "MaybeToTensor", "MaybeConvertMode",
+    "_convert_to_rgb", "_convert_image_to_rgb"}
+
+
+def _native_resolution_normalization(preprocess, image_size: Optional[Tuple[int, int]]) -> Optional[Tuple[List[float], List[float]]]:
+    """Works out whether preprocessing an image at the model's resolution only scales and normalizes it.
+
+    Returns:
+        (mean, std) of the normalization, or None if the preprocessing does anything else.
+    """
+    if image_size is None:
+        return None
+    normalization = None
+    for transform in getattr(preprocess, "transforms", None) or []:
+        name = getattr(transform, "__name__", None) or type(transform).__name__
+        if name == "Normalize" and normalization is None:
+            normalization = (list(transform.mean), list(transform.std))
+        elif name == "Resize":
+            size = transform.size
+            if isinstance(size, (list, tuple)) and len(size) == 1:
+                size = size[0]
+            if size not in (min(image_size), tuple(image_size), list(image_size)):
+                return None
+        elif name == "CenterCrop":
+            if tuple(transform.size) != tuple(image_size):
+                return None
+        elif name not in _NATIVE_RESOLUTION_NO_OPS:
+            return None
+    return normalization
+
+
+def _is_out_of_memory(e: Exception) -> bool:
+    """Is this exception the model running out of (GPU or CPU) memory?"""
+    if isinstance(e, MemoryError):
+        return True
+    message = str(e).lower()
+    return isinstance(e, RuntimeError) and \
+        ("out of memory" in message or "can't allocate memory" in message)
+
+
 class DescriptorSetNotFoundError(Exception):
     """Exception raised when a descriptor set is not found."""
 
@@ -66,7 +336,11 @@ class Embedder():
                  model_name: str = None,
                  pretrained: str = None,
                  descriptor_set: str = None,
-                 device: Optional[Literal["cpu", "cuda"]] = None):
+                 device: Optional[Literal["cpu", "cuda"]] = None,
+                 batch_size: Optional[int] = None,
+                 max_batch_pixels: Optional[int] = None,
+                 max_batch_tokens: Optional[int] = None,
+                 preprocess_workers: Optional[int] = None):
         """Initialize the Embedder with a model specification.
 
         Args:
@@ -75,6 +349,10 @@ class Embedder():
             pretrained (str): The pretrained corpus, e.g., "laion2b_s34b_b79k". (Optional for CLIP)
             descriptor_set (str): The name of the descriptor set to use for this embedder.
             device (str): The device to run the model on. Default is to auto-detect.
+            batch_size (int): The maximum number of inputs passed to the model at once. Default from EMBEDDINGS_BATCH_SIZE.
+            max_batch_pixels (int): The maximum number of pixels (images × height × width) passed to the model at once; 0 for no limit. Default from EMBEDDINGS_MAX_BATCH_PIXELS.
+            max_batch_tokens (int): The maximum number of tokens (texts × longest text) passed to the model at once; 0 for no limit. Default from EMBEDDINGS_MAX_BATCH_TOKENS.
+            preprocess_workers (int): The number of threads used to decode and preprocess images; 0 for none. Default from EMBEDDINGS_PREPROCESS_WORKERS.
         """
         assert provider in self.supported_providers, \
             f"Unsupported provider: {provider}. {self.supported_providers=}"
@@ -100,6 +378,14 @@ class Embedder():
         # https://github.com/nomic-ai/gpt4all/tree/main/gpt4all-bindings/python
         self.gpt4all_device_name = "gpu" if device_name == "cuda" else "intel"
 
+        self.batch_size = batch_size or DEFAULT_BATCH_SIZE
+        self.max_batch_pixels = DEFAULT_MAX_BATCH_PIXELS if max_batch_pixels is None else max_batch_pixels
+        self.max_batch_tokens = DEFAULT_MAX_BATCH_TOKENS if max_batch_tokens is None else max_batch_tokens
+        # Reduced if the model runs out of memory
+        self._adaptive_batch_size = self.batch_size
+
+        self.preprocess_workers = DEFAULT_PREPROCESS_WORKERS if preprocess_workers is None else preprocess_workers
+
         self._load_model()  # sets self.preprocess, self.tokenizer
 
     @staticmethod
@@ -121,38 +407,60 @@ class Embedder():
         pretrained = parts[2] if len(parts) > 2 else None
         return dict(provider=provider, model_name=model_name, pretrained=pretrained)
 
+    @property
+    def _registry_key(self) -> Tuple:
+        return (self.provider, self.model_name, self.pretrained, str(self.device))
+
     def _load_model(self):
-        """Load the model based on the provider, model name, and pretrained corpus."""
-        # TODO: Consider caching this so that multiple instances of Embedder
-        # with the same provider, model name, and pretrained corpus can share the same model.
+        """Load the model based on the provider, model name, and pretrained corpus.
+
+        Models are shared through MODEL_REGISTRY, so that multiple instances of Embedder
+        with the same provider, model name, pretrained corpus, and device share the same weights.
+        """
+        loaded = MODEL_REGISTRY.get(self._registry_key, self._create_model)
+        self._loaded = loaded
+        self.model = loaded.model
+        self.preprocess = loaded.preprocess
+        self.tokenizer = loaded.tokenizer
+        self.context_length = loaded.context_length
+        self._native_normalization = _native_resolution_normalization(
+            self.preprocess, self.image_size)
+
+    def _create_model(self) -> LoadedModel:
+        """Create the model from scratch. Use `_load_model` instead."""
         if self.provider == "openclip":
             import open_clip
-            self.model, self.preprocess, _ = open_clip.create_model_and_transforms(
+            # The second transform is for training, with random crops
+            model, _, preprocess = open_clip.create_model_and_transforms(
                 model_name=self.model_name,
                 pretrained=self.pretrained,
                 device=self.device
             )
-            self.model.eval()
-            self.tokenizer = open_clip.get_tokenizer(self.model_name)
-            self.context_length = inspect.signature(
-                self.tokenizer.__call__).parameters["context_length"].default
-
+            model.eval()
+            tokenizer = open_clip.get_tokenizer(self.model_name)
+            context_length = inspect.signature(
+                tokenizer.__call__).parameters["context_length"].default
+            return LoadedModel(model=model, preprocess=preprocess,
+                               tokenizer=tokenizer, context_length=context_length)
         elif self.provider == "clip":
             import clip
             model_id = self.model_name
             # CLIP assumes pretrained corpus is "openai"
-            self.model, self.preprocess = clip.load(
+            model, preprocess = clip.load(
                 model_id, device=self.device)
-            self.model.eval()
-            self.tokenizer = lambda x: clip.tokenize(x, truncate=True)
-            self.context_length = inspect.signature(
+            model.eval()
+            context_length = inspect.signature(
                 clip.tokenize).parameters["context_length"].default
+            return LoadedModel(model=model, preprocess=preprocess,
+                               tokenizer=lambda x: clip.tokenize(
+                                   x, truncate=True),
+                               context_length=context_length)
         elif self.provider == "gpt4all":
             from gpt4all import Embed4All
-            self.model = Embed4All(model_name=self.model_name)
+            return LoadedModel(model=Embed4All(model_name=self.model_name))
         elif self.provider == "sentence-transformers":
             from sentence_transformers import SentenceTransformer
-            self.model = SentenceTransformer(self.model_name)
+            return LoadedModel(model=SentenceTransformer(self.model_name))
         else:
             raise ValueError(f"Unsupported provider: {self.provider}")
 
@@ -360,7 +668,43 @@ class Embedder():
         return self.embed_texts([text])[0]
 
     def embed_texts(self, texts: List[str]) -> List[np.ndarray]:
+        """Embed a list of texts of any length.
+
+        The texts are passed to the model in batches, limited by `batch_size` and `max_batch_tokens`.
+        Texts of similar length are batched together, so that short texts are not padded to the
+        length of a long one.
+        If EMBEDDINGS_CACHE is set, texts that have been embedded before are taken from the cache.
+
+        Args:
+            texts (List[str]): The texts to embed.
+
+        Returns:
+            List[np.ndarray]: A list of embedded vectors for the texts, in the order of the texts.
+        """
+        return self._cached("text", texts, [text.encode("utf-8") for text in texts],
+                            self._embed_texts)
+
+    def _embed_texts(self, texts: List[str]) -> List[np.ndarray]:
         logger.debug(f"Embedding {len(texts)} texts on {self.device}")
+        costs = [self.estimate_tokens(text) for text in texts]
+        order = sorted(range(len(texts)), key=costs.__getitem__)
+        vectors = self._run_batched([texts[i] for i in order],
+                                    [costs[i] for i in order],
+                                    self.max_batch_tokens, self._embed_text_batch)
+        results = [None] * len(texts)
+        for i, vector in zip(order, vectors):
+            results[i] = vector
+        return results
+
+    def estimate_tokens(self, text: str) -> int:
+        """Estimate the number of tokens the model will see for a text."""
+        if self.context_length:
+            # CLIP-style tokenizers pad every text to the context length
+            return self.context_length
+        # Roughly four characters per token for English text
+        return len(text) // 4 + 1
+
+    def _embed_text_batch(self, texts: List[str]) -> List[np.ndarray]:
         if self.provider == "gpt4all":
             return [np.array(embedding, dtype=np.float32) for embedding in self.model.embed(texts)]
         elif self.provider == "sentence-transformers":
@@ -391,7 +735,10 @@ class Embedder():
         return self.embed_images([b])[0]
 
     def embed_images(self, images: List[bytes]) -> List[np.ndarray]:
-        """Embed a list of images.
+        """Embed a list of images of any length.
+
+        The images are decoded and passed to the model in batches, limited by `batch_size` and `max_batch_pixels`.
+        If EMBEDDINGS_CACHE is set, images that have been embedded before are taken from the cache.
 
         Args:
             images (List[bytes]): A list of image data in bytes format (JPEG/PNG).
@@ -399,28 +746,39 @@ class Embedder():
         Returns:
             List[np.ndarray]: A list of embedded vectors for the images.
         """
+        return self._cached("image", images, images, self._embed_images)
 
+    def _embed_images(self, images: List[bytes]) -> List[np.ndarray]:
         logger.debug(f"Embedding {len(images)} images on {self.device}")
 
-        preprocessed = []
-
-        for i, b in enumerate(images):
-            try:
-                assert isinstance(b, bytes), \
-                    f"Image {i} must be bytes, got {type(b)}"
-                nparr = np.frombuffer(b, np.uint8)
-                image = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
-                image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
-                image = Image.fromarray(image)
-                tensor = self.preprocess(image)  # shape [C, H, W]
-                preprocessed.append(tensor)
-            except Exception as e:
-                raise ValueError(
-                    f"Failed to preprocess image {i}: {e}. Ensure the image is valid and in a supported format.")
+        height, width = self.image_size or (0, 0)
+        costs = [height * width] * len(images)
+        return self._run_batched(list(enumerate(images)), costs, self.max_batch_pixels, self._embed_image_batch)
 
-        # Stack and move to device
-        batch = torch.stack(preprocessed, dim=0).to(
-            self.device)  # shape [B, C, H, W]
+    @property
+    def image_size(self) -> Optional[Tuple[int, int]]:
+        """The (height, width) of the images that the model takes as input, if known."""
+        visual = getattr(self.model, "visual", None)
+        size = getattr(visual, "image_size", None) or \
+            getattr(visual, "input_resolution", None)
+        if size is None:
+            return None
+        if isinstance(size, int):
+            return (size, size)
+        return tuple(size)
+
+    def _embed_image_batch(self, indexed_images: List[Tuple[int, bytes]]) -> List[np.ndarray]:
+        images = self._map_preprocess(self._decode_image, indexed_images)
+
+        if self._native_normalization is not None and \
+                all(image.shape[:2] == self.image_size for image in images):
+            batch = self._normalize_native(images)  # shape [B, C, H, W]
+        else:
+            preprocessed = self._map_preprocess(
+                lambda image: self.preprocess(Image.fromarray(image)), images)  # shape [C, H, W]
+            # Stack and move to device
+            batch = torch.stack(preprocessed, dim=0).to(
+                self.device)  # shape [B, C, H, W]
 
         with torch.no_grad():
             features = self.model.encode_image(batch)  # shape [B, D]
@@ -431,18 +789,164 @@ class Embedder():
             f"Expected all embeddings to have {self.dimensions} dimensions, got {[f.shape[0] for f in features]}"
         return features
 
+    @staticmethod
+    def _decode_image(indexed_image: Tuple[int, bytes]) -> np.ndarray:
+        """Decode an image to an RGB array of shape [H, W, C]."""
+        i, b = indexed_image
+        try:
+            assert isinstance(b, bytes), \
+                f"Image {i} must be bytes, got {type(b)}"
+            nparr = np.frombuffer(b, np.uint8)
+            image = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
+            return cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+        except Exception as e:
+            raise ValueError(
+                f"Failed to preprocess image {i}: {e}. Ensure the image is valid and in a supported format.")
+
+    def _map_preprocess(self, fn: Callable, items: list) -> list:
+        """Apply fn to each item, using the preprocessing threads if there are any."""
+        if self.preprocess_workers == 0 or len(items) < 2:
+            return [fn(item) for item in items]
+        return list(_preprocess_pool(self.preprocess_workers).map(fn, items))
+
+    def _normalize_native(self, images: List[np.ndarray]) -> torch.Tensor:
+        """Preprocess images that are already at the model's resolution, without going through PIL.
+
+        This is equivalent to the model's preprocessing, which only scales and normalizes such images.
+        """
+        mean, std = self._native_normalization
+        # Move as uint8 to reduce the transfer to the device
+        batch = torch.from_numpy(np.stack(images)).to(self.device)  # shape [B, H, W, C]
+        batch = batch.permute(0, 3, 1, 2).float().div_(255)  # shape [B, C, H, W]
+        mean = torch.tensor(mean, device=self.device).view(1, -1, 1, 1)
+        std = torch.tensor(std, device=self.device).view(1, -1, 1, 1)
+        return batch.sub_(mean).div_(std)
+
+    def _cached(self,
+                kind: str,
+                items: list,
+                data: List[bytes],
+                embed: Callable[[list], List[np.ndarray]]) -> List[np.ndarray]:
+        """Embed items, taking those that have been embedded before from EMBEDDING_CACHE.
+
+        Only the misses are passed to `embed`, and an input that occurs more than once is only
+        embedded once.
+        """
+        if EMBEDDING_CACHE is None or not items:
+            return embed(items)
+        fingerprint = self.fingerprint_hash()
+        keys = [input_key(kind, d) for d in data]
+        results = EMBEDDING_CACHE.get_many(fingerprint, keys)
+        # The first item for each key that is not cached
+        misses = {}
+        for i, (key, result) in enumerate(zip(keys, results)):
+            if result is None:
+                misses.setdefault(key, i)
+        if misses:
+            vectors = embed([items[i] for i in misses.values()])
+            missed = dict(zip(misses, vectors))
+            results = [missed[key] if result is None else result
+                       for key, result in zip(keys, results)]
+            EMBEDDING_CACHE.put_many(fingerprint, list(missed.items()))
+        return results
+
+    def _run_batched(self,
+                     items: list,
+                     costs: List[int],
+                     budget: int,
+                     embed_batch: Callable[[list], List[np.ndarray]]) -> List[np.ndarray]:
+        """Split items into batches and embed each batch.
+
+        A batch is limited to the current batch size, and the cost of a batch
+        (number of items × largest item cost) is limited to `budget`, unless it is 0.
+        If the model runs out of memory, the batch size is halved and the batch is retried.
+        The reduced batch size is kept for later calls.
+        """
+        results = []
+        start = 0
+        while start < len(items):
+            end = self._batch_end(costs, start, budget)
+            try:
+                results.extend(embed_batch(items[start:end]))
+            except Exception as e:
+                if not _is_out_of_memory(e) or end - start == 1:
+                    raise
+                self._adaptive_batch_size = max(1, (end - start) // 2)
+                logger.warning(
+                    f"Out of memory embedding {end - start} inputs on {self.device}; reducing batch size to {self._adaptive_batch_size}")
+                ModelRegistry._release_memory()
+                continue
+            start = end
+        return results
+
+    def _batch_end(self, costs: List[int], start: int, budget: int) -> int:
+        """Returns the end of the batch that starts at `start`."""
+        end = start
+        widest = 0
+        while end < len(costs) and end - start < self._adaptive_batch_size:
+            candidate = max(widest, costs[end])
+            # Always take at least one item, even if it is over budget
+            if budget and end > start and candidate * (end - start + 1) > budget:
+                break
+            widest = candidate
+            end += 1
+        return end
+
+    @property
+    def _metadata_key(self) -> str:
+        return f"{self.model_spec} {self.device}"
+
     def fingerprint(self, canonical_text: str = FINGERPRINT_TEXT) -> np.ndarray:
-        result = self.embed_text(canonical_text)
-        return result
+        """Embed the canonical text. This is computed once per loaded model."""
+        loaded = self._loaded
+        with loaded.lock:
+            if canonical_text not in loaded.fingerprints:
+                # Not cached, as the cache is keyed by the fingerprint
+                loaded.fingerprints[canonical_text] = self._embed_texts(
+                    [canonical_text])[0]
+            return loaded.fingerprints[canonical_text].copy()
 
     def fingerprint_hash(self, canonical_text: str = FINGERPRINT_TEXT) -> str:
-        vec = self.fingerprint(canonical_text)
-        return hashlib.sha256(vec.tobytes()).hexdigest()
+        """Hash of the fingerprint. This is computed once per loaded model,
+        and persisted in MODEL_METADATA_CACHE if that is configured."""
+        loaded = self._loaded
+        with loaded.lock:
+            if canonical_text not in loaded.fingerprint_hashes:
+                text_key = hashlib.sha256(
+                    canonical_text.encode("utf-8")).hexdigest()
+                persisted = MODEL_METADATA_CACHE.get(
+                    self._metadata_key).get("fingerprint_hashes", {})
+                if text_key in persisted:
+                    result = persisted[text_key]
+                else:
+                    vec = self.fingerprint(canonical_text)
+                    result = hashlib.sha256(vec.tobytes()).hexdigest()
+                    MODEL_METADATA_CACHE.update(
+                        self._metadata_key,
+                        fingerprint_hashes={**persisted, text_key: result})
+                loaded.fingerprint_hashes[canonical_text] = result
+            return loaded.fingerprint_hashes[canonical_text]
 
     @property
     def dimensions(self) -> int:
+        loaded = self._loaded
+        if loaded.dimensions is None:
+            with loaded.lock:
+                if loaded.dimensions is None:
+                    loaded.dimensions = self._compute_dimensions()
+        return loaded.dimensions
+
+    def _compute_dimensions(self) -> int:
         if self.provider == "gpt4all":
-            return np.array(self.model.embed(FINGERPRINT_TEXT), dtype=np.float32).shape[0]
+            # gpt4all does not expose the dimensions, so embed something
+            persisted = MODEL_METADATA_CACHE.get(
+                self._metadata_key).get("dimensions")
+            if persisted:
+                return persisted
+            dimensions = self.fingerprint().shape[0]
+            MODEL_METADATA_CACHE.update(
+                self._metadata_key, dimensions=dimensions)
+            return dimensions
         elif self.provider == "sentence-transformers":
             return self.model.get_sentence_embedding_dimension()
         return self.model.visual.output_dim if hasattr(self.model, 'visual') else self.model.output_dim
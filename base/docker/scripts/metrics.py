@@ -0,0 +1,37 @@
+import logging
+import os
+import threading
+
+from prometheus_client import start_http_server
+
+logger = logging.getLogger(__name__)
+
+_lock = threading.Lock()
+_started = False
+
+
+def start_metrics_server() -> bool:
+    """Serve Prometheus metrics on PROMETHEUS_PORT, for the status server to scrape.
+
+    This is safe to call more than once, and does nothing if PROMETHEUS_PORT is not set,
+    say outside a workflow container.
+
+    Returns:
+        True if metrics are being served by this process.
+    """
+    global _started
+    with _lock:
+        if _started:
+            return True
+        port = os.environ.get("PROMETHEUS_PORT")
+        if not port:
+            return False
+        try:
+            start_http_server(int(port))
+        except OSError as e:
+            # Probably the application already serves metrics on this port
+            logger.info(f"Not serving metrics on port {port}: {e}")
+            return False
+        _started = True
+        logger.info(f"Serving metrics on port {port}")
+        return True
@@ -0,0 +1,74 @@
+from typing import Iterable, Iterator, TypeVar
+import logging
+import queue
+import threading
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+_DONE = object()
+
+
+class _Error:
+    """An exception raised by the producer, to be raised again by the consumer"""
+
+    def __init__(self, error: BaseException):
+        self.error = error
+
+
+def prefetch(items: Iterable[T], depth: int = 1) -> Iterator[T]:
+    """Yields the items of an iterable, which is run on a background thread
+    up to `depth` items ahead of the consumer.
+
+    This is meant for reading pages from the database while the last page
+    is processed, so that neither waits for the other. The iterable runs
+    on another thread, so anything it uses, such as a database connection,
+    must not be used by the consumer at the same time.
+
+    An exception raised by the iterable is raised by this generator when
+    the consumer reaches it. If the consumer stops early, the iterable is
+    stopped after the item that it is producing.
+
+    Args:
+        items: The iterable to run in the background.
+        depth: Maximum number of items waiting for the consumer; 0 to run
+            the iterable in the calling thread.
+    """
+    if depth <= 0:
+        yield from items
+        return
+
+    q = queue.Queue(maxsize=depth)
+    stop = threading.Event()
+
+    def run():
+        try:
+            for item in items:
+                q.put(item)
+                if stop.is_set():
+                    return
+        except BaseException as e:
+            q.put(_Error(e))
+            return
+        q.put(_DONE)
+
+    thread = threading.Thread(target=run, name="prefetch", daemon=True)
+    thread.start()
+    try:
+        while True:
+            item = q.get()
+            if item is _DONE:
+                return
+            if isinstance(item, _Error):
+                raise item.error
+            yield item
+    finally:
+        stop.set()
+        # Make room for the producer, in case it is waiting to put an item
+        while thread.is_alive():
+            try:
+                q.get(timeout=0.1)
+            except queue.Empty:
+                pass
+        thread.join()
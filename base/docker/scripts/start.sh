@@ -23,7 +23,8 @@ S3LOGFILE="upload_s3.log"
 WORKFLOW_VERSION=$(cat /app/workflow_version)
 STATUS_SERVER_HOSTNAME=$(hostname -f)
 STATUS_SERVER_PORT=8080
-PROMETHEUS_PORT=8001
+# Exported so that applications can serve metrics for the status server
+export PROMETHEUS_PORT=8001
 STATUS_SCRIPT=/app/status_tools.py
 
 # Timing and URL variables (set during execution)
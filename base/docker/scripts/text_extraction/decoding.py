@@ -0,0 +1,106 @@
+""" Choose the character encoding of a document and decode it a piece at a time. """
+
+from bs4.dammit import EncodingDetector
+from typing import Iterator, Optional
+import codecs
+import logging
+
+logger = logging.getLogger(__name__)
+
+try:
+    import charset_normalizer
+except ImportError:  # Only used for documents that say nothing of their encoding
+    charset_normalizer = None
+
+DECODE_CHUNK_BYTES = 64 * 1024
+# How much of a document to look at to guess its encoding
+DETECTION_BYTES = 64 * 1024
+FALLBACK_ENCODING = "windows-1252"
+
+_BOMS = [
+    (codecs.BOM_UTF32_LE, "utf-32"),  # before UTF-16 LE, which it starts with
+    (codecs.BOM_UTF32_BE, "utf-32"),
+    (codecs.BOM_UTF8, "utf-8-sig"),
+    (codecs.BOM_UTF16_LE, "utf-16"),
+    (codecs.BOM_UTF16_BE, "utf-16"),
+]
+
+
+def _known_encoding(encoding: Optional[str]) -> Optional[str]:
+    """The Python name of an encoding, or None if Python does not know it"""
+    if not encoding:
+        return None
+    try:
+        return codecs.lookup(encoding.strip().strip("\"'")).name
+    except LookupError:
+        logger.warning(f"Unknown encoding: {encoding}")
+        return None
+
+
+def _is_utf8(data: bytes) -> bool:
+    if data.isascii():
+        return True
+    decoder = codecs.getincrementaldecoder("utf-8")()
+    view = memoryview(data)
+    try:
+        for start in range(0, len(view), DECODE_CHUNK_BYTES):
+            decoder.decode(view[start:start + DECODE_CHUNK_BYTES])
+        decoder.decode(b"", final=True)
+    except UnicodeDecodeError:
+        return False
+    return True
+
+
+def detect_encoding(data: bytes,
+                    declared: Optional[str] = None,
+                    is_html: bool = False) -> str:
+    """Choose the encoding to decode a document with.
+
+    In order, this takes a byte order mark, which leaves no doubt,
+    the charset from the Content-Type header, an encoding declared at
+    the start of an HTML or XML document, UTF-8 if the document is
+    valid UTF-8, a guess from charset_normalizer if it is installed,
+    and finally windows-1252, which decodes any bytes.
+
+    None of these steps decodes the whole document into a string.
+    """
+    for bom, encoding in _BOMS:
+        if data.startswith(bom):
+            return encoding
+
+    encoding = _known_encoding(declared)
+    if encoding:
+        return encoding
+
+    encoding = _known_encoding(EncodingDetector.find_declared_encoding(
+        data[:DETECTION_BYTES], is_html=is_html))
+    if encoding:
+        return encoding
+
+    if _is_utf8(data):
+        return "utf-8"
+
+    if charset_normalizer is not None:
+        guess = charset_normalizer.from_bytes(data[:DETECTION_BYTES]).best()
+        encoding = _known_encoding(guess.encoding if guess else None)
+        if encoding:
+            return encoding
+
+    return FALLBACK_ENCODING
+
+
+def iter_decode(data: bytes,
+                encoding: str,
+                chunk_bytes: int = DECODE_CHUNK_BYTES) -> Iterator[str]:
+    """Decode a document in pieces of at most chunk_bytes bytes, so that
+    the whole of it is never held as a string. Bytes that are not valid
+    in the encoding are replaced with U+FFFD."""
+    decoder = codecs.getincrementaldecoder(encoding)(errors="replace")
+    view = memoryview(data)
+    for start in range(0, len(view), chunk_bytes):
+        text = decoder.decode(view[start:start + chunk_bytes])
+        if text:
+            yield text
+    text = decoder.decode(b"", final=True)
+    if text:
+        yield text
@@ -12,6 +12,9 @@ class CrawlDocument:
     url: str
     content_type: str
     blob: bytes
+    # From the response headers, if the server sent them
+    etag: Optional[str] = None
+    last_modified: Optional[dict] = None  # {"_date": ...}, as ApertureDB returns dates
 
 
 @dataclass
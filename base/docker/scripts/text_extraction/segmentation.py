@@ -1,19 +1,62 @@
-from typing import Iterator
+from bisect import bisect_left, bisect_right
+from itertools import accumulate, repeat
+from typing import Iterator, List, Tuple
 from .schema import Segment, TextBlock
 from tiktoken import encoding_for_model
-from langchain_text_splitters.character import RecursiveCharacterTextSplitter
 import logging
+import re
 import unicodedata
 
 logger = logging.getLogger(__name__)
 
+# Start of a character in UTF-8
+_CHARACTER_START = re.compile(rb"[^\x80-\xbf]")
+
+_ASCII_ALNUM = b"ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789"
+# Characters for which str.isalnum() is true, outside ASCII
+_NON_ASCII_ALNUM = re.compile(r"[^\x00-\x7f\W]+")
+# Mathematical Alphanumeric Symbols; Emoji, Dingbats, Enclosed, etc.;
+# and the replacement character
+_WEIRD = re.compile("[\U0001D400-\U0001D7FF\U0001F000-\U0001FAFF\uFFFD]")
+
+
+def _alnum_count(text: str) -> int:
+    """Number of characters for which str.isalnum() is true"""
+    # Bytes of multi-byte characters are never ASCII letters or digits
+    data = text.encode("utf-8", "surrogatepass")
+    count = len(data) - len(data.translate(None, _ASCII_ALNUM))
+    if not text.isascii():
+        count += sum(map(len, _NON_ASCII_ALNUM.findall(text)))
+    return count
+
+
+def _weird_count(text: str) -> int:
+    """Number of symbols, emoji and replacement characters"""
+    if text.isascii():
+        return 0
+    return len(_WEIRD.findall(text))
+
+
+class _TokenLengths(dict):
+    """Length in bytes of each token, looked up when first needed"""
+
+    def __init__(self, encoder):
+        super().__init__()
+        self.encoder = encoder
+
+    def __missing__(self, token: int) -> int:
+        length = self[token] = len(self.encoder.decode_single_token_bytes(token))
+        return length
+
 
 class TextSegmenter:
     """Segment text into chunks suitable for LLM processing.
     Short blocks are combined together.
     Overly-long blocks are split into smaller segments.
-    This class uses the tiktoken encoder to count tokens and
-    the langchain RecursiveCharacterTextSplitter to split text.
+    This class uses the tiktoken encoder to count tokens, and encodes
+    each block only once. Overly-long blocks are split the way the
+    langchain RecursiveCharacterTextSplitter splits text, but pieces
+    are measured by the offsets of the block's tokens, not encoded again.
     Successive segments overlap by a specified number of tokens.
     The overlap is not exact, but approximate.
 
@@ -26,40 +69,137 @@ class TextSegmenter:
         max_tokens: int = 300,  # maximum number of tokens per segment
         overlap_tokens: int = 50,  # approximate number of tokens to overlap between segments
         min_tokens: int = 20,  # minimum number of tokens per segment
+        min_alnum_ratio: float = 0.2,  # minimum fraction of alphanumeric characters in a segment
+        min_distinct_characters: int = 5,  # minimum number of different characters in a segment
+        max_weird_ratio: float = 0.2,  # maximum fraction of symbols, emoji and replacement characters
     ):
         self.model_name = model_name
         self.max_tokens = max_tokens
         self.overlap_tokens = overlap_tokens
         self.min_tokens = min_tokens
+        self.min_alnum_ratio = min_alnum_ratio
+        self.min_distinct_characters = min_distinct_characters
+        self.max_weird_ratio = max_weird_ratio
         self.encoder = encoding_for_model(model_name)
-        self.splitter = RecursiveCharacterTextSplitter.from_tiktoken_encoder(
-            chunk_size=max_tokens,
-            chunk_overlap=0,  # Not a typo, overlap handled separately
-            model_name=model_name,
-        )
+        self._token_lengths = _TokenLengths(self.encoder)
+        # Paragraphs, then lines, then words, then characters
+        self._separators = [re.compile(re.escape(s))
+                            for s in [b"\n\n", b"\n", b" ", b""]]
 
-    def _token_count(self, text):
+    def _encode(self, text: str) -> List[int]:
         """We use the encoder to count tokens.
         Here we're using the OpenAI tokenizer, but it's not critical,
         and does not tie us to OpenAI.
+        Special tokens in the text are treated as ordinary text.
+        """
+        return self.encoder.encode_ordinary(text)
+
+    def _split(self, text: str, tokens: List[int]) -> List[Tuple[str, int]]:
+        """Split text that is too long into chunks of up to max_tokens,
+        returning each chunk with its token count.
+
+        The text is split as UTF-8, in which the tokens start at the
+        running totals of their lengths. The length of a piece of text is
+        the number of the text's tokens that overlap it, which is close to
+        the length of the piece encoded on its own.
         """
-        return len(self.encoder.encode(text))
+        # Lone surrogates take three bytes, like the replacement
+        # characters that the encoder substitutes for them
+        data = text.encode("utf-8", "surrogatepass")
+        lengths = self._token_lengths
+        starts = list(accumulate((lengths[t] for t in tokens), initial=0))
+        starts.pop()
+        chunks = []
+        self._split_span(data, starts, 0, len(data), self._separators, chunks)
+        return chunks
 
     @staticmethod
-    def _is_weird(c: str) -> bool:
-        # Mathematical Alphanumeric Symbols
-        if 0x1D400 <= ord(c) <= 0x1D7FF:
-            return True
+    def _token_count(starts: List[int], start: int, end: int) -> int:
+        """Number of tokens overlapping data[start:end]"""
+        return bisect_left(starts, end) - bisect_right(starts, start) + 1
+
+    def _split_span(self,
+                    data: bytes, starts: List[int],
+                    start: int, end: int,
+                    separators: List[re.Pattern],
+                    chunks: List[Tuple[str, int]]):
+        """Split data[start:end] before each occurrence of the first
+        separator that it contains, merge the pieces into chunks, and
+        split pieces that are still too long on the remaining separators."""
+        separator = separators[-1]
+        new_separators = []
+        for i, s in enumerate(separators):
+            if not s.pattern:
+                separator = s
+                break
+            if s.search(data, start, end):
+                separator = s
+                new_separators = separators[i + 1:]
+                break
 
-        # Emoji, Dingbats, Enclosed, etc.
-        if 0x1F000 <= ord(c) <= 0x1FAFF:
-            return True
+        if separator.pattern:
+            bounds = [m.start() for m in separator.finditer(data, start, end)]
+        else:
+            bounds = [m.start() for m in _CHARACTER_START.finditer(data, start, end)]
+        if not bounds or bounds[0] != start:
+            bounds.insert(0, start)
+        bounds.append(end)
+        # Number of tokens overlapping each piece
+        first = map(bisect_right, repeat(starts), bounds[:-1])
+        last = map(bisect_left, repeat(starts), bounds[1:])
+        counts = [b - a + 1 for a, b in zip(first, last)]
+
+        good_pieces = []
+        for piece in zip(bounds, bounds[1:], counts):
+            if piece[2] < self.max_tokens:
+                good_pieces.append(piece)
+                continue
+            if good_pieces:
+                self._merge_pieces(data, starts, good_pieces, chunks)
+                good_pieces = []
+            piece_start, piece_end, piece_tokens = piece
+            if not new_separators:
+                chunks.append((data[piece_start:piece_end].decode(
+                    "utf-8", "surrogatepass"), piece_tokens))
+            else:
+                self._split_span(data, starts, piece_start, piece_end,
+                                 new_separators, chunks)
+        if good_pieces:
+            self._merge_pieces(data, starts, good_pieces, chunks)
 
-        # replacement character
-        if c == "\uFFFD":
-            return True
+    def _merge_pieces(self,
+                      data: bytes, starts: List[int],
+                      pieces: List[Tuple[int, int, int]],
+                      chunks: List[Tuple[str, int]]):
+        """Merge consecutive pieces into chunks of up to max_tokens"""
+        chunk_start = None
+        chunk_end = None
+        total = 0
+        for start, end, tokens in pieces:
+            if total + tokens > self.max_tokens and chunk_start is not None:
+                self._add_chunk(data, starts, chunk_start, chunk_end, chunks)
+                chunk_start = None
+                total = 0
+            if chunk_start is None:
+                chunk_start = start
+            chunk_end = end
+            total += tokens
+        if chunk_start is not None:
+            self._add_chunk(data, starts, chunk_start, chunk_end, chunks)
 
-        return False
+    def _add_chunk(self,
+                   data: bytes, starts: List[int],
+                   start: int, end: int,
+                   chunks: List[Tuple[str, int]]):
+        """Add data[start:end] without surrounding whitespace, unless empty"""
+        text = data[start:end].decode("utf-8", "surrogatepass")
+        chunk = text.strip()
+        if not chunk:
+            return
+        start += len(text[:len(text) - len(text.lstrip())].encode(
+            "utf-8", "surrogatepass"))
+        end -= len(text[len(text.rstrip()):].encode("utf-8", "surrogatepass"))
+        chunks.append((chunk, self._token_count(starts, start, end)))
 
     def _is_clean(self, text: str) -> bool:
         """Applies some simple filters to exclude garbage text"""
@@ -74,26 +214,23 @@ class TextSegmenter:
             return False
 
         # Must contain mostly alphanumeric
-        ratio = sum(c.isalnum() for c in text) / len(text)
-        ratio_threshold = 0.2
-        if ratio < ratio_threshold:
+        ratio = _alnum_count(text) / len(text)
+        if ratio < self.min_alnum_ratio:
             logger.debug(
-                f"Rejecting {text[:100]} because alphanumeric ratio {ratio} < {ratio_threshold}")
+                f"Rejecting {text[:100]} because alphanumeric ratio {ratio} < {self.min_alnum_ratio}")
             return False
 
         # Reject excessive repetition
-        if len(set(text)) < 5:
+        characters = set(text)
+        if len(characters) < self.min_distinct_characters:
             logger.debug(
-                f"Rejecting {text[:100]} because characters set {set(text)} has cardinality {len(set(text))} < 5")
+                f"Rejecting {text[:100]} because characters set {characters} has cardinality {len(characters)} < {self.min_distinct_characters}")
             return False
 
-        weird_character_ratio = sum(
-            TextSegmenter._is_weird(c) for c in text
-        ) / max(len(text), 1)
-        weird_character_ratio_threshold = 0.2
-        if weird_character_ratio > weird_character_ratio_threshold:
+        weird_character_ratio = _weird_count(text) / len(text)
+        if weird_character_ratio > self.max_weird_ratio:
             logger.debug(
-                f"Rejecting {text[:100]} because weird character ratio {weird_character_ratio} > {weird_character_ratio_threshold}")
+                f"Rejecting {text[:100]} because weird character ratio {weird_character_ratio} > {self.max_weird_ratio}")
             return False
 
         return True
@@ -103,7 +240,8 @@ class TextSegmenter:
                 clean_only: bool = True,
                 ) -> Iterator[Segment]:
         """Turn the sequence of text blocks into segments"""
-        buffer = []
+        # Blocks with their token counts
+        buffer: List[Tuple[TextBlock, int]] = []
         buffer_tokens = 0
         total_tokens = 0
         n_segments = 0
@@ -115,30 +253,29 @@ class TextSegmenter:
                 title = block.title
 
             # TODO: Consider suppressing overlap for some kinds of block
-            token_count = self._token_count(block.text)
-            total_tokens += token_count
+            tokens = self._encode(block.text)
+            total_tokens += len(tokens)
 
             # If the block is short enough, add it to the buffer
             # Otherwise, split it into smaller blocks
             # and add those to the buffer
-            if token_count <= self.max_tokens:
-                sub_blocks = [block]
+            if len(tokens) <= self.max_tokens:
+                sub_blocks = [(block, len(tokens))]
             else:  # block is too long; split
-                chunks = self.splitter.split_text(block.text)
-                sub_blocks = [block.split(chunk) for chunk in chunks]
+                sub_blocks = [(block.split(chunk), chunk_tokens)
+                              for chunk, chunk_tokens in self._split(block.text, tokens)]
 
             # Now try merging short blocks into segments
-            for sub_block in sub_blocks:
-                sub_tokens = self._token_count(sub_block.text)
+            for sub_block, sub_tokens in sub_blocks:
 
                 # If the new block is too long, flush the buffer
                 # by emitting a new segment
                 if buffer_tokens + sub_tokens > self.max_tokens and buffer:
-                    segment_text = "\n\n".join(b.text for b in buffer)
+                    segment_text = "\n\n".join(b.text for b, _ in buffer)
                     if not clean_only or self._is_clean(segment_text):
                         yield Segment(
                             text=segment_text,
-                            blocks=buffer.copy(),
+                            blocks=[b for b, _ in buffer],
                             total_tokens=buffer_tokens,
                             title=title
                         )
@@ -148,27 +285,24 @@ class TextSegmenter:
 
                     # Now extract just the next overlap from the buffer
                     overlap = []
-                    tokens = 0
-                    for b in reversed(buffer):
-                        t = self._token_count(b.text)
-                        if tokens + t > self.overlap_tokens:
+                    buffer_tokens = 0
+                    for b, t in reversed(buffer):
+                        if buffer_tokens + t > self.overlap_tokens:
                             break
-                        tokens += t
-                        overlap.insert(0, b)
+                        buffer_tokens += t
+                        overlap.insert(0, (b, t))
 
                     # Set buffer to be just the overlap
                     buffer = overlap
-                    buffer_tokens = sum(
-                        self._token_count(b.text) for b in buffer)
 
                 # Add the new block to the buffer
-                buffer.append(sub_block)
+                buffer.append((sub_block, sub_tokens))
                 buffer_tokens += sub_tokens
 
         if buffer:  # Finally flush buffer by emitting one more segment
-            segment_text = "\n\n".join(b.text for b in buffer)
+            segment_text = "\n\n".join(b.text for b, _ in buffer)
             if not clean_only or self._is_clean(segment_text):
-                yield Segment(text=segment_text, blocks=buffer.copy(), total_tokens=buffer_tokens, title=title)
+                yield Segment(text=segment_text, blocks=[b for b, _ in buffer], total_tokens=buffer_tokens, title=title)
                 n_segments += 1
             else:
                 n_rejected_segments += 1
@@ -1,9 +1,20 @@
 """ Extract text and images from various document formats. """
 
 from bs4 import BeautifulSoup
-from typing import Iterator, Optional, Union, Literal
+from concurrent.futures import ProcessPoolExecutor
+from itertools import chain, repeat
+from typing import Callable, Iterator, List, Optional, Tuple, Union, Literal
 import io
+import lxml.etree
+import lxml.html
+import multiprocessing
+import os
 import pdfplumber
+import pypdfium2
+import re
+import tempfile
+import threading
+from .decoding import detect_encoding, iter_decode
 from .schema import Block, TextBlock, ImageBlock, FullTextBlock
 import logging
 from email.message import Message
@@ -11,10 +22,105 @@ from email.message import Message
 logger = logging.getLogger(__name__)
 
 
+CONTENT_TAGS = ["p", "h1", "h2", "h3", "h4", "h5", "li",
+                "figcaption", "img", "div", "span"]
+HTML_BACKENDS = ["bs4", "lxml"]
+PDF_ENGINES = ["pdfplumber", "pdfium"]
+# Plain text is broken into blocks of about this many characters
+PLAIN_TEXT_BLOCK_CHARACTERS = 64 * 1024
+# pdfium ends lines with \r\n and marks a hyphen that breaks a word at
+# the end of a line with U+FFFE, joining the two halves
+_PDFIUM_LINE_BREAK = re.compile(r"\r\n?")
+_PDFIUM_SOFT_HYPHEN = "\ufffe"
+
+
+def _pdf_info(data: bytes, engine: str) -> Tuple[Optional[str], int]:
+    """The title and number of pages of a PDF"""
+    if engine == "pdfium":
+        pdf = pypdfium2.PdfDocument(data)
+        try:
+            return pdf.get_metadata_dict().get("Title") or None, len(pdf)
+        finally:
+            pdf.close()
+    with pdfplumber.open(io.BytesIO(data)) as pdf:
+        return pdf.metadata.get("Title"), len(pdf.pages)
+
+
+def _extract_pdf_pages(data: Union[bytes, str], first: int, last: int, engine: str) -> List[str]:
+    """The text of pages first to last - 1 of a PDF, counting from 0.
+
+    This is a module function so that it can run in a worker process.
+    `data` is the PDF, or the path of a file holding it, which is much
+    cheaper to send to a worker.
+    """
+    if engine == "pdfium":
+        pdf = pypdfium2.PdfDocument(data)
+        try:
+            texts = []
+            for i in range(first, last):
+                page = pdf[i]
+                text = page.get_textpage().get_text_range()
+                text = _PDFIUM_LINE_BREAK.sub("\n", text)
+                texts.append(text.replace(_PDFIUM_SOFT_HYPHEN, ""))
+                page.close()
+            return texts
+        finally:
+            pdf.close()
+    source = io.BytesIO(data) if isinstance(data, bytes) else data
+    with pdfplumber.open(source, pages=range(first + 1, last + 1)) as pdf:
+        return [page.extract_text() for page in pdf.pages]
+
+
 class TextExtractor:
-    def __init__(self, css_selector: Optional[str] = None, emit_full_text: bool = False):
+    def __init__(self,
+                 css_selector: Optional[str] = None,
+                 emit_full_text: bool = False,
+                 html_backend: Literal["bs4", "lxml"] = "bs4",
+                 pdf_engine: Literal["pdfplumber", "pdfium"] = "pdfplumber",
+                 pdf_workers: int = 0,
+                 pdf_parallel_min_pages: int = 16):
+        """
+        Args:
+            css_selector: Only extract text from HTML elements matching this selector, if any match.
+            emit_full_text: Also emit a FullTextBlock with all the text of the document.
+            html_backend: "bs4" parses HTML with BeautifulSoup and html.parser;
+                "lxml" parses it with lxml, which is much faster on large pages,
+                but may build a different tree from malformed HTML.
+            pdf_engine: "pdfplumber" lays out the characters of each PDF page itself;
+                "pdfium" uses the text layer from pdfium, which is many times
+                faster, but may break lines and space words differently.
+            pdf_workers: Number of worker processes that extract ranges of
+                pages of a PDF in parallel. 0 or 1 extracts PDFs in this process.
+            pdf_parallel_min_pages: PDFs with fewer pages than this are
+                extracted in this process even if there are workers.
+        """
+        if html_backend not in HTML_BACKENDS:
+            raise ValueError(
+                f"Unknown HTML backend {html_backend}; must be one of {HTML_BACKENDS}")
+        if pdf_engine not in PDF_ENGINES:
+            raise ValueError(
+                f"Unknown PDF engine {pdf_engine}; must be one of {PDF_ENGINES}")
         self.css_selector = css_selector
         self.emit_full_text = emit_full_text
+        self.html_backend = html_backend
+        self.pdf_engine = pdf_engine
+        self.pdf_workers = pdf_workers
+        self.pdf_parallel_min_pages = pdf_parallel_min_pages
+        self._pdf_executor = None
+        self._pdf_executor_lock = threading.Lock()
+
+    def close(self):
+        """Shut down the PDF worker processes, if any"""
+        with self._pdf_executor_lock:
+            if self._pdf_executor is not None:
+                self._pdf_executor.shutdown()
+                self._pdf_executor = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
 
     def _parse_content_type(self, content_type: str) -> (str, dict):
         """Parse the content type and return the main type and options.
@@ -28,53 +134,106 @@ class TextExtractor:
         return params[0][0], dict(params[1:])
 
     def extract_blocks(self, data: bytes, content_type: str) -> Iterator[Block]:
-        full_text_buffer = io.StringIO() if self.emit_full_text else None
         mimetype, options = self._parse_content_type(content_type)
-        # TODO: Handle options like charset
+        charset = options.get("charset")
         if mimetype == "text/plain":
-            gen = self._extract_plain_text_blocks(data)
+            gen = self._extract_plain_text_blocks(data, detect_encoding(data, charset))
+        elif mimetype == "text/html" and self.html_backend == "lxml":
+            gen = self._extract_lxml_html_blocks(
+                data, detect_encoding(data, charset, is_html=True))
         elif mimetype == "text/html":
-            gen = self._extract_html_blocks(data)
+            gen = self._extract_html_blocks(
+                data, detect_encoding(data, charset, is_html=True))
         elif mimetype == "application/pdf":
             gen = self._extract_pdf_text_blocks(data)
         else:
             raise ValueError(f"Unsupported content type: {content_type}")
         title = None
+        # The blocks' own strings, rather than a copy of them in a buffer
+        full_text_parts = []
         for block in gen:
             if self.emit_full_text and isinstance(block, TextBlock):
                 if not title:
                     title = block.title
-                full_text_buffer.write(block.text)
-                full_text_buffer.write("\n\n")
+                full_text_parts.append(block.text)
+                full_text_parts.append("\n\n")
             yield block
         if self.emit_full_text:
-            yield FullTextBlock(text=full_text_buffer.getvalue(), title=title)
+            yield FullTextBlock(text="".join(full_text_parts), title=title)
 
     def _extract_pdf_text_blocks(self, data: bytes) -> Iterator[Block]:
-        with pdfplumber.open(io.BytesIO(data)) as pdf:
-            title = pdf.metadata.get("Title")  # or None
-            for page_number, page in enumerate(pdf.pages, start=1):
-                text = page.extract_text()
-                if text:
-                    yield TextBlock(
-                        text=text.strip(),
-                        kind="body",
-                        page_number=page_number,
-                        title=title,
-                    )
-
-    def _extract_plain_text_blocks(self, data: bytes) -> Iterator[Block]:
-        text = data.decode("utf-8", errors="replace")
-        yield TextBlock(text=text)
-
-    def _extract_html_blocks(self, data: bytes) -> Iterator[Block]:
-        soup = BeautifulSoup(data, "html.parser")
+        title, n_pages = _pdf_info(data, self.pdf_engine)
+        if self.pdf_workers > 1 and n_pages >= self.pdf_parallel_min_pages:
+            texts = self._extract_pdf_pages_in_parallel(data, n_pages)
+        else:
+            texts = _extract_pdf_pages(data, 0, n_pages, self.pdf_engine)
+        for page_number, text in enumerate(texts, start=1):
+            if text:
+                yield TextBlock(
+                    text=text.strip(),
+                    kind="body",
+                    page_number=page_number,
+                    title=title,
+                )
+
+    def _extract_pdf_pages_in_parallel(self, data: bytes, n_pages: int) -> Iterator[str]:
+        """Split the pages into a few ranges per worker, so that a slow range
+        does not hold up the others, and put the text back in page order.
+
+        The PDF is written to a temporary file, which the workers read,
+        so that each task is sent only its range of pages rather than a
+        copy of the whole PDF.
+        """
+        with self._pdf_executor_lock:
+            if self._pdf_executor is None:
+                # Spawn rather than fork, as the caller may be running threads
+                self._pdf_executor = ProcessPoolExecutor(
+                    max_workers=self.pdf_workers,
+                    mp_context=multiprocessing.get_context("spawn"))
+        n_ranges = min(n_pages, 4 * self.pdf_workers)
+        bounds = [n_pages * i // n_ranges for i in range(n_ranges + 1)]
+        logger.debug(
+            f"Extracting {n_pages} pages in {n_ranges} ranges with {self.pdf_workers} workers")
+        with tempfile.NamedTemporaryFile(suffix=".pdf", delete=False) as f:
+            f.write(data)
+        try:
+            yield from chain.from_iterable(self._pdf_executor.map(
+                _extract_pdf_pages, repeat(f.name), bounds[:-1], bounds[1:],
+                repeat(self.pdf_engine)))
+        finally:
+            os.unlink(f.name)
+
+    def _extract_plain_text_blocks(self, data: bytes, encoding: str) -> Iterator[Block]:
+        """Decode the text a piece at a time, and yield it in blocks broken
+        between paragraphs or lines where possible, rather than as one
+        string that the segmenter then has to encode in one go"""
+        pending = ""
+        n_blocks = 0
+        for text in iter_decode(data, encoding):
+            pending += text
+            while len(pending) > PLAIN_TEXT_BLOCK_CHARACTERS:
+                block_text, pending = self._split_plain_text(pending)
+                n_blocks += 1
+                yield TextBlock(text=block_text)
+        if pending or not n_blocks:
+            yield TextBlock(text=pending)
+
+    @staticmethod
+    def _split_plain_text(text: str) -> (str, str):
+        """The first block of the text, and the rest"""
+        for separator in ["\n\n", "\n"]:
+            end = text.rfind(separator, 0, PLAIN_TEXT_BLOCK_CHARACTERS)
+            if end > 0:
+                return text[:end], text[end + len(separator):]
+        return text[:PLAIN_TEXT_BLOCK_CHARACTERS], text[PLAIN_TEXT_BLOCK_CHARACTERS:]
+
+    def _extract_html_blocks(self, data: bytes, encoding: str) -> Iterator[Block]:
+        soup = BeautifulSoup(data, "html.parser", from_encoding=encoding)
         title_element = soup.find("title")
         title = title_element.get_text(strip=True) if title_element else None
         logger.info(f"Title found in HTML: {title}")
 
-        content_tags = ["p", "h1", "h2", "h3", "h4", "h5", "li",
-                        "figcaption", "img", "div", "span"]
+        content_tags = CONTENT_TAGS
         # TODO: Tag code blocks for language-sensitive splitting.
         # If a CSS selector is provided and matches, use its elements
         if self.css_selector:
@@ -93,6 +252,63 @@ class TextExtractor:
         yield from self._yield_html_content_blocks(
             self._filter_nested_elements(soup.find_all(content_tags)), title)
 
+    def _extract_lxml_html_blocks(self, data: bytes, encoding: str) -> Iterator[Block]:
+        """Like _extract_html_blocks, but walks an lxml tree once in document
+        order, rather than finding all the content elements and then
+        filtering out those inside another."""
+        # Feed the parser a piece at a time, so that the document is
+        # never held as one string alongside its bytes and its tree
+        parser = lxml.html.HTMLParser(remove_comments=True, remove_pis=True)
+        for markup in iter_decode(data, encoding):
+            parser.feed(markup)
+        try:
+            root = parser.close()
+        except lxml.etree.XMLSyntaxError:  # Nothing was fed
+            return
+        if root is None:  # Document is empty
+            return
+        # BeautifulSoup leaves these out of the text, so drop them,
+        # keeping any text that follows them
+        lxml.etree.strip_elements(root, "script", "style", with_tail=False)
+
+        title_element = root.find(".//title")
+        title = self._lxml_text(title_element) if title_element is not None else None
+        logger.info(f"Title found in HTML: {title}")
+
+        def yield_blocks(elements):
+            return self._yield_html_content_blocks(
+                elements, title, name=lambda el: el.tag, text=self._lxml_text)
+
+        if self.css_selector:
+            root_elements = root.cssselect(self.css_selector)
+            if root_elements:
+                for element in root_elements:
+                    yield from yield_blocks(self._lxml_content_elements(list(element)))
+                return
+            else:
+                logger.warning(
+                    f"No matches found for CSS selector: {self.css_selector}")
+
+        yield from yield_blocks(self._lxml_content_elements([root]))
+
+    @staticmethod
+    def _lxml_content_elements(elements: list) -> Iterator[lxml.html.HtmlElement]:
+        """The content elements among these elements and their descendants,
+        in document order, leaving out those inside another content element"""
+        content_tags = set(CONTENT_TAGS)
+        stack = elements[::-1]
+        while stack:
+            el = stack.pop()
+            if el.tag in content_tags:
+                yield el
+            elif isinstance(el.tag, str):
+                stack.extend(reversed(el))
+
+    @staticmethod
+    def _lxml_text(el: lxml.html.HtmlElement) -> str:
+        """The text of an element, as get_text(strip=True) gives it"""
+        return "".join(t.strip() for t in el.itertext())
+
     def _filter_nested_elements(self, elements):
         seen = set()
         filtered = 0
@@ -103,14 +319,20 @@ class TextExtractor:
             seen.add(id(el))
             yield el
 
-    def _yield_html_content_blocks(self, elements: list, title: Optional[str]) -> Iterator[Block]:
+    def _yield_html_content_blocks(self,
+                                   elements: list,
+                                   title: Optional[str],
+                                   name: Callable = lambda el: el.name,
+                                   text: Callable = lambda el: el.get_text(strip=True),
+                                   ) -> Iterator[Block]:
         pending_image = None
         current_anchor = None
         for el in elements:
             anchor = el.get("id") or el.get("name")
             if anchor:
                 current_anchor = anchor
-            if el.name == "img":
+            tag_name = name(el)
+            if tag_name == "img":
                 image_url = el.get("src")
                 alt_text = el.get("alt")
                 if image_url:
@@ -120,20 +342,19 @@ class TextExtractor:
                     pending_image = ImageBlock(
                         image_url=image_url, alt_text=alt_text, anchor=current_anchor, title=title)
             else:
-                if el.name == "figcaption":
-                    text = el.get_text(strip=True)
+                el_text = text(el)
+                if tag_name == "figcaption":
                     # Attach caption to last image if available
-                    if pending_image is not None and text:
+                    if pending_image is not None and el_text:
                         if pending_image.caption is None:
-                            pending_image.caption = text
+                            pending_image.caption = el_text
                         else:
                             logger.warning(
-                                f"Multiple captions found for the same image: {current_anchor} - {pending_image} - {text}")
+                                f"Multiple captions found for the same image: {current_anchor} - {pending_image} - {el_text}")
 
-                text = el.get_text(strip=True)
-                if text:
-                    kind = self._tag_kind(el.name)
-                    yield TextBlock(text=text, kind=kind, anchor=current_anchor, title=title)
+                if el_text:
+                    kind = self._tag_kind(tag_name)
+                    yield TextBlock(text=el_text, kind=kind, anchor=current_anchor, title=title)
             # TODO: Maybe get context text in other ways
         if pending_image is not None and pending_image.has_text:  # Flush final image block
             yield pending_image
@@ -0,0 +1,256 @@
+#!/usr/bin/env python3
+"""
+Test suite for batcher.py
+
+Tests use a fake execute_query that records the queries it receives,
+so no ApertureDB instance is needed.
+"""
+
+import copy
+import json
+import threading
+import time
+import pytest
+
+from batcher import SymbolicBatcher, CommandTemplate
+
+
+class FakeDB:
+    """Records queries and returns one result per command"""
+
+    def __init__(self, delay: float = 0, fail_on: int = None):
+        self.queries = []
+        self.blobs = []
+        self.delay = delay
+        self.fail_on = fail_on
+        self.threads = set()
+
+    def execute_query(self, commands, blobs):
+        self.threads.add(threading.current_thread().name)
+        if self.delay:
+            time.sleep(self.delay)
+        if self.fail_on is not None and len(self.queries) == self.fail_on:
+            self.queries.append(commands)
+            raise ValueError("Query failed")
+        self.queries.append(commands)
+        self.blobs.append(list(blobs))
+        results = [{next(iter(c)): {"status": 0, "n": i}}
+                   for i, c in enumerate(commands)]
+        return results, list(blobs)
+
+
+def add_descriptor(i: int) -> list:
+    return [
+        {"FindEntity": {"with_class": "Segment",
+                        "constraints": {"id": ["==", str(i)]}, "_ref": "SEGMENT"}},
+        {"AddDescriptor": {"set": "test", "properties": {"i": i},
+                           "connect": {"ref": "SEGMENT", "class": "segmentHasDescriptor"},
+                           "_ref": "TEMP"}},
+        {"AddConnection": {"src": "SPEC", "dst": "TEMP",
+                           "class": "specHasDescriptor"}},
+    ]
+
+
+def spec_prolog() -> list:
+    return [{"FindEntity": {"with_class": "Spec", "_ref": "SPEC"}}]
+
+
+@pytest.mark.parametrize("pipeline_depth", [0, 1, 3])
+def test_batches_and_refs(pipeline_depth):
+    db = FakeDB()
+    with SymbolicBatcher(db.execute_query, batch_size=6, prolog=spec_prolog,
+                         pipeline_depth=pipeline_depth) as batcher:
+        for i in range(5):
+            batcher.add(add_descriptor(i), [bytes([i])])
+
+    assert len(db.queries) == 3
+    assert [len(q) for q in db.queries] == [7, 7, 4]
+    assert db.blobs == [[b"\x00", b"\x01"], [b"\x02", b"\x03"], [b"\x04"]]
+    # Refs restart for each batch
+    first = db.queries[0]
+    assert first[0]["FindEntity"]["_ref"] == 1
+    assert first[1]["FindEntity"]["_ref"] == 2
+    assert first[2]["AddDescriptor"]["connect"]["ref"] == 2
+    assert first[2]["AddDescriptor"]["_ref"] == 3
+    assert first[3]["AddConnection"] == {
+        "src": 1, "dst": 3, "class": "specHasDescriptor"}
+    assert first[4]["FindEntity"]["_ref"] == 4
+    assert first[6]["AddConnection"]["dst"] == 5
+    assert db.queries[2][1]["FindEntity"]["constraints"]["id"] == ["==", "4"]
+
+
+def test_unknown_ref():
+    db = FakeDB()
+    batcher = SymbolicBatcher(db.execute_query)
+    batcher.add([{"AddConnection": {"src": "MISSING", "dst": "MISSING"}}])
+    with pytest.raises(ValueError, match="not assigned"):
+        batcher.flush()
+
+
+@pytest.mark.parametrize("pipeline_depth", [0, 2])
+def test_response_handlers_in_order(pipeline_depth):
+    db = FakeDB()
+    seen = []
+    with SymbolicBatcher(db.execute_query, batch_size=4, prolog=spec_prolog,
+                         pipeline_depth=pipeline_depth) as batcher:
+        for i in range(6):
+            batcher.add(add_descriptor(i)[:2],
+                        response_handler=lambda results, blobs, i=i: seen.append(
+                            (i, [next(iter(r)) for r in results], blobs)))
+
+    assert [i for i, _, _ in seen] == list(range(6))
+    assert all(names == ["FindEntity", "AddDescriptor"]
+               for _, names, _ in seen)
+
+
+def test_pipelined_overlaps_with_caller():
+    db = FakeDB(delay=0.05)
+    batcher = SymbolicBatcher(db.execute_query, batch_size=1,
+                              pipeline_depth=2)
+    start = time.monotonic()
+    batcher.add([{"FindEntity": {}}])
+    # The first batch is being executed in the background
+    assert time.monotonic() - start < 0.04
+    assert "batcher" not in threading.current_thread().name
+    batcher.close()
+    assert len(db.queries) == 1
+    assert db.threads == {"batcher"}
+
+
+def test_pipelined_error_raised_on_next_call():
+    db = FakeDB(fail_on=0)
+    batcher = SymbolicBatcher(db.execute_query, batch_size=1,
+                              pipeline_depth=1)
+    batcher.add([{"FindEntity": {}}])
+    with pytest.raises(ValueError, match="Query failed"):
+        batcher.join()
+    # Error is only raised once, and later batches still run
+    batcher.add([{"FindEntity": {}}])
+    batcher.close()
+    assert len(db.queries) == 2
+
+
+def test_pipelined_error_raised_on_exit():
+    db = FakeDB(fail_on=0)
+    with pytest.raises(ValueError, match="Query failed"):
+        with SymbolicBatcher(db.execute_query, pipeline_depth=1) as batcher:
+            batcher.add([{"FindEntity": {}}])
+
+
+@pytest.mark.parametrize("pipeline_depth", [0, 1])
+def test_error_in_with_body(pipeline_depth):
+    db = FakeDB()
+    with pytest.raises(KeyError, match="in body"):
+        with SymbolicBatcher(db.execute_query, batch_size=10,
+                             pipeline_depth=pipeline_depth) as batcher:
+            batcher.add([{"FindEntity": {}}])
+            raise KeyError("in body")
+    # The half-built batch is not sent
+    assert db.queries == []
+    assert batcher._worker is None
+
+
+def test_error_in_with_body_not_hidden():
+    db = FakeDB(fail_on=0)
+    with pytest.raises(KeyError, match="in body"):
+        with SymbolicBatcher(db.execute_query, batch_size=1,
+                             pipeline_depth=1) as batcher:
+            batcher.add([{"FindEntity": {}}])
+            raise KeyError("in body")
+    # The flushed batch still ran, and its error was only logged
+    assert len(db.queries) == 1
+
+def test_flush_on_blob_bytes():
+    db = FakeDB()
+    with SymbolicBatcher(db.execute_query, batch_size=100,
+                         max_blob_bytes=10) as batcher:
+        batcher.add([{"AddBlob": {}}], [b"x" * 4])
+        batcher.add([{"AddBlob": {}}], [b"x" * 4])
+        # Would take the batch over the limit, so starts a new batch
+        batcher.add([{"AddBlob": {}}], [b"x" * 4])
+        # Reaches the limit, so flushes
+        batcher.add([{"AddBlob": {}}], [b"x" * 6])
+        # Over the limit on its own, so sent alone
+        batcher.add([{"AddBlob": {}}], [b"x" * 20])
+        batcher.add([{"AddBlob": {}}], [b"x"])
+
+    assert [len(q) for q in db.queries] == [2, 2, 1, 1]
+    assert [sum(len(b) for b in blobs) for blobs in db.blobs] == [8, 10, 20, 1]
+
+
+def test_flush_on_json_bytes():
+    db = FakeDB()
+    command = {"AddEntity": {"properties": {"text": "x" * 100}}}
+    size = len(json.dumps([command]))
+    with SymbolicBatcher(db.execute_query, batch_size=100,
+                         max_json_bytes=3 * size + 1) as batcher:
+        for _ in range(7):
+            batcher.add([command])
+
+    assert [len(q) for q in db.queries] == [3, 3, 1]
+
+
+def test_flush_on_latency():
+    db = FakeDB()
+    with SymbolicBatcher(db.execute_query, batch_size=100,
+                         max_latency=0.05) as batcher:
+        batcher.add([{"FindEntity": {}}])
+        batcher.add([{"FindEntity": {}}])
+        assert db.queries == []
+        time.sleep(0.06)
+        batcher.add([{"FindEntity": {}}])
+        assert [len(q) for q in db.queries] == [3]
+        batcher.add([{"FindEntity": {}}])
+
+    assert [len(q) for q in db.queries] == [3, 1]
+
+
+def test_commands_not_modified():
+    db = FakeDB()
+    commands = add_descriptor(0)
+    expected = copy.deepcopy(commands)
+    with SymbolicBatcher(db.execute_query, batch_size=6,
+                         prolog=spec_prolog) as batcher:
+        # The same commands can be added again, to this and later batches
+        for _ in range(3):
+            batcher.add(commands)
+
+    assert commands == expected
+    assert [len(q) for q in db.queries] == [7, 4]
+    assert db.queries[1][2]["AddDescriptor"]["connect"]["ref"] == 2
+    # Properties are shared, not copied
+    assert db.queries[1][2]["AddDescriptor"]["properties"] is \
+        commands[1]["AddDescriptor"]["properties"]
+
+
+def test_command_template():
+    db = FakeDB()
+    template = CommandTemplate(
+        {"FindEntity": {"with_class": "Spec", "_ref": "SPEC"}})
+    with SymbolicBatcher(db.execute_query, batch_size=2,
+                         prolog=lambda: [template]) as batcher:
+        for i in range(3):
+            batcher.add([template, {"AddConnection": {"src": "SPEC", "dst": "SPEC"}}])
+
+    assert len(db.queries) == 3
+    assert db.queries[0][1] == {"FindEntity": {"with_class": "Spec", "_ref": 2}}
+    assert db.queries[0][2] == {"AddConnection": {"src": 2, "dst": 2}}
+
+
+def test_command_ref():
+    db = FakeDB()
+    with SymbolicBatcher(db.execute_query, prolog=spec_prolog) as batcher:
+        batcher.add([{"UpdateEntity": {"ref": "SPEC", "properties": {"done": True}}}])
+
+    assert db.queries[0][1] == {"UpdateEntity": {"ref": 1, "properties": {"done": True}}}
+
+
+def test_numeric_ref():
+    batcher = SymbolicBatcher(FakeDB().execute_query)
+    batcher.add([{"FindEntity": {"_ref": 1}}])
+    with pytest.raises(ValueError, match="Numeric ref"):
+        batcher.flush()
+    with pytest.raises(ValueError, match="Numeric ref"):
+        CommandTemplate({"FindEntity": {"_ref": 1}})
+    with pytest.raises(ValueError, match="Numeric ref"):
+        CommandTemplate({"DeleteEntity": {"ref": 1}})
@@ -0,0 +1,68 @@
+#!/usr/bin/env python3
+"""
+Test suite for bulk.py
+"""
+
+import pytest
+
+from bulk import BulkUpdate
+
+
+def test_update_only():
+    bulk = BulkUpdate("Image", ["a", "b", "c"], properties={"done": True})
+    assert bulk.query() == [
+        {"FindImage": {"_ref": 1, "constraints": {"_uniqueid": ["in", ["a", "b", "c"]]},
+                       "blobs": False}},
+        {"UpdateImage": {"ref": 1, "properties": {"done": True}}},
+    ]
+
+
+def test_remove_props():
+    bulk = BulkUpdate("Entity", ["a"], remove_props=["done"])
+    assert bulk.query()[1] == {
+        "UpdateEntity": {"ref": 1, "remove_props": ["done"]}}
+
+
+def test_find_options():
+    # Entities have no blobs to leave out
+    bulk = BulkUpdate("Entity", ["a", "b"], properties={"done": True})
+    assert "blobs" not in bulk.query()[0]["FindEntity"]
+
+    bulk = BulkUpdate("Video", ["a", "b"], properties={"done": True},
+                      find_options={"with_label": "x"})
+    bulk.ref("a")
+    for find in (bulk.query()[0]["FindVideo"], bulk.query()[2]["FindVideo"]):
+        assert find["blobs"] is False
+        assert find["with_label"] == "x"
+
+
+def test_per_object_refs():
+    bulk = BulkUpdate("Image", ["a", "b", "c"], properties={"done": True})
+    box_ref = bulk.new_ref()
+    bulk.add({"AddBoundingBox": {"image_ref": bulk.ref("b"), "_ref": box_ref}})
+    bulk.add({"AddBoundingBox": {"image_ref": bulk.ref("b")}})
+    query = bulk.query()
+
+    # Only the image with boxes is found individually, and only once
+    assert len(query) == 5
+    assert query[2] == {"FindImage": {
+        "_ref": 3, "constraints": {"_uniqueid": ["==", "b"]}, "blobs": False}}
+    assert query[3] == {"AddBoundingBox": {"image_ref": 3, "_ref": 2}}
+    assert query[4] == {"AddBoundingBox": {"image_ref": 3}}
+
+
+def test_single_object_uses_bulk_ref():
+    bulk = BulkUpdate("Image", ["a"], properties={"done": True})
+    bulk.add({"AddBoundingBox": {"image_ref": bulk.ref("a")}})
+    assert len(bulk.query()) == 3
+    assert bulk.query()[2] == {"AddBoundingBox": {"image_ref": 1}}
+
+
+def test_unknown_object():
+    bulk = BulkUpdate("Image", ["a", "b"])
+    with pytest.raises(AssertionError):
+        bulk.ref("c")
+
+
+def test_empty():
+    assert BulkUpdate("Image", []).query() == []
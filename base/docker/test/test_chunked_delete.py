@@ -0,0 +1,156 @@
+#!/usr/bin/env python3
+"""
+Test suite for chunked_delete.py
+"""
+
+import pytest
+
+from chunked_delete import ChunkedDeleter
+
+
+class FakeDB:
+    """Just enough of ApertureDB to find and delete objects by constraints"""
+
+    def __init__(self):
+        self.objects = {}  # uniqueid -> (type, properties, blob uniqueid)
+        self.descriptor_sets = set()
+        self.queries = []
+        self.next_id = 0
+
+    def add(self, object_type, blob=False, **properties):
+        blob_id = self.add("Blob") if blob else None
+        self.next_id += 1
+        self.objects[self.next_id] = (object_type, properties, blob_id)
+        return self.next_id
+
+    def of_type(self, object_type):
+        return [(i, p) for i, (t, p, _) in self.objects.items() if t == object_type]
+
+    def _find(self, object_type, body):
+        found = []
+        for i, properties in self.of_type(object_type):
+            if "with_class" in body and properties.get("class") != body["with_class"]:
+                continue
+            if "set" in body and properties.get("set") != body["set"]:
+                continue
+            if all(properties.get(k) == v for k, (_, v) in body.get("constraints", {}).items()):
+                found.append(i)
+        return found
+
+    def execute_query(self, query):
+        self.queries.append(query)
+        refs = {}
+        results = []
+        for command in query:
+            name, body = next(iter(command.items()))
+            if name.startswith("Find") and name != "FindBlob":
+                found = self._find(name[4:], body)
+                if body.get("results", {}).get("count"):
+                    results.append({name: {"count": len(found)}})
+                    continue
+                found = found[:body["results"]["limit"]]
+                refs[body["_ref"]] = found
+                results.append({name: {"returned": len(found)}})
+            elif name == "FindBlob":
+                refs[body["_ref"]] = [self.objects[i][2] for i in refs[body["is_connected_to"]["ref"]]
+                                      if self.objects[i][2] is not None]
+                results.append({name: {}})
+            elif name == "DeleteDescriptorSet":
+                for i, _ in self.of_type("Descriptor"):
+                    if self.objects[i][1]["set"] == body["with_name"]:
+                        del self.objects[i]
+                self.descriptor_sets.discard(body["with_name"])
+                results.append({name: {"count": 1}})
+            else:
+                for i in refs[body["ref"]]:
+                    del self.objects[i]
+                results.append({name: {"count": len(refs[body["ref"]])}})
+        return results, []
+
+
+class FakeUpdater:
+    def __init__(self):
+        self.updates = []
+
+    def post_update(self, completed=None, phase=None, **kwargs):
+        self.updates.append((completed, phase))
+
+
+@pytest.fixture
+def db():
+    db = FakeDB()
+    db.add("Entity", **{"class": "Spec", "id": "a"})
+    for i in range(25):
+        db.add("Entity", **{"class": "Segment", "spec_id": "a"})
+    for i in range(5):
+        db.add("Entity", **{"class": "Segment", "spec_id": "b"})
+    for i in range(7):
+        db.add("Entity", blob=True, **{"class": "FullText", "spec_id": "a"})
+    return db
+
+
+def test_deletes_in_batches(db):
+    updater = FakeUpdater()
+    deleter = ChunkedDeleter(db.execute_query, batch_size=10, updater=updater)
+    deleter.add("Entity", {"spec_id": ["==", "a"]}, with_class="Segment")
+    deleter.add("Entity", {"id": ["==", "a"]}, with_class="Spec")
+    deleted = deleter.run()
+
+    assert list(deleted.values()) == [25, 1]
+    assert len(db.of_type("Entity")) == 5 + 7
+    # Two counts, three batches of segments and one of the spec
+    assert len(db.queries) == 2 + 3 + 1
+    assert [c for c, _ in updater.updates] == pytest.approx(
+        [100 * n / 26 for n in [10, 20, 25, 26, 26]])
+    assert all(phase == "deleting" for _, phase in updater.updates)
+
+
+def test_deletes_connected_blobs(db):
+    deleter = ChunkedDeleter(db.execute_query, batch_size=3)
+    deleter.add("Entity", {"spec_id": ["==", "a"]},
+                blob_connection="fullTextHasBlob", with_class="FullText")
+    assert list(deleter.run().values()) == [7]
+    assert db.of_type("Blob") == []
+    assert len(db.of_type("Entity")) == 1 + 25 + 5
+
+
+def test_resumes(db):
+    deleter = ChunkedDeleter(db.execute_query, batch_size=10)
+    deleter.add("Entity", {"spec_id": ["==", "a"]}, with_class="Segment")
+    deleter._delete_batch(deleter.steps[0])  # interrupted after one batch
+    assert list(deleter.run().values()) == [15]
+    assert list(deleter.run().values()) == [0]
+
+
+def test_descriptor_set_in_one_step():
+    db = FakeDB()
+    db.descriptor_sets.add("set")
+    for i in range(100):
+        db.add("Descriptor", set="set")
+    db.add("Descriptor", set="other")
+    updater = FakeUpdater()
+    deleter = ChunkedDeleter(db.execute_query, batch_size=10, updater=updater)
+    deleter.add_descriptor_set("set")
+    assert list(deleter.run().values()) == [100]
+    assert db.descriptor_sets == set()
+    assert len(db.of_type("Descriptor")) == 1
+    # One count and one delete
+    assert len(db.queries) == 2
+    assert updater.updates[0] == (100.0, "deleting")
+
+
+def test_overlapping_step_not_in_total():
+    db = FakeDB()
+    db.descriptor_sets.add("set")
+    for i in range(20):
+        db.add("Descriptor", set="set", spec_id="a")
+    for i in range(5):
+        db.add("Descriptor", set="renamed", spec_id="a")
+    updater = FakeUpdater()
+    deleter = ChunkedDeleter(db.execute_query, batch_size=10, updater=updater)
+    deleter.add_descriptor_set("set")
+    # Also finds the descriptors in "set", until that step has run
+    deleter.add("Descriptor", {"spec_id": ["==", "a"]}, in_total=False)
+    assert list(deleter.run().values()) == [20, 5]
+    assert db.of_type("Descriptor") == []
+    assert [c for c, _ in updater.updates] == [100.0, 100.0, 100.0]
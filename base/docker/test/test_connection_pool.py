@@ -0,0 +1,280 @@
+#!/usr/bin/env python3
+"""
+Test suite for connection_pool.py
+
+Tests use fake connections, so no ApertureDB instance is needed.
+"""
+
+import asyncio
+import threading
+import time
+import pytest
+
+from connection_pool import AsyncConnectionPool, ConnectionPool
+
+
+class FakeConnection:
+    def __init__(self, delay: float = 0):
+        self.alive = True
+        self.closed = False
+        self.status_checks = 0
+        self.delay = delay
+
+    def query(self, query, blobs=[]):
+        if self.delay:
+            time.sleep(self.delay)
+        if query == [{"GetStatus": {}}]:
+            self.status_checks += 1
+        if not self.alive:
+            raise ConnectionError("Connection lost")
+        return [{}], []
+
+    def last_query_ok(self):
+        return self.alive
+
+    def close(self):
+        self.closed = True
+
+
+class FakeFactory:
+    def __init__(self, delay: float = 0):
+        self.connections = []
+        self.delay = delay
+
+    def __call__(self):
+        connection = FakeConnection(self.delay)
+        self.connections.append(connection)
+        return connection
+
+
+def test_lazy_creation():
+    factory = FakeFactory()
+    pool = ConnectionPool(pool_size=3, connection_factory=factory)
+    assert len(factory.connections) == 1
+    assert pool.available() == 3
+
+    with pool.get_connection() as a:
+        with pool.get_connection() as b:
+            assert a is not b
+            assert pool.size() == 2
+            assert pool.available() == 1
+    # Connections are reused, most recently returned first
+    with pool.get_connection() as c:
+        assert c is a
+    assert len(factory.connections) == 2
+
+
+def test_no_connections():
+    def factory():
+        raise ConnectionError("No database")
+    with pytest.raises(ConnectionError):
+        ConnectionPool(connection_factory=factory)
+    # Fully lazy pools fail on use
+    pool = ConnectionPool(connection_factory=factory, min_size=0)
+    with pytest.raises(ConnectionError):
+        with pool.get_connection():
+            pass
+    assert pool.size() == 0
+
+
+def test_acquire_timeout():
+    pool = ConnectionPool(pool_size=1, connection_factory=FakeFactory(),
+                          acquire_timeout=0.05)
+    with pool.get_connection():
+        start = time.monotonic()
+        with pytest.raises(TimeoutError):
+            with pool.get_connection():
+                pass
+        assert time.monotonic() - start >= 0.05
+
+
+def test_waits_for_connection():
+    pool = ConnectionPool(pool_size=1, connection_factory=FakeFactory())
+    got = []
+
+    def worker():
+        with pool.get_connection(timeout=5) as connection:
+            got.append(connection)
+
+    with pool.get_connection() as connection:
+        thread = threading.Thread(target=worker)
+        thread.start()
+        time.sleep(0.05)
+        assert got == []
+    thread.join()
+    assert got == [connection]
+
+
+def test_idle_reaping():
+    factory = FakeFactory()
+    pool = ConnectionPool(pool_size=3, connection_factory=factory,
+                          max_idle_time=0.05)
+    with pool.get_connection():
+        with pool.get_connection():
+            pass
+    assert pool.size() == 2
+    time.sleep(0.06)
+    with pool.get_connection():
+        # One connection kept for min_size, and one in use
+        assert pool.size() == 1
+    assert sum(c.closed for c in factory.connections) == 1
+
+
+def test_broken_connection_replaced():
+    factory = FakeFactory()
+    pool = ConnectionPool(pool_size=2, connection_factory=factory)
+    with pytest.raises(ConnectionError):
+        with pool.get_connection() as connection:
+            connection.alive = False
+            connection.query([{"FindImage": {}}])
+    # Checked before use, and replaced
+    with pool.get_connection() as replacement:
+        assert replacement is not connection
+    assert connection.closed
+    assert pool.size() == 1
+
+
+def test_validate_after_idle():
+    factory = FakeFactory()
+    pool = ConnectionPool(pool_size=1, connection_factory=factory,
+                          validate_after=0.05)
+    with pool.get_connection() as connection:
+        pass
+    with pool.get_connection():
+        pass
+    assert connection.status_checks == 0
+    time.sleep(0.06)
+    with pool.get_connection():
+        pass
+    assert connection.status_checks == 1
+
+
+def test_close():
+    factory = FakeFactory()
+    pool = ConnectionPool(pool_size=2, connection_factory=factory)
+    with pool.get_connection():
+        with pool.get_connection():
+            pool.close()
+    assert all(c.closed for c in factory.connections)
+    assert pool.size() == 0
+
+
+def test_metrics():
+    from prometheus_client import REGISTRY
+
+    def sample(name, **labels):
+        return REGISTRY.get_sample_value(name, labels) or 0
+
+    pool = ConnectionPool(pool_size=2, connection_factory=FakeFactory())
+    checkouts = sample("aperturedb_pool_checkout_wait_seconds_count")
+    queries = sample("aperturedb_query_duration_seconds_count",
+                     command="FindImage")
+    errors = sample("aperturedb_query_errors_total", command="FindImage")
+    sent = sample("aperturedb_query_sent_bytes_total")
+    commands = sample("aperturedb_query_sent_commands_total")
+
+    with pool.get_connection():
+        assert sample("aperturedb_pool_connections_in_use") == 1
+    assert sample("aperturedb_pool_connections_in_use") == 0
+
+    pool.query([{"FindImage": {}}], [b"1234"])
+    with pytest.raises(ConnectionError):
+        with pool.get_connection() as connection:
+            connection.alive = False
+        pool.query([{"FindImage": {}}])
+
+    assert sample("aperturedb_pool_checkout_wait_seconds_count") == checkouts + 4
+    assert sample("aperturedb_query_duration_seconds_count",
+                  command="FindImage") == queries + 2
+    assert sample("aperturedb_query_errors_total",
+                  command="FindImage") == errors + 1
+    assert sample("aperturedb_query_sent_bytes_total") == sent + 4
+    assert sample("aperturedb_query_sent_commands_total") == commands + 2
+
+
+def test_async_queries_overlap():
+    pool = AsyncConnectionPool(pool_size=4,
+                               connection_factory=FakeFactory(delay=0.1))
+
+    async def main():
+        ticks = 0
+
+        async def ticker():
+            nonlocal ticks
+            while True:
+                await asyncio.sleep(0.01)
+                ticks += 1
+
+        tick_task = asyncio.create_task(ticker())
+        start = time.monotonic()
+        results = await asyncio.gather(
+            *[pool.query([{"FindImage": {}}]) for _ in range(4)])
+        elapsed = time.monotonic() - start
+        tick_task.cancel()
+        return results, elapsed, ticks
+
+    results, elapsed, ticks = asyncio.run(main())
+    assert results == [([{}], [])] * 4
+    # The queries ran at the same time, and the event loop kept running
+    assert elapsed < 0.3
+    assert ticks >= 5
+    pool.close()
+
+
+def test_async_waits_for_place():
+    factory = FakeFactory()
+    pool = AsyncConnectionPool(pool_size=1, connection_factory=factory)
+
+    async def main():
+        order = []
+
+        async def user(name):
+            async with pool.get_connection() as connection:
+                order.append(name)
+                await pool.run_in_executor(connection.query, [{"FindImage": {}}])
+                await asyncio.sleep(0.02)
+            return connection
+
+        connections = await asyncio.gather(user("a"), user("b"))
+        status = await pool.execute_query([{"FindImage": {}}])
+        return order, connections, status
+
+    order, connections, status = asyncio.run(main())
+    assert order == ["a", "b"]
+    assert connections[0] is connections[1]
+    assert status[1] == [{}]
+    assert len(factory.connections) == 1
+    pool.close()
+
+
+def test_async_timeout():
+    pool = AsyncConnectionPool(pool_size=1, connection_factory=FakeFactory(),
+                               acquire_timeout=0.05)
+
+    async def main():
+        async with pool.get_connection():
+            with pytest.raises(TimeoutError):
+                await pool.run(lambda connection: None)
+
+    asyncio.run(main())
+    assert pool.pool.available() == 1
+    pool.close()
+
+
+def test_async_run_error_marks_suspect():
+    factory = FakeFactory()
+    pool = AsyncConnectionPool(pool_size=1, connection_factory=factory)
+
+    def fail(connection):
+        connection.alive = False
+        connection.query([{"FindImage": {}}])
+
+    async def main():
+        with pytest.raises(ConnectionError):
+            await pool.run(fail)
+        return await pool.run(lambda connection: connection)
+
+    replacement = asyncio.run(main())
+    assert replacement is not factory.connections[0]
+    assert factory.connections[0].closed
+    pool.close()
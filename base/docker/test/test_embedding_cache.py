@@ -0,0 +1,164 @@
+#!/usr/bin/env python3
+"""
+Test suite for embeddings/cache.py and the cache in Embedder
+
+The embeddings package needs torch, so these are skipped where the
+embedding requirements are not installed.
+"""
+
+import itertools
+
+import numpy as np
+import pytest
+
+pytest.importorskip("torch")
+
+from embeddings import cache as cache_module  # noqa: E402
+from embeddings import embeddings as embeddings_module  # noqa: E402
+from embeddings.cache import EmbeddingCache, input_key  # noqa: E402
+from embeddings.embeddings import Embedder  # noqa: E402
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    """Make each use of the cache later than the last"""
+    ticks = itertools.count()
+    monkeypatch.setattr(cache_module.time, "time", lambda: float(next(ticks)))
+
+
+def vector(i: float, n: int = 4) -> np.ndarray:
+    return np.full(n, i, dtype=np.float32)
+
+
+def keys(prefix: str, n: int) -> list:
+    return [input_key("text", f"{prefix}{i}".encode()) for i in range(n)]
+
+
+def test_hits_and_misses(tmp_path):
+    cache = EmbeddingCache(str(tmp_path / "sub" / "cache.db"))
+    k = keys("a", 3)
+    cache.put_many("fp", [(k[0], vector(0)), (k[1], vector(1))])
+
+    found = cache.get_many("fp", [k[1], k[2], k[0]])
+    assert found[1] is None
+    np.testing.assert_array_equal(found[0], vector(1))
+    np.testing.assert_array_equal(found[2], vector(0))
+    assert found[0].dtype == np.float32
+    # Another model has its own embeddings
+    assert cache.get_many("other", k) == [None, None, None]
+    # Another instance sees the same file
+    assert EmbeddingCache(cache.path).get_many("fp", k[:1])[0] is not None
+
+
+def test_duplicate_keys(tmp_path):
+    cache = EmbeddingCache(str(tmp_path / "cache.db"))
+    k = keys("a", 2)
+    cache.put_many("fp", [(k[0], vector(7))])
+    found = cache.get_many("fp", [k[0], k[1], k[0]])
+    assert found[1] is None
+    np.testing.assert_array_equal(found[0], vector(7))
+    np.testing.assert_array_equal(found[2], vector(7))
+
+
+def test_many_keys(tmp_path):
+    # More than fit in one SQLite statement
+    cache = EmbeddingCache(str(tmp_path / "cache.db"))
+    k = keys("a", 1200)
+    cache.put_many("fp", [(key, vector(i, 2)) for i, key in enumerate(k)])
+    found = cache.get_many("fp", k + keys("b", 10))
+    assert [v[0] for v in found[:1200]] == list(range(1200))
+    assert found[1200:] == [None] * 10
+
+
+def test_evicts_least_recently_used(tmp_path, clock):
+    # Room for 10 vectors of 16 bytes
+    cache = EmbeddingCache(str(tmp_path / "cache.db"), max_bytes=10 * 16)
+    old = keys("old", 8)
+    cache.put_many("fp", [(key, vector(i)) for i, key in enumerate(old)])
+    # The first two are used again, so the next oldest go first
+    cache.get_many("fp", old[:2])
+    new = keys("new", 5)
+    cache.put_many("fp", [(key, vector(i)) for i, key in enumerate(new)])
+
+    kept = [v is not None for v in cache.get_many("fp", old)]
+    # Down to 90% of the limit: 9 vectors
+    assert kept == [True, True, False, False, False, False, True, True]
+    assert all(v is not None for v in cache.get_many("fp", new))
+
+
+def test_reconnects_in_new_process(tmp_path):
+    cache = EmbeddingCache(str(tmp_path / "cache.db"))
+    k = keys("a", 1)
+    cache.put_many("fp", [(k[0], vector(1))])
+    db = cache._db
+    cache._pid = -1  # as if after a fork
+    assert cache.get_many("fp", k)[0] is not None
+    assert cache._db is not db
+
+
+def test_corrupt_file_is_a_miss(tmp_path, caplog):
+    path = tmp_path / "cache.db"
+    path.write_bytes(b"this is not a database" * 100)
+    cache = EmbeddingCache(str(path))
+    k = keys("a", 2)
+    assert cache.get_many("fp", k) == [None, None]
+    cache.put_many("fp", [(k[0], vector(1))])  # does not raise
+    assert "embedding cache" in caplog.text
+
+
+def test_unwritable_path_is_a_miss(tmp_path):
+    not_a_directory = tmp_path / "file"
+    not_a_directory.write_text("")
+    cache = EmbeddingCache(str(not_a_directory / "cache.db"))
+    k = keys("a", 1)
+    cache.put_many("fp", [(k[0], vector(1))])
+    assert cache.get_many("fp", k) == [None]
+
+
+class FakeModel:
+    """Records the inputs that reach the model"""
+
+    def __init__(self):
+        self.calls = []
+
+    def embed(self, texts):
+        self.calls.append(list(texts))
+        return [vector(ord(text[0])) for text in texts]
+
+
+@pytest.fixture
+def embedder(monkeypatch):
+    # No model is loaded; the fake stands in for inference
+    embedder = Embedder.__new__(Embedder)
+    monkeypatch.setattr(embedder, "fingerprint_hash", lambda: "fp", raising=False)
+    return embedder
+
+
+def cached(embedder, model, texts):
+    return embedder._cached("text", texts, [t.encode() for t in texts], model.embed)
+
+
+def test_embedder_embeds_only_misses(embedder, tmp_path, monkeypatch):
+    monkeypatch.setattr(embeddings_module, "EMBEDDING_CACHE",
+                        EmbeddingCache(str(tmp_path / "cache.db")))
+    model = FakeModel()
+
+    first = cached(embedder, model, ["a", "b", "a"])
+    # Repeated inputs are embedded once
+    assert model.calls == [["a", "b"]]
+    assert [v[0] for v in first] == [ord("a"), ord("b"), ord("a")]
+
+    second = cached(embedder, model, ["c", "b", "d", "c"])
+    assert model.calls[1] == ["c", "d"]
+    assert [v[0] for v in second] == [ord("c"), ord("b"), ord("d"), ord("c")]
+
+    cached(embedder, model, ["d", "a"])
+    assert len(model.calls) == 2
+
+
+def test_embedder_without_cache(embedder, monkeypatch):
+    monkeypatch.setattr(embeddings_module, "EMBEDDING_CACHE", None)
+    model = FakeModel()
+    cached(embedder, model, ["a", "a"])
+    cached(embedder, model, ["a"])
+    assert model.calls == [["a", "a"], ["a"]]
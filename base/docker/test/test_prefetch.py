@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+"""
+Test suite for prefetch.py
+"""
+
+import threading
+
+import pytest
+
+from prefetch import prefetch
+
+
+def test_yields_in_order():
+    assert list(prefetch(iter(range(100)), depth=3)) == list(range(100))
+
+
+def test_depth_zero_runs_in_caller():
+    threads = []
+
+    def items():
+        threads.append(threading.current_thread())
+        yield 1
+
+    assert list(prefetch(items(), depth=0)) == [1]
+    assert threads == [threading.current_thread()]
+
+
+def test_runs_ahead_by_depth():
+    produced = []
+    ready = threading.Event()
+
+    def items():
+        for i in range(10):
+            produced.append(i)
+            if len(produced) == 4:
+                ready.set()
+            yield i
+
+    reader = prefetch(items(), depth=2)
+    assert next(reader) == 0
+    ready.wait(timeout=5)
+    # Two waiting in the queue and one waiting to be put
+    assert len(produced) == 4
+    reader.close()
+
+
+def test_raises_producer_error():
+    def items():
+        yield 1
+        raise ValueError("broken page")
+
+    reader = prefetch(items(), depth=2)
+    assert next(reader) == 1
+    with pytest.raises(ValueError, match="broken page"):
+        next(reader)
+
+
+def test_close_stops_producer():
+    produced = []
+
+    def items():
+        for i in range(1000):
+            produced.append(i)
+            yield i
+
+    reader = prefetch(items(), depth=1)
+    assert next(reader) == 0
+    reader.close()
+    assert len(produced) < 1000
+    assert not any(t.name == "prefetch" for t in threading.enumerate())
@@ -0,0 +1,150 @@
+#!/usr/bin/env python3
+"""
+Test suite for text_extraction/segmentation.py
+
+Tests use a small stand-in for the tiktoken encoding, so that they do not
+need to download it.
+"""
+
+import random
+import re
+
+import pytest
+
+from text_extraction import segmentation
+from text_extraction.schema import TextBlock
+from text_extraction.segmentation import TextSegmenter
+
+
+class FakeEncoding:
+    """Just enough of a tiktoken Encoding. A token is up to four
+    characters of a word, with the whitespace before them, so tokens
+    span separators and long words take several tokens."""
+
+    _TOKEN = re.compile(r"\s*\S{1,4}|\s+")
+
+    def __init__(self):
+        self.ids = {}
+        self.pieces = []
+
+    def encode_ordinary(self, text):
+        tokens = []
+        for match in self._TOKEN.finditer(text):
+            piece = match.group()
+            if piece not in self.ids:
+                self.ids[piece] = len(self.pieces)
+                self.pieces.append(piece)
+            tokens.append(self.ids[piece])
+        return tokens
+
+    def decode_single_token_bytes(self, token):
+        return self.pieces[token].encode("utf-8", "surrogatepass")
+
+
+@pytest.fixture
+def segmenter(monkeypatch):
+    monkeypatch.setattr(segmentation, "encoding_for_model",
+                        lambda model_name: FakeEncoding())
+    return TextSegmenter(max_tokens=6, overlap_tokens=3, min_tokens=0)
+
+
+def split(segmenter, text):
+    return segmenter._split(text, segmenter._encode(text))
+
+
+def test_merges_paragraphs(segmenter):
+    text = "aa bb cc\n\ndd ee ff\n\ngg hh ii jj kk ll mm"
+    # The last paragraph is too long, so it is split on words
+    assert split(segmenter, text) == [
+        ("aa bb cc\n\ndd ee ff", 6),
+        ("gg hh ii jj kk ll", 6),
+        ("mm", 1),
+    ]
+
+
+def test_splits_lines(segmenter):
+    assert split(segmenter, "aa bb\ncc dd ee ff gg\nhh") == [
+        ("aa bb", 2),
+        ("cc dd ee ff gg\nhh", 6),
+    ]
+
+
+def test_splits_words_by_tokens(segmenter):
+    # "three", "seven" and "eight" are two tokens each
+    text = "one two three four five six seven eight nine ten"
+    assert split(segmenter, text) == [
+        ("one two three four five", 6),
+        ("six seven eight nine", 6),
+        ("ten", 1),
+    ]
+
+
+def test_splits_long_word_into_characters(segmenter):
+    # Each character counts as the token it is in
+    assert split(segmenter, "abcdefghijklmnopqrstuvwxyz0123 end") == [
+        ("abcdef", 2),
+        ("ghijkl", 2),
+        ("mnopqr", 2),
+        ("stuvwx", 2),
+        ("yz0123", 2),
+        ("end", 1),
+    ]
+
+
+def test_multibyte_characters(segmenter):
+    text = "naïve café\n\n東京データ 검색 поиск über straße \ud800x ok"
+    chunks = split(segmenter, text)
+    assert chunks == [
+        ("naïve café", 3),
+        ("東京データ 검색 поиск über", 6),
+        ("straße \ud800x ok", 4),
+    ]
+    assert all(count == len(segmenter._encode(chunk)) for chunk, count in chunks)
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_split_keeps_text_within_limit(segmenter, seed):
+    rng = random.Random(seed)
+    words = ["a", "to", "the", "data", "query", "vectors", "embedding", "café", "東京"]
+    separators = [" "] * 8 + ["\n"] * 2 + ["\n\n"]
+    text = "".join(rng.choice(words) + rng.choice(separators) for _ in range(300)).strip()
+    chunks = split(segmenter, text)
+
+    assert [w for chunk, _ in chunks for w in chunk.split()] == text.split()
+    for chunk, count in chunks:
+        assert 0 < count <= segmenter.max_tokens
+        # Splits fall between words, so a chunk has the tokens it would
+        # have if it were encoded on its own
+        assert count == len(segmenter._encode(chunk))
+
+
+def test_segments_overlap(segmenter):
+    blocks = [TextBlock(text=t, title="Title")
+              for t in ["one two", "three four", "five", "six seven eight", "nine"]]
+    segments = list(segmenter.segment(blocks, clean_only=False))
+    assert [(s.text, s.total_tokens) for s in segments] == [
+        ("one two\n\nthree four\n\nfive", 6),
+        # "five" is carried over, as it fits in overlap_tokens
+        ("five\n\nsix seven eight", 6),
+        # "six seven eight" does not fit in the overlap
+        ("nine", 1),
+    ]
+    assert all(s.title == "Title" for s in segments)
+
+
+def test_long_block_is_split(segmenter):
+    block = TextBlock(text="one two three four five six seven eight nine ten",
+                      page_number=3)
+    segments = list(segmenter.segment([block], clean_only=False))
+    assert [(s.text, s.total_tokens) for s in segments] == [
+        ("one two three four five", 6),
+        ("six seven eight nine", 6),
+        ("ten", 1),
+    ]
+    assert all(s.blocks[0].page_number == 3 for s in segments)
+
+
+def test_rejects_garbage(segmenter):
+    blocks = [TextBlock(text="!!!! ???? ....")]
+    assert list(segmenter.segment(blocks)) == []
+    assert len(list(segmenter.segment(blocks, clean_only=False))) == 1